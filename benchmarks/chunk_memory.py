@@ -0,0 +1,75 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Peak memory of a hiMoon run, without chunks and with --chunked at several chunk sizes
+
+Each run is a separate hiMoon process, peak RSS is read from its resource usage
+(solver subprocesses are not included).
+
+usage: python benchmarks/chunk_memory.py VCF -t TRANSLATION_TABLES [--chunk-sizes 10,100,1000]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def run_himoon(vcf_file: str, translation_tables: str, extra_args: list) -> tuple:
+    """
+    Run hiMoon in a child process
+
+    Args:
+        vcf_file (str): path/to/vcf
+        translation_tables (str): translation table or directory
+        extra_args (list): additional hiMoon arguments
+
+    Returns:
+        tuple: peak RSS (MB) and wall time (s)
+    """
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "hiMoon", vcf_file, "-t", translation_tables, "-o", out_dir] + extra_args,
+            stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError(f"hiMoon exited with status {status} ({' '.join(extra_args)})")
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss / scale, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description = "Compare peak memory of hiMoon with and without --chunked.")
+    parser.add_argument("vcf_file", help = "path/to/indexed multi-sample vcf")
+    parser.add_argument("-t", "--translation-tables", required = True,
+                        help = "Directory with translation tables or a single translation table file")
+    parser.add_argument("--chunk-sizes", default = "10,100,1000",
+                        help = "Comma separated chunk sizes, default = 10,100,1000")
+    args = parser.parse_args()
+    runs = [("all samples", [])]
+    runs += [(f"--chunked {size}", ["--chunked", "--chunk-size", size]) for size in args.chunk_sizes.split(",")]
+    print("\t".join(["RUN", "PEAK_RSS_MB", "SECONDS"]))
+    for name, extra_args in runs:
+        peak, elapsed = run_himoon(args.vcf_file, args.translation_tables, extra_args)
+        print("\t".join([name, f"{peak:.1f}", f"{elapsed:.1f}"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Per-sample latency of calling a gene panel, one gene at a time and with genes called concurrently
+
+Genes are loaded once, then every sample is called with each --gene-workers setting
+(on threads, and with --processes also in gene worker processes, see subject.GeneProcesses)
+and the median and maximum wall time per sample are reported.
+By default the bundled GRCh38 CYP2D6, CYP2C9, and CYP2C19 translation tables are used.
+Without a VCF (--simulate), a VCF with the variants of every table is written first, 
+each sample carrying two random haplotypes of every gene, so every gene is solved. 
+
+usage: python benchmarks/gene_latency.py [VCF] [-t TRANSLATION_TABLES] [--gene-workers 1,3] [--processes] [--samples 10] [--simulate 20]
+"""
+
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from pysam import VariantFile, VariantHeader, tabix_index
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from hiMoon import get_config
+from hiMoon.gene import AbstractGene
+from hiMoon.subject import GeneProcesses, Subject
+from hiMoon.vcf import VarFile
+
+TABLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hiMoon", "tests", "test_files", "translation_tables")
+PANEL = ["CYP2D6.NC_000022.11", "CYP2C9.NC_000010.11", "CYP2C19.NC_000010.11"]
+
+
+def simulate_vcf(path: str, genes: list, config, samples: int, seed: int = 1) -> None:
+    """
+    Write an indexed VCF with the variants of the genes' translation tables, 
+    every sample carries two random haplotypes (unphased) of each gene
+
+    Args:
+        path (str): path/to/out.vcf.gz
+        genes (list): gene.AbstractGene objects (without variants)
+        config (ConfigData): config.ConfigData object
+        samples (int): number of samples
+        seed (int, optional): random seed. Defaults to 1.
+    """
+    rng = random.Random(seed)
+    header = VariantHeader()
+    header.add_line('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">')
+    for gene in genes:
+        header.add_line(f"##contig=<ID=chr{gene.chromosome},length=250000000>")
+    sample_names = [f"SIM{i}" for i in range(samples)]
+    for sample in sample_names:
+        header.add_sample(sample)
+    records = []
+    for gene in genes:
+        table = gene.translation_table.iloc[:gene.modifier_start]
+        sites = {} # MATCH_ID -> [REF, ALT alleles, haplotype -> allele index]
+        for hap, ref, alt, var_type, match_id in zip(table.iloc[:, 0], table["Reference Allele"], table["Variant Allele"], table["Type"], table["MATCH_ID"]):
+            if var_type == "insertion":
+                site_ref, site_alt = "A", "A" + alt
+            elif var_type == "deletion":
+                site_ref, site_alt = "A" + ref, "A"
+            elif var_type == "substitution":
+                site_ref, site_alt = ref, config.IUPAC_CODES.get(alt, [alt])[0]
+            else:
+                continue
+            site = sites.setdefault(match_id, [site_ref, [], {}])
+            if site[0] != site_ref or (var_type == "substitution" and len(site_ref) != len(site_alt)):
+                continue # Another variant type at the same position, or a substitution written as a longer allele
+            if site_alt not in site[1]:
+                site[1].append(site_alt)
+            site[2][hap] = site[1].index(site_alt) + 1
+        haps = list(gene.hap_names) + [gene.reference]
+        calls = [(rng.choice(haps), rng.choice(haps)) for _ in sample_names]
+        for match_id, (site_ref, site_alts, hap_alleles) in sites.items():
+            _, pos, _ = match_id.split("_")
+            genotypes = [tuple(hap_alleles.get(hap, 0) for hap in call) for call in calls]
+            records.append((gene.chromosome, int(pos), site_ref, site_alts, genotypes))
+    records.sort(key = lambda r: (r[0], r[1]))
+    with VariantFile(path, "wz", header = header) as out:
+        for chrom, pos, site_ref, site_alts, genotypes in records:
+            record = out.new_record(contig = f"chr{chrom}", start = pos - 1, alleles = [site_ref] + site_alts)
+            for sample, gt in zip(sample_names, genotypes):
+                record.samples[sample]["GT"] = gt
+            out.write(record)
+    tabix_index(path, preset = "vcf", csi = True, force = True)
+
+
+def sample_latency(samples: list, genes: list, config, gene_workers: int, gene_processes: GeneProcesses = None) -> list:
+    """
+    Call each sample and time it
+
+    Args:
+        samples (list): sample IDs
+        genes (list): gene.AbstractGene objects with variants
+        config (ConfigData): config.ConfigData object
+        gene_workers (int): genes called at the same time
+        gene_processes (GeneProcesses, optional): processes that match and solve the genes. Defaults to None (threads).
+
+    Returns:
+        list: seconds per sample
+    """
+    times = []
+    for sample in samples:
+        start = time.perf_counter()
+        Subject(sample, genes = genes, config = config, gene_workers = gene_workers, gene_processes = gene_processes)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description = "Compare per-sample latency with genes called one at a time and concurrently.")
+    parser.add_argument("vcf_file", nargs = "?", help = "path/to/indexed vcf (not needed with --simulate)")
+    parser.add_argument("-t", "--translation-tables", default = ",".join(f"{TABLES}/{table}.haplotypes.tsv" for table in PANEL),
+                        help = "Comma separated translation tables, default = bundled GRCh38 CYP2D6, CYP2C9, and CYP2C19 tables")
+    parser.add_argument("--gene-workers", default = "1,3",
+                        help = "Comma separated --gene-workers settings, default = 1,3")
+    parser.add_argument("--processes", action = "store_true",
+                        help = "Also call the genes in gene worker processes for each --gene-workers setting")
+    parser.add_argument("--samples", type = int, default = 10,
+                        help = "Number of samples to call, default = 10")
+    parser.add_argument("--simulate", type = int, default = 0,
+                        help = "Write a VCF with this many samples carrying haplotypes of the translation tables and use it instead of VCF")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    config = get_config()
+    vcf_file = args.vcf_file
+    if args.simulate:
+        vcf_file = os.path.join(tempfile.mkdtemp(), "simulated.vcf.gz")
+        simulate_vcf(vcf_file, [AbstractGene(table, config = config) for table in args.translation_tables.split(",")], config, args.simulate)
+    elif vcf_file is None:
+        parser.error("a VCF or --simulate is required")
+    vcf = VarFile(vcf_file, config = config)
+    genes = [AbstractGene(table, vcf = vcf, config = config) for table in args.translation_tables.split(",")]
+    samples = vcf.samples[:args.samples]
+    Subject(samples[0], genes = genes, config = config) # Warm up (solver start, first LP)
+    print("\t".join(["GENE_WORKERS", "EXECUTOR", "SAMPLES", "MEDIAN_SECONDS", "MAX_SECONDS"]))
+    for gene_workers in args.gene_workers.split(","):
+        for executor in ["threads", "processes"] if args.processes else ["threads"]:
+            gene_processes = GeneProcesses(genes, config, int(gene_workers)) if executor == "processes" else None
+            times = sample_latency(samples, genes, config, int(gene_workers), gene_processes)
+            if gene_processes is not None:
+                gene_processes.close()
+            print("\t".join([gene_workers, executor, str(len(times)), f"{statistics.median(times):.3f}", f"{max(times):.3f}"]))
+
+
+if __name__ == "__main__":
+    main()
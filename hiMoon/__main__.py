@@ -18,36 +18,168 @@ import glob
 import sys
 import csv
 
-from .subject import Subject
+from .subject import Subject, GeneProcesses
+from .haplotype import phased_fallback_stats, reset_phased_fallbacks, fast_path_stats, reset_fast_paths
 from .gene import AbstractGene
-from .vcf import VarFile, write_variant_file, write_flat_file
+from .vcf import READERS, VarFile, ColumnarWriter, FlatFileWriter, VariantFileWriter, read_flat_file
+from .store import RegionStore, is_store, write_store
+from .summary import CohortSummary, read_groups
+from .pipeline import Pipeline, call_chunks
+from .cache import CallCache
+from .incremental import IncrementalCalls
+from .sweep import ParameterSweep, parse_settings, read_truth, truth_alleles
+from .trace import TraceLog
+from . import memory
 
 from . import LOGGING, get_config, set_logging_info
 
-def get_vcf_genes(args, CONFIG) -> ([AbstractGene], VarFile):
+def get_vcf_genes(args, CONFIG, load_variants: bool = True) -> ([AbstractGene], VarFile):
     """
     Prep VCF and gene objects
 
     Args:
         args ([type]): args
+        load_variants (bool, optional): fetch gene regions for all samples now. 
+            Set to False when regions are fetched later per chunk of samples. Defaults to True.
 
     Returns:
         Tuple
     """
-    vcf = VarFile(args["vcf_file"], args["sample"], config = CONFIG)
-    genes = []
-    solver = args["solver"]
-    if args["translation_tables"][-3:] == "tsv":
-        genes.append(AbstractGene(os.path.abspath(args["translation_tables"]), vcf, solver = solver, config = CONFIG, phased = args["phased"]))
+    if is_store(args["vcf_file"]):
+        vcf = RegionStore(args["vcf_file"], args["sample"])
     else:
-        for translation_table in glob.glob(args["translation_tables"] + "/*.tsv"):
-            genes.append(AbstractGene(os.path.abspath(translation_table), vcf, solver = solver, config = CONFIG, phased = args["phased"]))
+        vcf = VarFile(args["vcf_file"], args["sample"], config = CONFIG, stream = args["stream"], reader = args["reader"])
+    gene_vcf = vcf if load_variants or vcf.stream else None
+    genes = get_genes(args["translation_tables"], gene_vcf, args, CONFIG)
+    if vcf.stream:
+        vcf.fill_genes(genes)
     return vcf, genes
 
+def get_genes(translation_tables: str, vcf, args, CONFIG) -> [AbstractGene]:
+    """
+    Gene objects for a translation table or a directory of translation tables
+
+    Args:
+        translation_tables (str): translation table or directory
+        vcf (VarFile): VarFile to fetch gene regions from, None to leave variants empty
+        args ([type]): args
+
+    Returns:
+        [AbstractGene]: genes
+    """
+    if translation_tables[-3:] == "tsv":
+        translation_tables = [translation_tables]
+    else:
+        translation_tables = glob.glob(translation_tables + "/*.tsv")
+    return [AbstractGene(os.path.abspath(translation_table), vcf, solver = args["solver"], config = CONFIG, phased = args["phased"]) for translation_table in translation_tables]
+
+def extract(argv: list) -> None:
+    """
+    hiMoon extract: write genotypes in all gene windows to a region store
+    The store can then be given to hiMoon in place of the VCF. 
+
+    Args:
+        argv (list): command line arguments following "extract"
+    """
+    parser = argparse.ArgumentParser(
+                        description="Extract genotypes in all gene windows to a region store that can be used in place of the VCF.", prog="hiMoon extract")
+    parser.add_argument("vcf_file", help="path/to/vcf file, or a manifest (.txt/.list/.manifest) listing one indexed VCF/BCF per line")
+    parser.add_argument("-t", "--translation-tables",
+                        help="Directory with translation tables or a single translation table file", 
+                        required=True)
+    parser.add_argument("-o", "--output-directory",
+                        required=True,
+                        help="Directory for the region store.")
+    parser.add_argument("-c", "--config-file",
+                        default=None,
+                        help="path to config file.")
+    parser.add_argument("--stream",
+                        help="Read the VCF in a single pass without an index (use - for stdin)",
+                        action="store_true")
+    parser.add_argument("--reader",
+                        help="Genotype decoding backend: pysam (default) or text (decodes all samples of a record at once, faster for wide VCFs)",
+                        choices=list(READERS),
+                        default=None)
+    args = vars(parser.parse_args(argv))
+    CONFIG = get_config(args["config_file"])
+    vcf, genes = get_vcf_genes({**args, "sample": None, "solver": "CBC", "phased": False}, CONFIG)
+    write_store(args["output_directory"], genes, vcf.samples)
+
+def sweep(argv: list) -> None:
+    """
+    hiMoon sweep: call samples with several LP parameter sets
+    Genotypes are read and matched once per sample, only the LP is run for each set. 
+    With --truth (and no VCF/translation tables), the VCF, translation table, and samples of each truth file are used.
+
+    Args:
+        argv (list): command line arguments following "sweep"
+    """
+    parser = argparse.ArgumentParser(
+                        description="Call samples with several LP parameter sets, matching each sample once.", prog="hiMoon sweep")
+    parser.add_argument("vcf_file", help="path/to/vcf file (not needed with --truth)", nargs="?")
+    parser.add_argument("-t", "--translation-tables",
+                        help="Directory with translation tables or a single translation table file (not needed with --truth)", 
+                        default=None)
+    parser.add_argument("--settings",
+                        help="LP parameter sets separated by ';', parameters separated by ',' (e.g. 'max_haps=2;max_haps=3,optimal_decay=0.1')",
+                        required=True)
+    parser.add_argument("--truth",
+                        help="Comma separated truth files (YAML as in tests/test_files) for a concordance summary (requires PyYAML)",
+                        default=None)
+    parser.add_argument("-o", "--output-directory",
+                        default="./",
+                        help="Directory for Output Files.")
+    parser.add_argument("-c", "--config-file",
+                        default=None,
+                        help="path to config file.")
+    parser.add_argument("-s", "--sample",
+                        help="Single sample from multisample ID (if not specified, will do all)",
+                        default=None)
+    parser.add_argument("-S", "--solver",
+                        help="Solver to use (GLPK or CBC), default = CBC",
+                        default="CBC")
+    parser.add_argument("-P", "--phased",
+                        help="Use phased constraint in LP",
+                        action="store_true")
+    parser.add_argument("--reader",
+                        help="Genotype decoding backend: pysam (default) or text (decodes all samples of a record at once, faster for wide VCFs)",
+                        choices=list(READERS),
+                        default=None)
+    args = vars(parser.parse_args(argv))
+    CONFIG = get_config(args["config_file"])
+    truth_files = args["truth"].split(",") if args["truth"] else []
+    definitions = [read_truth(truth_file) for truth_file in truth_files]
+    truth = truth_alleles(definitions) if definitions else None
+    if args["vcf_file"] and args["translation_tables"]:
+        runs = [(args["vcf_file"], args["translation_tables"])]
+        prefix = os.path.basename(os.path.normpath(args["vcf_file"])).replace(".vcf.gz", "").replace(".bcf", "").replace(".vcf", "")
+    elif definitions and not (args["vcf_file"] or args["translation_tables"]):
+        runs = [(os.path.join(os.path.dirname(os.path.abspath(truth_file)), definition["VCF"].strip()),
+                 os.path.join(os.path.dirname(os.path.abspath(truth_file)), definition["TRANSLATION_TABLE"].strip())) for truth_file, definition in zip(truth_files, definitions)]
+        prefix = "truth"
+    else:
+        print("You must provide a VCF and translation tables, or truth files (--truth) that name them.")
+        sys.exit(1)
+    truth_samples = {sample for sample, _ in truth} if truth else None
+    param_sweep = ParameterSweep(parse_settings(args["settings"]), config = CONFIG)
+    for vcf_file, translation_tables in runs:
+        vcf = VarFile(vcf_file, args["sample"], config = CONFIG, reader = args["reader"])
+        genes = get_genes(translation_tables, vcf, args, CONFIG)
+        for sub_id in vcf.samples:
+            if truth_samples is None or sub_id in truth_samples:
+                param_sweep.call(sub_id, genes)
+    param_sweep.write(args["output_directory"], prefix, truth)
+
 def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == "extract":
+        extract(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "sweep":
+        sweep(sys.argv[2:])
+        sys.exit(0)
     parser = argparse.ArgumentParser(
                         description="Match haplotypes, return raw data and/or reports.", prog="hiMoon")
-    parser.add_argument("vcf_file", help="path/to/vcf file", nargs="?")
+    parser.add_argument("vcf_file", help="path/to/vcf file, a manifest (.txt/.list/.manifest) listing one indexed VCF/BCF per line, or a region store from hiMoon extract", nargs="?")
     parser.add_argument("-t", "--translation-tables",
                         help="Directory with translation tables or a single translation table file", 
                         default=None)
@@ -69,6 +201,69 @@ def main() -> None:
     parser.add_argument("-P", "--phased",
                         help="Use phased constraint in LP",
                         action="store_true")
+    parser.add_argument("--stream",
+                        help="Read the VCF in a single pass without an index (use - for stdin)",
+                        action="store_true")
+    parser.add_argument("--reader",
+                        help="Genotype decoding backend: pysam (default) or text (decodes all samples of a record at once, faster for wide VCFs)",
+                        choices=list(READERS),
+                        default=None)
+    parser.add_argument("--parquet",
+                        help="Also write calls to a Parquet file (requires pyarrow)",
+                        action="store_true")
+    parser.add_argument("--bgzip",
+                        help="Write the haplotype VCF BGZF compressed ({prefix}.haplotypes.vcf.gz) with a CSI index",
+                        action="store_true")
+    parser.add_argument("--bgzip-threads",
+                        help="Extra compression threads with --bgzip, default = 0",
+                        type=int,
+                        default=0)
+    parser.add_argument("--summary",
+                        help="Write haplotype/diplotype counts and call rates per gene",
+                        action="store_true")
+    parser.add_argument("--groups",
+                        help="Tab-delimited sample to group (e.g. population) mapping for the summary (implies --summary)",
+                        default=None)
+    parser.add_argument("--pipeline",
+                        help="Overlap VCF decoding, matching/solving, and writing (samples are processed in chunks)",
+                        action="store_true")
+    parser.add_argument("--chunked",
+                        help="Process samples in chunks of --chunk-size, only one chunk of genotypes is held in memory",
+                        action="store_true")
+    parser.add_argument("--memory-report",
+                        help="Write peak and retained memory per stage and gene (slows hiMoon down)",
+                        action="store_true")
+    parser.add_argument("--trace",
+                        help="Write {prefix}.trace.jsonl with the problem size and solves of each sample and gene",
+                        action="store_true")
+    parser.add_argument("--cache-dir",
+                        help="Directory of a persistent cache of solved calls, samples with cached genotype patterns are not solved again",
+                        default=None)
+    parser.add_argument("--cache-size",
+                        help="Maximum number of calls kept in the cache (least recently used are removed), default = 1000000",
+                        type=int,
+                        default=1000000)
+    parser.add_argument("--previous-tables",
+                        help="Translation table(s) of an earlier run, only samples whose genotypes touch updated haplotypes are called again (needs --previous-calls)",
+                        default=None)
+    parser.add_argument("--previous-calls",
+                        help="Flat file ({prefix}.haplotypes.tsv) of the earlier run with --previous-tables, other calls are carried forward",
+                        default=None)
+    parser.add_argument("--workers",
+                        help="Number of matching/solving threads with --pipeline, default = 2",
+                        type=int,
+                        default=2)
+    parser.add_argument("--gene-workers",
+                        help="Number of genes called at the same time for each sample (solvers run in parallel), default = 1",
+                        type=int,
+                        default=1)
+    parser.add_argument("--gene-processes",
+                        help="Call the --gene-workers genes in worker processes instead of threads, so table matching runs in parallel too (not with --pipeline or --chunked)",
+                        action="store_true")
+    parser.add_argument("--chunk-size",
+                        help="Number of samples per chunk with --pipeline or --chunked, default = 100",
+                        type=int,
+                        default=100)
     
     args = vars(parser.parse_args())
     if args["config_file"] ==  "default":
@@ -79,15 +274,71 @@ def main() -> None:
     if args["translation_tables"] is None:
         print("You must provide a translation table or a directory with translation tables.")
         sys.exit(1)
+    if (args["previous_tables"] is None) != (args["previous_calls"] is None):
+        print("--previous-tables and --previous-calls must be used together.")
+        sys.exit(1)
+    if args["memory_report"] and (args["pipeline"] or args["gene_workers"] > 1 or args["gene_processes"]):
+        print("--memory-report cannot be used with --pipeline, --gene-processes, or --gene-workers above 1, stages must run one at a time to be measured.")
+        sys.exit(1)
+    if args["gene_processes"] and (args["pipeline"] or args["chunked"]):
+        print("--gene-processes cannot be used with --pipeline or --chunked, the processes are started with every sample's variants loaded.")
+        sys.exit(1)
     if args["loglevel_info"]:
         set_logging_info()
     CONFIG = get_config(args["config_file"])
-    vcf, genes = get_vcf_genes(args, CONFIG)
-    subjects = [Subject(prefix = sub_id, genes = genes, config = CONFIG) for sub_id in vcf.samples]
+    reset_phased_fallbacks()
+    reset_fast_paths()
+    memory_report = memory.enable() if args["memory_report"] else None
+    vcf, genes = get_vcf_genes(args, CONFIG, load_variants = not (args["pipeline"] or args["chunked"]))
     out_dir = args["output_directory"]
-    prefix = args["vcf_file"].split("/")[-1].replace(".vcf.gz", "").replace(".bcf", "")
-    write_variant_file(out_dir, subjects, prefix, genes)
-    write_flat_file(out_dir, subjects, prefix)
+    prefix = os.path.basename(os.path.normpath(args["vcf_file"])).replace(".vcf.gz", "").replace(".bcf", "").replace(".vcf", "") if args["vcf_file"] != "-" else "stdin"
+    columnar = ColumnarWriter(out_dir, prefix) if args["parquet"] else None
+    summary = CohortSummary(read_groups(args["groups"]) if args["groups"] else None) if args["summary"] or args["groups"] else None
+    flat_file = FlatFileWriter(out_dir, prefix)
+    cache = CallCache(args["cache_dir"], args["cache_size"]) if args["cache_dir"] else None
+    trace = TraceLog(os.path.join(out_dir, f"{prefix}.trace.jsonl")) if args["trace"] else None
+    gene_processes = GeneProcesses(genes, CONFIG, args["gene_workers"]) if args["gene_processes"] else None
+    previous = IncrementalCalls(get_genes(args["previous_tables"], None, args, CONFIG), genes, read_flat_file(args["previous_calls"])) if args["previous_tables"] else None
+    # Subjects are not kept, each writer takes what it needs as they are called
+    variant_file = VariantFileWriter(out_dir, prefix, genes, compress = args["bgzip"], threads = args["bgzip_threads"])
+    def add_subject(subject: Subject) -> None:
+        variant_file.write(subject)
+        flat_file.write(subject)
+        if columnar:
+            columnar.write(subject)
+        if summary:
+            summary.add(subject)
+    if args["pipeline"]:
+        Pipeline(vcf, genes, config = CONFIG, chunk_size = args["chunk_size"], workers = args["workers"], cache = cache, previous = previous, gene_workers = args["gene_workers"], trace = trace).run(add_subject)
+    elif args["chunked"]:
+        call_chunks(vcf, genes, add_subject, config = CONFIG, chunk_size = args["chunk_size"], cache = cache, previous = previous, gene_workers = args["gene_workers"], trace = trace)
+    else:
+        for sub_id in vcf.samples:
+            add_subject(Subject(prefix = sub_id, genes = genes, config = CONFIG, cache = cache, previous = previous, gene_workers = args["gene_workers"], trace = trace, gene_processes = gene_processes))
+    if gene_processes:
+        gene_processes.close()
+    flat_file.close()
+    if cache:
+        cache.close()
+    if trace:
+        trace.close()
+    if args["phased"]:
+        fallbacks = phased_fallback_stats()
+        LOGGING.info(f"Phased problems solved unphased: {fallbacks['triggered']} after an infeasible phased solve, {fallbacks['avoided']} predicted infeasible and not solved phased")
+    fast_paths = fast_path_stats()
+    fast = fast_paths["reference"] + fast_paths["single"]
+    if fast + fast_paths["solved"] > 0:
+        LOGGING.info(f"Called without the solver: {fast} of {fast + fast_paths['solved']} ({fast_paths['reference']} reference only, {fast_paths['single']} with a single candidate haplotype)")
+    if previous:
+        LOGGING.info(f"Carried forward {previous.stats()['carried']} calls, called {previous.stats()['called']}")
+    if columnar:
+        columnar.close()
+    if summary:
+        summary.write(out_dir, prefix)
+    variant_file.close()
+    if memory_report:
+        memory.disable()
+        memory_report.write(out_dir, prefix)
 
 if __name__ == "__main__": 
     main()
@@ -0,0 +1,219 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from . import LOGGING
+
+CACHE_FILE = "himoon_cache.sqlite"
+
+# Seconds between writes of the access times of cache hits (also written on put and close)
+FLUSH_INTERVAL = 10.0
+
+
+def config_items(config) -> tuple:
+    """
+    Contents of a config (section and (option, value) pairs), used to look up its hash
+
+    Args:
+        config (ConfigData): config.ConfigData object
+
+    Returns:
+        tuple: (section, ((option, value), ...)) for each section
+    """
+    return tuple((section, tuple(config.config[section].items())) for section in config.config.sections())
+
+
+def config_hash(config, gene) -> str:
+    """
+    Hash of everything other than the genotypes that changes a call:
+    config values, phasing, solver, the processed translation table, and the records its rows resolve to
+
+    Args:
+        config (ConfigData): config.ConfigData object
+        gene (AbstractGene): gene
+
+    Returns:
+        str: hex digest
+    """
+    settings = {section: dict(items) for section, items in config_items(config)}
+    settings["phased"] = bool(gene.phased)
+    settings["solver"] = gene.solver
+    settings["table"] = gene.table_digest
+    settings["resolution"] = gene.get_resolution_digest()
+    return hashlib.sha1(json.dumps(settings, sort_keys = True, default = str).encode()).hexdigest()
+
+
+def genotype_pattern(haplotype) -> str:
+    """
+    Canonical genotype pattern of a sample, only records used by the translation table are included
+    Phase sets are renumbered in order of appearance, so samples with the same genotypes share a pattern.
+
+    Args:
+        haplotype (Haplotype): haplotype object (before matching)
+
+    Returns:
+        str: hex digest
+    """
+    phase_sets = {}
+    pattern = []
+    for code in sorted(set(int(r) for r in haplotype.row_records if r >= 0)):
+        genotype = haplotype.genotypes[code]
+        if genotype is None:
+            continue
+        phase_set = genotype["phase_set"]
+        if genotype["phased"] and phase_set is not None:
+            phase_set = phase_sets.setdefault(phase_set, len(phase_sets))
+        else:
+            phase_set = None
+        alleles = list(genotype["alleles"]) if genotype["alleles"] is not None else None
+        pattern.append([haplotype.record_keys[code], genotype["ref"], alleles, bool(genotype["phased"]), phase_set])
+    return hashlib.sha1(json.dumps(pattern).encode()).hexdigest()
+
+
+class CallCache:
+
+    def __init__(self, cache_dir: str, max_entries: int = 1000000) -> None:
+        """
+        Persistent cache of solved calls (SQLite) shared across runs
+        Keyed on gene, translation table version, config hash (including how the table rows resolve to VCF records), 
+        and the canonical genotype pattern of the sample. The least recently used entries are removed above max_entries.
+        Access times of hits are kept in memory and written in one transaction on put, every FLUSH_INTERVAL seconds, and on close, 
+        so a hit is only a lookup.
+
+        Args:
+            cache_dir (str): cache directory (created if needed)
+            max_entries (int, optional): maximum number of cached calls. Defaults to 1000000.
+        """
+        os.makedirs(cache_dir, exist_ok = True)
+        self.path = os.path.join(cache_dir, CACHE_FILE)
+        self.max_entries = max(1, int(max_entries))
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread = False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS calls (
+            gene TEXT, version TEXT, config TEXT, pattern TEXT,
+            result TEXT, last_used REAL, hits INTEGER DEFAULT 0,
+            PRIMARY KEY (gene, version, config, pattern))""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS calls_last_used ON calls (last_used)")
+        self.connection.commit()
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.config_hashes = {}
+        self.accessed = {} # Key -> last use, hits not yet written
+        self.flushed = time.time()
+
+    def _key(self, gene, haplotype, config) -> tuple:
+        settings = (gene.table_digest, gene.get_resolution_digest(), gene.phased, gene.solver, config_items(config))
+        try:
+            gene_config = self.config_hashes[settings]
+        except KeyError:
+            gene_config = self.config_hashes.setdefault(settings, config_hash(config, gene))
+        return str(gene), str(gene.version), gene_config, genotype_pattern(haplotype)
+
+    def _flush(self) -> None:
+        """
+        Write the access times of hits since the last flush (the caller holds the lock and commits)
+        """
+        if self.accessed:
+            self.connection.executemany(
+                "UPDATE calls SET last_used = ?, hits = hits + ? WHERE gene = ? AND version = ? AND config = ? AND pattern = ?",
+                [(last_used, hits) + key for key, (last_used, hits) in self.accessed.items()])
+            self.accessed = {}
+        self.flushed = time.time()
+
+    def get(self, gene, haplotype, config) -> tuple:
+        """
+        Cached call for a sample
+
+        Args:
+            gene (AbstractGene): gene
+            haplotype (Haplotype): haplotype object for the sample (before matching)
+            config (ConfigData): config.ConfigData object
+
+        Returns:
+            tuple: key and cached result (None if not cached)
+        """
+        key = self._key(gene, haplotype, config)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT result FROM calls WHERE gene = ? AND version = ? AND config = ? AND pattern = ?", key).fetchone()
+            if row is None:
+                self.misses += 1
+                return key, None
+            self.hits += 1
+            now = time.time()
+            self.accessed[key] = (now, self.accessed.get(key, (now, 0))[1] + 1)
+            if now - self.flushed > FLUSH_INTERVAL:
+                self._flush()
+                self.connection.commit()
+        return key, json.loads(row[0])
+
+    def put(self, key: tuple, result: dict) -> None:
+        """
+        Add a call to the cache
+
+        Args:
+            key (tuple): key from get
+            result (dict): HAPS, REFS, and CANDIDATES of the call
+        """
+        with self.lock:
+            self._flush() # Evictions use the latest access times
+            # Another worker may have missed on the same key and added it first, then the entry is replaced
+            exists = self.connection.execute(
+                "SELECT 1 FROM calls WHERE gene = ? AND version = ? AND config = ? AND pattern = ?", key).fetchone() is not None
+            self.connection.execute(
+                "INSERT OR REPLACE INTO calls (gene, version, config, pattern, result, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                key + (json.dumps(result), time.time()))
+            if not exists:
+                self.entries += 1
+            if self.entries > self.max_entries:
+                removed = self.entries - self.max_entries
+                self.connection.execute(
+                    "DELETE FROM calls WHERE rowid IN (SELECT rowid FROM calls ORDER BY last_used LIMIT ?)", (removed,))
+                self.entries -= removed
+                self.evictions += removed
+            self.connection.commit()
+
+    def stats(self) -> dict:
+        """
+        Cache statistics for this run
+
+        Returns:
+            dict: hits, misses, hit_rate, entries, evictions
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "entries": self.entries,
+            "evictions": self.evictions}
+
+    def close(self) -> None:
+        """
+        Write the access times of hits, log statistics, and close the database
+        """
+        stats = self.stats()
+        LOGGING.info(f"Call cache: {stats['hits']} hits, {stats['misses']} misses ({round(stats['hit_rate'] * 100, 1)}%), {stats['entries']} entries, {stats['evictions']} evicted")
+        with self.lock:
+            self._flush()
+            self.connection.commit()
+            self.connection.close()
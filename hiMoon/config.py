@@ -141,7 +141,11 @@ class ConfigData:
             LOGGING.info("Using a 1kb 5' and 3' offset.")
             self.VARIANT_QUERY_PARAMETERS = {
                 "5p_offset": 1000,
-                "3p_offset": 1000
+                "3p_offset": 1000,
+                "fetch_threads": 4,
+                "decompression_threads": 1,
+                "reader": "pysam",
+                "nearby_records": 0
             }
             self.config["VARIANT QUERY PARAMETERS"] = self.VARIANT_QUERY_PARAMETERS
     
@@ -161,7 +165,9 @@ class ConfigData:
         except KeyError:
             self.LP_PARAMS = {
                 "optimal_decay": 0,
-                "max_haps": 2
+                "max_haps": 2,
+                "solve_time_limit": 0,
+                "sample_time_limit": 0
             }
             self.config["LINEAR PROGRAM PARAMETERS"] = self.LP_PARAMS
     
@@ -12,12 +12,34 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-import pandas as pd
+import copy
+import hashlib
+import json
 import sys
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from pulp import LpElement
 
 from . import LOGGING
+from . import memory
+from .index import RecordIndex
 from .vcf import VarFile
 
+def lp_name(name: str) -> str:
+    """
+    Name as written in LP output (characters that are not allowed in LP variable names replaced with _)
+    Haplotype and variant names are reported in this form.
+
+    Args:
+        name (str): haplotype or variant name
+
+    Returns:
+        str: name
+    """
+    return str(name).translate(LpElement.trans)
+
 class AbstractGene:
     """
     Abstract gene class, conains top level information that is available to muliple
@@ -39,29 +61,63 @@ class AbstractGene:
         self.solver = solver
         self.gene = None
         self.accession = None
-        # test if translation table is a path or a dataframe
-        if isinstance(translation_table, str):
-            self.read_translation_table(translation_table)
-        else:
-            self.version = ""
-            self.translation_table = translation_table
-        try:
-            self.reference = self.translation_table[self.translation_table["rsID"] == "REFERENCE"]["Haplotype Name"][0]
-        except (KeyError, IndexError):
-            self.reference = "REF"
-        self.translation_table = self.translation_table[self.translation_table["ReferenceSequence"] != "."]
-        self.accession = self.translation_table.iloc[-1, 3]
-        self.chromosome = self.config.CHROMOSOME_ACCESSIONS[self.accession]
-        self.translation_table["ID"] = self.translation_table.apply(lambda x: f"c{self.chromosome}_{x['Variant Start']}_{self.get_type(x['Type'])}", axis = 1)
-        self.translation_table["EXCLUDE"] = 0
-        self.gene = self.translation_table.iloc[-1, 1]
+        self.row_records = None
+        self.variant_index = None
+        # CNV modifier rows (e.g. *2_x2) and the sub-alleles they are combined with, see _merge_tables
+        self.cnv_modifiers = None
+        self.cnv_combinations = []
+        self.cnv_base_rows = None
+        with memory.stage("translation_table") as mem_stage:
+            # test if translation table is a path or a dataframe
+            if isinstance(translation_table, str):
+                self.read_translation_table(translation_table)
+            else:
+                self.version = ""
+                self.translation_table = translation_table
+            try:
+                self.reference = self.translation_table[self.translation_table["rsID"] == "REFERENCE"]["Haplotype Name"][0]
+            except (KeyError, IndexError):
+                self.reference = "REF"
+            if self.cnv_modifiers is None:
+                self.cnv_modifiers = self.translation_table.iloc[0:0]
+            self.translation_table = self.translation_table[self.translation_table["ReferenceSequence"] != "."]
+            self.cnv_modifiers = self.cnv_modifiers[self.cnv_modifiers["ReferenceSequence"] != "."]
+            self._set_cnv_combinations()
+            self.accession = self.translation_table.iloc[-1, 3]
+            self.chromosome = self.config.CHROMOSOME_ACCESSIONS[self.accession]
+            self.gene = self.translation_table.iloc[-1, 1]
+            # CNV modifier rows are kept at the end of the table, they are matched like any row but are not haplotypes
+            self.modifier_start = len(self.translation_table)
+            table = pd.concat([self.translation_table, self.cnv_modifiers], ignore_index = True)
+            self.cnv_modifiers = None
+            table["ID"] = table.apply(lambda x: f"c{self.chromosome}_{x['Variant Start']}_{self.get_type(x['Type'])}", axis = 1)
+            table["MATCH_ID"] = table.apply(self._get_match_id, axis = 1)
+            table["VAR_ID"] = table.apply(
+                    lambda x: f'{x["ID"]}_{str(x.iloc[6]).strip("<>")}_{str(x.iloc[7]).strip("<>")}',
+                    axis = 1
+                    )
+            # Integer codes for VAR_ID (used for matching and in the LP), decoded to names only for output
+            var_codes, var_names = pd.factorize(table["VAR_ID"])
+            table["VAR_CODE"] = var_codes
+            table["EXCLUDE"] = 0
+            self.translation_table = table
+            self.var_labels = [lp_name(var) for var in var_names]
+            self.hap_labels = {hap: lp_name(hap) for hap in list(table.iloc[:self.modifier_start,0].unique()) + self.cnv_names}
+            # Integer haplotype code of each row (bit in the haplotype bitsets of get_variant_index)
+            self.hap_codes, self.hap_names = pd.factorize(self.translation_table.iloc[:,0])
+            mem_stage["gene"] = self.gene
+        # Digest of the processed table and CNV combinations (e.g. for cache keys), shared by gene views
+        table_hash = pd.util.hash_pandas_object(self.translation_table.astype(str), index = False).to_numpy()
+        self.table_digest = hashlib.sha1(table_hash.tobytes() + self.cnv_rows.tobytes() + self.cnv_codes.tobytes() + "\t".join(self.cnv_names).encode()).hexdigest()
         self.max = self.translation_table.iloc[:,5].dropna().max() + int(self.config.VARIANT_QUERY_PARAMETERS["5p_offset"])
         self.min = self.translation_table.iloc[:,4].dropna().min() - int(self.config.VARIANT_QUERY_PARAMETERS["3p_offset"])
-        if vcf:
-            self.variants = vcf.get_range(self.chromosome, self.min, self.max)
+        if vcf and getattr(vcf, "stream", False):
+            self.variants = {} # Filled for all genes at once by VarFile.fill_genes
+        elif vcf:
+            with memory.stage("get_range", self.gene, len(vcf.samples)):
+                self.variants = vcf.get_range(self.chromosome, self.min, self.max)
         else:
             self.variants = variants
-        print(self.variants)
 
     def __str__(self):
         return self.gene
@@ -69,76 +125,219 @@ class AbstractGene:
     def __repr__(self):
         return self.gene
     
-    def get_sample_vars(self, sample: str) -> dict:
+    def with_variants(self, variants: dict) -> "AbstractGene":
+        """
+        Shallow copy of the gene that uses a different set of variants (e.g. for a chunk of samples)
+        The translation table and other gene level data are shared, not copied. 
+
+        Args:
+            variants (dict): variants in the same format as VarFile.get_range
+
+        Returns:
+            AbstractGene: gene view with the given variants
+        """
+        gene_view = copy.copy(self)
+        gene_view.variants = variants
+        gene_view.row_records = None
+        gene_view.variant_index = None
+        return gene_view
+
+    def resolve_rows(self) -> tuple:
+        """
+        Resolve every translation table row to a VCF record and the VCF alleles that describe it
+        Done once per gene (and set of variants) with a positional index over the records.
+
+        Returns:
+            tuple: record code of each row (index into the record IDs, index.MISSING_RECORD if not found), 
+                list of frozensets of VCF alleles (one per row), list of record IDs
+        """
+        if self.row_records is None or self.row_records[0] is not self.variants:
+            nearby = bool(int(self.config.VARIANT_QUERY_PARAMETERS.get("nearby_records", 0)))
+            index = RecordIndex(self.variants, self.config.IUPAC_CODES, nearby)
+            codes, alleles = self._resolve(index, self.translation_table)
+            resolution = [[index.keys[code] if code >= 0 else None, sorted(row_alleles)] for code, row_alleles in zip(codes, alleles)]
+            resolution_digest = hashlib.sha1(json.dumps(resolution).encode()).hexdigest()
+            self.row_records = (self.variants, codes, alleles, index.keys, index, resolution_digest)
+        return self.row_records[1:4]
+
+    def get_resolution_digest(self) -> str:
+        """
+        Digest of the record ID and VCF alleles every row resolves to (see resolve_rows)
+        Rows resolve from the loaded records (and the nearby_records setting), so cached calls are keyed on it. 
+
+        Returns:
+            str: hex digest
+        """
+        self.resolve_rows()
+        return self.row_records[5]
+
+    def get_variant_index(self) -> tuple:
+        """
+        Inverted index from each resolved variant (VCF record and alleles, see resolve_rows) to the haplotypes that require it
+        Rows that resolve to the same record and alleles match a sample the same way, so they are matched once
+        and a variant that does not match knocks out all of its haplotypes at once. 
+        Built once per gene (and set of variants). 
+
+        Returns:
+            tuple: variant of each row, record code of each variant, frozenset of VCF alleles of each variant,
+                bitset (int, bit = haplotype code in self.hap_codes) of the haplotypes of each variant
+        """
+        records, alleles, _ = self.resolve_rows()
+        if self.variant_index is None or self.variant_index[0] is not self.variants:
+            variants = {}
+            row_variants = np.empty(len(records), dtype = int)
+            variant_haps = []
+            for i, (record, row_alleles, hap_code) in enumerate(zip(records, alleles, self.hap_codes)):
+                variant = variants.setdefault((int(record), row_alleles), len(variants))
+                if variant == len(variant_haps):
+                    variant_haps.append(0)
+                variant_haps[variant] |= 1 << int(hap_code)
+                row_variants[i] = variant
+            self.variant_index = (self.variants, row_variants, np.array([v[0] for v in variants], dtype = int), [v[1] for v in variants], variant_haps)
+        return self.variant_index[1:]
+
+    def resolve_table(self, table: pd.DataFrame) -> tuple:
         """
-        The gene contains variants for all samples in the VCF
-        This function parses variants for a single sample. 
+        Resolve the rows of another processed translation table (e.g. an earlier version of this gene's table)
+        to this gene's VCF records, with the same record codes as resolve_rows
+
+        Args:
+            table (pd.DataFrame): processed translation table (AbstractGene.translation_table)
+
+        Returns:
+            tuple: record code of each row, list of frozensets of VCF alleles (one per row)
+        """
+        self.resolve_rows()
+        return self._resolve(self.row_records[4], table)
+
+    def _set_cnv_combinations(self) -> None:
+        """
+        Rows of the CNV haplotypes (e.g. *2.001_x2), in the order they had when the combinations were copied into the table
+        For each modifier, its CNV row once per row of the base haplotype (named for that row's sub-allele),
+        then the rows of the base haplotype's sub-alleles. 
+        Rows are positions in the table, with the modifier rows at the end. 
+        """
+        positions = {label: i for i, label in enumerate(self.translation_table.index)}
+        modifier_positions = {label: len(positions) + i for i, label in enumerate(self.cnv_modifiers.index)}
+        rows = []
+        names = []
+        for modifier, base_rows, combined in self.cnv_combinations:
+            if modifier in modifier_positions:
+                rows += [modifier_positions[modifier]] * len(combined)
+                names += combined
+            kept = [(positions[label], name) for label, name in zip(base_rows, combined) if label in positions]
+            rows += [row for row, _ in kept]
+            names += [name for _, name in kept]
+        self.cnv_rows = np.array(rows, dtype = int)
+        codes, cnv_names = pd.factorize(pd.Series(names, dtype = object))
+        self.cnv_codes = codes.astype(int)
+        self.cnv_names = list(cnv_names)
+        # For each modifier: its row (None if it was dropped), the CNV haplotype for each sub-allele of the base haplotype,
+        # the CNV haplotypes whose base rows are not in the table (only the modifier row, e.g. *2.*2_x2 from the REFERENCE row of *2),
+        # and the weight of each CNV haplotype (its modifier row is counted once per base row, as in the rows above). 
+        # Haplotype.lp_hap solves a CNV haplotype as its sub-allele plus a copy of the modifier. 
+        self.cnv_haps = []
+        for modifier, base_rows, combined in self.cnv_combinations:
+            subs = {}
+            for label, name in zip(base_rows, combined):
+                if label in positions:
+                    subs.setdefault(self.translation_table.iloc[positions[label], 0], name)
+            unplaced = list(dict.fromkeys(name for label, name in zip(base_rows, combined) if label not in positions and name not in subs.values()))
+            self.cnv_haps.append((modifier_positions.get(modifier), subs, unplaced, Counter(combined)))
+        # CNV haplotypes were added after the translation table rows, before the CNV haplotypes without a modifier (e.g. *5)
+        self.cnv_insert = int(np.sum(self.translation_table.index < self.cnv_base_rows)) if self.cnv_base_rows is not None else len(positions)
+
+    def get_full_table(self) -> pd.DataFrame:
+        """
+        Translation table with the rows of every CNV haplotype (e.g. *2.001_x2) written out
+        Only needed to compare tables (e.g. incremental.diff_tables), matching does not copy these rows.
+
+        Returns:
+            pd.DataFrame: processed translation table
+        """
+        table = self.translation_table
+        if len(self.cnv_rows) == 0:
+            return table.iloc[:self.modifier_start]
+        cnv_table = table.iloc[self.cnv_rows].copy()
+        cnv_table.iloc[:,0] = [self.cnv_names[code] for code in self.cnv_codes]
+        return pd.concat([table.iloc[:self.cnv_insert], cnv_table, table.iloc[self.cnv_insert:self.modifier_start]], ignore_index = True)
+
+    def _resolve(self, index: RecordIndex, table: pd.DataFrame) -> tuple:
+        resolved = [index.resolve(match_id, var_type, None if pd.isna(start) else int(start), None if pd.isna(stop) else int(stop), ref, alt) 
+            for match_id, var_type, start, stop, ref, alt in zip(table["MATCH_ID"], table["Type"], table["Variant Start"], table["Variant Stop"], table["Reference Allele"], table["Variant Allele"])]
+        return np.array([r[0] for r in resolved], dtype = int), [r[1] for r in resolved]
+
+    def get_sample_records(self, sample: str) -> list:
+        """
+        Genotypes of a single sample by record code (see resolve_rows)
 
         Args:
             sample (str): sample ID
 
         Returns:
-            dict: single sample variants from VCF
+            list: genotype dict for each record (None if the sample is not in the record)
         """
-        sample_vars = {}
-        for var_id, sub_vars in self.variants.items():
-            try:
-                sample_vars[var_id] = sub_vars[sample]
-            except KeyError:
-                pass
-        return sample_vars
-    
+        record_keys = self.resolve_rows()[2]
+        return [self.variants[key].get(sample) for key in record_keys]
+
     def get_translation_table_copy(self) -> pd.DataFrame:
         """
         Get a deep copy of a translation table that can be modified
         for a single subject
+        Haplotype objects share self.translation_table read-only, this is only
+        needed if a caller wants to modify the table. 
 
         Returns:
             pd.DataFrame: deep copy of the associated translation table
         """
-        return(self.translation_table.copy(deep = True))
+        return(self.get_full_table().copy(deep = True))
+
+    def _get_match_id(self, row: pd.core.series.Series) -> str:
+        """
+        Get the ID used to look up a translation table row in the VCF variants
+        Indels are anchored one position upstream in VCF
+
+        Args:
+            row (pd.core.series.Series): single row from translation table
+
+        Returns:
+            str: variant ID as produced by VarFile.get_range
+        """
+        if row["Type"] in ["insertion", "deletion"]:
+            chrom, pos, _ = row["ID"].split("_")
+            return f'{chrom}_{int(pos) - 1}_SID'
+        return row["ID"]
     
-    def _merge_tables(self, translation_table, cnv_table):
-        new_rows = []
-        cnv_table["BASE"] = cnv_table.apply(lambda x: x["Haplotype Name"].split("_")[0], axis = 1)
-        cnv_table["SUFFIX"] = cnv_table.apply(lambda x: x["Haplotype Name"].split("_")[-1], axis = 1)
-        translation_table["BASE"] = translation_table.apply(lambda x: x["Haplotype Name"].split(".")[0], axis = 1)
-        translation_table["SUFFIX"] = translation_table.apply(lambda x: x["Haplotype Name"].split(".")[-1], axis = 1)
-        for index, row in cnv_table.iterrows():
-            trans_base = translation_table[translation_table["BASE"] == row["BASE"]]
-            trans_suffixes = trans_base["SUFFIX"]
-            for suf in trans_suffixes:
-                new_rows.append(
-                    {
-                        "Haplotype Name": f'{row["BASE"]}.{suf}_{row["SUFFIX"]}',
-                        "Gene": row["Gene"],
-                        "rsID": row["rsID"],
-                        "ReferenceSequence": row["ReferenceSequence"],
-                        "Variant Start": row["Variant Start"],
-                        "Variant Stop": row["Variant Stop"],
-                        "Reference Allele": row["Reference Allele"],
-                        "Variant Allele": row["Variant Allele"],
-                        "Type": row["Type"]
-                    }
-                )
-            for i, r in trans_base.iterrows():
-                new_rows.append(
-                    {
-                        "Haplotype Name": f'{row["BASE"]}.{r["SUFFIX"]}_{row["SUFFIX"]}',
-                        "Gene": r["Gene"],
-                        "rsID": r["rsID"],
-                        "ReferenceSequence": r["ReferenceSequence"],
-                        "Variant Start": r["Variant Start"],
-                        "Variant Stop": r["Variant Stop"],
-                        "Reference Allele": r["Reference Allele"],
-                        "Variant Allele": r["Variant Allele"],
-                        "Type": r["Type"]
-                    }
-                )
-        new_table = translation_table.drop(["BASE", "SUFFIX"], axis = 1)
-        added_rows = pd.DataFrame(new_rows)
-        cnv_table.drop(cnv_table[cnv_table["Haplotype Name"].str.contains("_")].index, axis = 0, inplace = True)
-        return pd.concat([new_table, added_rows, cnv_table], ignore_index=True)
+    def _merge_tables(self, translation_table, cnv_table) -> pd.DataFrame:
+        """
+        Add the CNV definitions to the translation table
+        CNV haplotypes without a modifier (e.g. *5.001) are added as rows. A modifier (e.g. *2_x2) is combined 
+        with every sub-allele of its base haplotype (e.g. *2.001_x2), the combinations are kept as 
+        (modifier row, base rows, combined names) and matched from the rows of the modifier and the sub-allele,
+        so the table grows with the number of CNV definitions, not CNV definitions x sub-alleles. 
+
+        Args:
+            translation_table (pd.DataFrame): translation table
+            cnv_table (pd.DataFrame): CNV definitions
+
+        Returns:
+            pd.DataFrame: translation table with the CNV haplotypes without a modifier
+        """
+        cnv_base = cnv_table["Haplotype Name"].str.split("_").str[0]
+        cnv_suffix = cnv_table["Haplotype Name"].str.split("_").str[-1]
+        trans_base = translation_table["Haplotype Name"].str.split(".").str[0]
+        trans_suffix = translation_table["Haplotype Name"].str.split(".").str[-1]
+        modifiers = []
+        for label in cnv_table.index:
+            base_rows = translation_table.index[trans_base == cnv_base[label]]
+            if len(base_rows) == 0:
+                continue
+            modifiers.append(label)
+            self.cnv_combinations.append((len(modifiers) - 1, list(base_rows), [f'{cnv_base[label]}.{trans_suffix[r]}_{cnv_suffix[label]}' for r in base_rows]))
+        self.cnv_base_rows = len(translation_table)
+        self.cnv_modifiers = cnv_table.loc[modifiers].reset_index(drop = True)
+        cnv_table = cnv_table.drop(cnv_table[cnv_table["Haplotype Name"].str.contains("_")].index, axis = 0)
+        return pd.concat([translation_table, cnv_table], ignore_index=True)
 
     def get_type(self, vtype: str) -> str:
         """
@@ -196,4 +395,6 @@ class AbstractGene:
             cnv_table = None
         if cnv_table is not None:
             self.translation_table = self._merge_tables(self.translation_table, cnv_table)
+            self.cnv_modifiers.iloc[:,0] = self.cnv_modifiers.iloc[:,0].str.replace("*", "(star)", regex = False)
+            self.cnv_combinations = [(modifier, base_rows, [name.replace("*", "(star)") for name in names]) for modifier, base_rows, names in self.cnv_combinations]
         self.translation_table.iloc[:,0] = self.translation_table.apply(lambda x: x.iloc[0].replace("*", "(star)"), axis = 1)
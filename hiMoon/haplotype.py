@@ -13,14 +13,83 @@
 #    limitations under the License.
 
 import sys
+import threading
+from collections import Counter
+from itertools import combinations_with_replacement, product
+from time import perf_counter
 
 import pandas as pd
 import numpy as np
 
 from pulp import *
 from .gene import AbstractGene
+from .index import MISSING_RECORD, bits_to_mask
 from . import LOGGING
 
+# Phased problems solved with the unphased formulation:
+# triggered (the phased LP was infeasible and solved again) or avoided (predicted infeasible, not solved phased)
+PHASED_FALLBACKS = Counter()
+FALLBACK_LOCK = threading.Lock()
+
+def phased_fallback_stats() -> dict:
+    """
+    Phased fallback counts since the start of the run (see reset_phased_fallbacks)
+
+    Returns:
+        dict: triggered, avoided
+    """
+    with FALLBACK_LOCK:
+        return {"triggered": PHASED_FALLBACKS["triggered"], "avoided": PHASED_FALLBACKS["avoided"]}
+
+def reset_phased_fallbacks() -> None:
+    """
+    Start counting phased fallbacks for a new run (e.g. several runs in one process)
+    """
+    with FALLBACK_LOCK:
+        PHASED_FALLBACKS.clear()
+
+def _count_fallback(kind: str) -> None:
+    with FALLBACK_LOCK:
+        PHASED_FALLBACKS[kind] += 1
+
+# Calls made without the solver (see Haplotype._fast_path): reference (no candidate haplotype) or single (one candidate),
+# and calls that were solved
+FAST_PATHS = Counter()
+FAST_PATH_LOCK = threading.Lock()
+
+def fast_path_stats() -> dict:
+    """
+    Fast path counts since the start of the run (see reset_fast_paths)
+
+    Returns:
+        dict: reference, single, solved
+    """
+    with FAST_PATH_LOCK:
+        return {"reference": FAST_PATHS["reference"], "single": FAST_PATHS["single"], "solved": FAST_PATHS["solved"]}
+
+def reset_fast_paths() -> None:
+    """
+    Start counting fast paths for a new run (e.g. several runs in one process)
+    """
+    with FAST_PATH_LOCK:
+        FAST_PATHS.clear()
+
+def _count_fast_path(kind: str) -> None:
+    with FAST_PATH_LOCK:
+        FAST_PATHS[kind] += 1
+
+def count_call(fast_path: str, fallback: str) -> None:
+    """
+    Count the fast path and phased fallback of a call made in another process (see subject.GeneProcesses)
+
+    Args:
+        fast_path (str): reference, single, or None (solved)
+        fallback (str): triggered, avoided, or None
+    """
+    _count_fast_path(fast_path or "solved")
+    if fallback is not None:
+        _count_fallback(fallback)
+
 class NoVariantsException(Exception):
     """
     Exception to call if a sample is attempted that has zero variants defined. 
@@ -45,113 +114,144 @@ class Haplotype:
         self.solver = gene.solver
         self.matched = False
         self.sample_prefix = sample_prefix
-        self.genotypes = gene.get_sample_vars(sample_prefix)
-        if len(self.genotypes) == 0:
+        # Record and matching VCF alleles for every translation table row (resolved once per gene)
+        self.row_records, self.row_alleles, self.record_keys = gene.resolve_rows()
+        self.row_variants, self.variant_records, self.variant_alleles, self.variant_haps = gene.get_variant_index()
+        self.hap_codes = gene.hap_codes
+        self.hap_names = gene.hap_names
+        # CNV haplotypes (e.g. *2.001_x2) are matched from the modifier and sub-allele rows (see AbstractGene._merge_tables)
+        self.modifier_start = gene.modifier_start
+        self.cnv_haps = gene.cnv_haps
+        self.genotypes = gene.get_sample_records(sample_prefix) # By record code
+        if all(genotype is None for genotype in self.genotypes):
             raise NoVariantsException
-        self.translation_table = gene.get_translation_table_copy()
+        # Names for output
+        self.var_labels = gene.var_labels
+        self.hap_labels = gene.hap_labels
+        # Shared with the gene and never modified, table_matcher keeps only the matched rows
+        self.translation_table = gene.translation_table
         self.chromosome = gene.chromosome
         self.version = gene.version
         self.reference = gene.reference
+        # LP parameters of the current solve (optimize_hap can override them, e.g. for a parameter sweep)
+        self.lp_params = self.config.LP_PARAMS
+        # Time budgets in seconds (0 = no limit)
+        self.solve_time_limit = float(self.config.LP_PARAMS.get("solve_time_limit", 0))
+        self.sample_time_limit = float(self.config.LP_PARAMS.get("sample_time_limit", 0))
+        self.deadline = None
+        self.timed_out = False
+        self.max_solve_time = 0
+        self.reduction_stats = {"haplotypes": 0, "classes": 0}
+        # LP size (one per lp_hap call) and solves of the current optimize_hap, for tracing
+        self.problems = []
+        self.solves = []
+        self.fallback = None # triggered or avoided (see PHASED_FALLBACKS)
+        self.fast_path = None # reference or single (see _fast_path)
     
     def table_matcher(self) -> None:
         """
         Matches variants in the translation table with the subject's variants
+        The gene translation table is not modified, matched rows are kept in 
+        self.translation_table along with their MATCH, STRAND, and PHASE_SET
         """
         self.matched = True
-        matches = self.translation_table.apply(self._match, axis = 1)
-        self.translation_table["MATCH"] = [m[0] for m in matches]
-        self.translation_table["STRAND"] = [m[1] for m in matches]
-        self.translation_table["PHASE_SET"] = [m[2] for m in matches]
-        self.translation_table["VAR_ID"] = self.translation_table.apply(
-                lambda x: f'{x["ID"]}_{str(x.iloc[6]).strip("<>")}_{str(x.iloc[7]).strip("<>")}',
-                axis = 1
-                )
-        self.translation_table = self.translation_table.drop(self.translation_table.index[self.translation_table["MATCH"] == 99].tolist())
-        no_match = self.translation_table[self.translation_table["MATCH"] == 0].iloc[:,0] # Haplotypes where there is any variant not matching
-        drops = []
-        for i in no_match.unique():
-            if sum([i == k for k in no_match]) > 0:
-                drops.append(i)
-        self.translation_table = self.translation_table[~self.translation_table.iloc[:,0].isin(drops)] # Drop haplotypes that don't match 100%
-        self.variants = self.translation_table.loc[:,["VAR_ID", "MATCH", "STRAND", "Type", "Variant Start"]].drop_duplicates() # List of matched variants
+        table = self.translation_table
+        # Each resolved variant is matched once, variants that do not match knock out all of their haplotypes
+        matches = [self._match(record, alleles) for record, alleles in zip(self.variant_records, self.variant_alleles)]
+        variant_match = np.array([m[0] for m in matches])
+        knocked_out = 0
+        for variant in np.flatnonzero(variant_match == 0):
+            knocked_out |= self.variant_haps[variant]
+        match = variant_match[self.row_variants]
+        strand = np.array([m[1] for m in matches])[self.row_variants]
+        phase_set = np.array([m[2] for m in matches])[self.row_variants]
+        self.row_mask = (match != 99) & ~bits_to_mask(knocked_out, len(self.hap_names))[self.hap_codes] # Drop missing variants and haplotypes that don't match 100%
+        self.row_mask[self.modifier_start:] = False # CNV modifier rows are only matched as part of CNV haplotypes
+        rows = np.flatnonzero(self.row_mask)
+        self.match = match[rows]
+        self.strand = strand[rows]
+        self.phase_set = phase_set[rows]
+        self.translation_table = table.iloc[rows].assign(MATCH = self.match, STRAND = self.strand, PHASE_SET = self.phase_set)
         self.haplotypes = [hap for hap in self.translation_table.iloc[:,0].unique().tolist()] # List of possible haplotypes
+        self._match_cnv_haps(match, strand, phase_set, knocked_out, table["VAR_CODE"].to_numpy())
+        modifier_rows = [modifier["row"] for modifier in self.modifiers]
+        matched_rows = self.translation_table
+        if len(modifier_rows) > 0:
+            matched_rows = pd.concat([matched_rows, table.iloc[modifier_rows].assign(MATCH = match[modifier_rows], STRAND = strand[modifier_rows], PHASE_SET = phase_set[modifier_rows])])
+        self.variants = matched_rows.loc[:,["VAR_CODE", "MATCH", "STRAND", "Type", "Variant Start"]].drop_duplicates() # List of matched variants
 
-    def _mod_vcf_record(self, alt: str, ref: str) -> str:
+    def _match_cnv_haps(self, match: np.ndarray, strand: np.ndarray, phase_set: np.ndarray, knocked_out: int, var_codes: np.ndarray) -> None:
         """
-        Modifies record from VCF to standardized form
-        
-        Args:
-            alt (str): alt allele
-            ref (str): ref allele
-        
-        Returns:
-            str: reformatted alt allele
-        """
-        if alt is None:
-            return "-"
-        if "<" in alt:
-            return f"s{alt.strip('<>')}"
-        elif len(ref) > len(alt):
-            return "id-"
-        elif len(ref) < len(alt):
-            return f'id{alt[1:]}' # Remove first position
-        else:
-            return f's{alt}'
+        Find the candidate CNV haplotypes (e.g. *2.001_x2) from the matched modifier and sub-allele rows
+        A CNV haplotype is its sub-allele plus the modifier, its rows are not copied into the matched table. 
+        Each matched modifier is kept in self.modifiers with the CNV haplotypes of each candidate sub-allele (solved as 
+        the sub-allele plus a copy of the modifier, see lp_hap), the CNV haplotypes that only have the modifier row 
+        (the sub-allele's rows are all missing), and the weight of each CNV haplotype. 
+        Modifiers of the same base haplotype and variant are kept as one. 
+        If the modifier is missing, a CNV haplotype has the same rows as its sub-allele, it is kept in self.cnv_members
+        and reported wherever the sub-allele is. 
 
-    def _mod_tt_record(self, var_type: str, alt: str) -> list:
-        """
-        Modifies the translation table ref to a standardized form
-        
         Args:
-            var_type (str): insertion, deletion, or substitution
-            alt (str): allele from translation table
-        
-        Returns:
-            [list]: modified allele as list based on iupac
+            match (np.ndarray): MATCH of every row of the gene table
+            strand (np.ndarray): STRAND of every row of the gene table
+            phase_set (np.ndarray): PHASE_SET of every row of the gene table
+            knocked_out (int): bitset of the haplotype codes with a variant that does not match
+            var_codes (np.ndarray): VAR_CODE of every row of the gene table
         """
-        alt = alt.strip("<>")
-        if var_type == "insertion":
-            return [f'id{alt}']
-        elif var_type == "deletion":
-            return [f'id-']
-        else:
-            try:
-                return [f's{a}' for a in self.config.IUPAC_CODES[alt]]
-            except KeyError:
-                return [f's{alt}']
+        self.modifiers = []
+        self.cnv_members = {}
+        merged = {}
+        candidates = set(self.haplotypes)
+        hap_knocked_out = bits_to_mask(knocked_out, len(self.hap_names))
+        for row, subs, unplaced, weights in self.cnv_haps:
+            modifier_match = match[row] if row is not None else 99
+            if modifier_match == 0:
+                continue
+            riding = {sub: name for sub, name in subs.items() if sub in candidates}
+            if modifier_match == 99:
+                for sub, name in riding.items():
+                    self.cnv_members.setdefault(sub, []).append(name)
+                continue
+            bare = unplaced + [name for sub, name in subs.items() if sub not in candidates and not hap_knocked_out[self.hap_names.get_loc(sub)]]
+            if len(riding) == 0 and len(bare) == 0:
+                continue
+            # Modifiers of a base haplotype with the same variant (e.g. *2_x2 and *2_xN for <CN2>) are interchangeable
+            key = (var_codes[row], tuple(subs))
+            if key in merged:
+                modifier = merged[key]
+                for sub, name in riding.items():
+                    modifier["subs"][sub].append(name)
+                modifier["bare"] += bare
+                modifier["weights"].update(weights)
+            else:
+                merged[key] = {"row": row, "var": var_codes[row], "strand": strand[row], "phase_set": phase_set[row], 
+                    "subs": {sub: [name] for sub, name in riding.items()}, "bare": bare, "weights": dict(weights), "base": tuple(subs)}
+                self.modifiers.append(merged[key])
 
-    def _match(self, row: pd.core.series.Series) -> (int, int):
+    def _match(self, record: int, alleles: frozenset) -> (int, int):
         """
         Evaluate match in a single translation table row with a sample
 
         Args:
-            row (pd.core.series.Series): single row from translation table
-            genotypes ([type]): list of genotypes
+            record (int): code of the VCF record the row resolves to (index.MISSING_RECORD if not in the VCF)
+            alleles (frozenset): VCF alleles of the record that describe the row's variant allele
 
         Returns:
             int: 99 (missing), 0, 1, or 2 (corresponds to the number of matched alleles for a particular position)
         """
         strand = 0
         phase_set = -1
-        if row.iloc[8] in ["insertion", "deletion"]:
-            new_pos = int(row["ID"].split("_")[1]) - 1
-            ID = f'{row["ID"].split("_")[0]}_{new_pos}_SID'
-        else:
-            ID = row["ID"]
-        try:
-            genotype = self.genotypes[ID]
-        except KeyError: # Not in VCF
-            return int(self.config.MISSING_DATA_PARAMETERS["missing_variants"]), strand, phase_set
-        try:
-            vcf_geno = [self._mod_vcf_record(g, genotype["ref"]) for g in genotype["alleles"]]
-        except AttributeError:
-            return int(self.config.MISSING_DATA_PARAMETERS["missing_variants"]), strand, phase_set
-        if vcf_geno == ["-", "-"]:
-            return int(self.config.MISSING_DATA_PARAMETERS["missing_variants"]), strand, phase_set
-        tt_alt_geno = self._mod_tt_record(row.iloc[8], row.iloc[7])
-        alt_matches = sum([vcf_geno.count(a) for a in tt_alt_geno])
+        missing = int(self.config.MISSING_DATA_PARAMETERS["missing_variants"])
+        genotype = self.genotypes[record] if record != MISSING_RECORD else None
+        if genotype is None: # Not in VCF
+            return missing, strand, phase_set
+        sample_alleles = genotype["alleles"]
+        if sample_alleles is None or list(sample_alleles) == [None, None]:
+            return missing, strand, phase_set
+        allele_matches = [a in alleles for a in sample_alleles]
+        alt_matches = sum(allele_matches)
         if alt_matches == 1 and genotype["phased"]:
-            strand = 1 if max([vcf_geno.index(a) for a in tt_alt_geno]) == 1 else -1
+            strand = 1 if allele_matches.index(True) == 1 else -1
             phase_set = genotype["phase_set"]
         elif alt_matches == 2 and genotype["phased"]:
             strand = 3
@@ -167,21 +267,14 @@ class Haplotype:
             lp_problem (object): solved lp problem
 
         Returns:
-            tuple: called haplotypes and associated information
+            tuple: called haplotypes (class representatives), variants, number of haplotypes used, 
+                reference fills, and the CNV modifiers used ((modifier, copies), see lp_hap)
         """
         refs = 0
-        haps = []
-        variants = []
-        phase_sets = []
-        for v in lp_problem.variables():
-            if v.varValue:
-                if "PHASE_SET" in v.name:
-                    phase_sets.append(int(v.varValue))
-                elif v.varValue > 0:
-                    if v.name.split("_")[0] == f'c{self.chromosome}':
-                        variants.append(v.name)
-                    else:
-                        haps.append((v.name, v.varValue))
+        # LP variables are integer coded, decode to haplotype and variant names
+        haps = sorted((label, v.varValue) for v, label in self.lp_haplotypes if v.varValue and v.varValue > 0)
+        modifiers = tuple((j, int(round(v.varValue))) for v, j in self.lp_modifiers if v.varValue and v.varValue > 0)
+        variants = [label for v, label in self.lp_variants if v.varValue and v.varValue > 0]
         if len(haps) == 0:
             called = [self.reference, self.reference]
             refs = 2
@@ -192,34 +285,78 @@ class Haplotype:
             if len(called) == 1:
                 called.append(self.reference)
                 refs = 1
-        return called, variants, len(haps), refs, phase_sets
+        return called, variants, len(haps), refs, modifiers
     
-    def _solve(self, hap_prob: object) -> object:
+    def _time_left(self) -> float:
+        """
+        Seconds left in the sample budget (None if there is no budget)
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - perf_counter()
+
+    def _solve(self, hap_prob: object, phased: bool = False) -> object:
+        """
+        Solve the LP within the per-solve and remaining per-sample time budgets
+        If a budget stops the solver, the problem is flagged as timed out
+        (the solver's best incumbent, if any, is kept in hap_prob). 
+
+        Args:
+            hap_prob (object): pulp LpProblem
+            phased (bool, optional): the problem uses the phased constraints (recorded with the solve). Defaults to False.
+        """
+        limits = [l for l in [self.solve_time_limit, self._time_left()] if l is not None and l > 0]
+        time_limit = max(min(limits), 0.1) if len(limits) > 0 else None
+        start = perf_counter()
         if self.solver == "GLPK":
-            hap_prob.solve(GLPK(msg=0))
+            hap_prob.solve(GLPK(msg=0, timeLimit = time_limit))
         else:
-            hap_prob.solve(PULP_CBC_CMD(msg=0))
+            hap_prob.solve(PULP_CBC_CMD(msg=0, timeLimit = time_limit))
+        solve_time = perf_counter() - start
+        self.max_solve_time = max(self.max_solve_time, solve_time)
+        self.solves.append({"status": LpStatus[hap_prob.status], "seconds": round(solve_time, 4), "phased": bool(phased)})
+        if hap_prob.sol_status == LpSolutionIntegerFeasible or (time_limit is not None and hap_prob.status != 1 and solve_time >= time_limit):
+            LOGGING.warning(f"Solver time budget reached for {self.sample_prefix}, using the best solution found.")
+            self.timed_out = True
+
+    def _out_of_time(self) -> bool:
+        """
+        Check (and flag) if the per-sample time budget is used up
+        """
+        time_left = self._time_left()
+        if time_left is not None and time_left <= 0:
+            LOGGING.warning(f"Time budget reached for {self.sample_prefix}, remaining solutions will not be enumerated.")
+            self.timed_out = True
+            return True
+        return False
 
     
-    def lp_hap(self) -> tuple:
+    def lp_hap(self, phased: bool = None) -> tuple:
         """
         Build and run the LP problem
+        The matched table and candidate haplotypes are not modified, so the LP can be run again (e.g. with other parameters)
+
+        Args:
+            phased (bool, optional): use the phased constraints. Defaults to self.phased.
 
         Returns:
             tuple: list of possible haplotypes and list of associated variants
         """
+        phased = self.phased if phased is None else phased
         possible_haplotypes = []
         haplotype_variants = []
         num_vars = self.variants.shape[0]
         num_haps = len(self.haplotypes)
-        hap_vars = []
-        for hap in self.haplotypes:
-            trans = self.translation_table[self.translation_table.iloc[:,0] == hap]
-            hap_vars.append([1 if var in trans["VAR_ID"].unique() else 0 for var in self.variants["VAR_ID"]])
-            #hap_vars.append(tuple([1 if var in trans["VAR_ID"].unique() else 0 for var in self.variants["VAR_ID"]]))
+        # Sparse incidence, the (sorted) indices of the variants used by each haplotype
+        var_index = {var: i for i, var in enumerate(self.variants["VAR_CODE"])}
+        hap_var_sets = {}
+        for hap, var in zip(self.translation_table.iloc[:,0], self.translation_table["VAR_CODE"]):
+            hap_var_sets.setdefault(hap, set()).add(var_index[var])
+        hap_vars = [tuple(sorted(hap_var_sets[hap])) for hap in self.haplotypes]
+        candidates = self.haplotypes
         hap_prob = LpProblem("Haplotype Optimization", LpMaximize)
         # Define the haplotypes and variants variables
-        if self.phased:
+        if phased:
             # If phased, iterate over the raw matches and eliminate those that are out of phase
             new_hap_list = []
             new_hap_vars = []
@@ -229,96 +366,318 @@ class Haplotype:
                     new_hap_vars.append(hap_vars[i])
                 else:
                     continue
-            self.haplotypes = new_hap_list
+            hap_strands = self._get_hap_strands()
+            modifier_vars = [(var_index[modifier["var"]],) for modifier in self.modifiers 
+                if len(modifier["bare"]) > 0 or any(sub in modifier["subs"] and self._can_carry(hap_strands, sub, modifier) for sub in new_hap_list)]
+            if not self._covers_cnvs(new_hap_vars + modifier_vars):
+                # A CNV must be used as many times as it matched, which no remaining candidate can do
+                LOGGING.info(f"Phased problem for {self.sample_prefix} is infeasible (CNV without an in-phase haplotype), solving unphased.")
+                self.fallback = "avoided"
+                _count_fallback("avoided")
+                return self.lp_hap(phased = False)
+            candidates = new_hap_list
             hap_vars = new_hap_vars
-            num_haps = len(self.haplotypes)
+            num_haps = len(candidates)
             # get unique and drop -1 from self.translation_table["PHASE_SET"]
             self.phase_sets = self.translation_table["PHASE_SET"].unique()
             self.phase_sets = self.phase_sets[self.phase_sets != -1]
             num_phase_sets = len(self.phase_sets)
-            # For each phase-set, which haplotypes have variants that use it?
-            phase_set_haps = []
-            for i in range(num_phase_sets):
-                psv = []
-                for hap in self.haplotypes:
-                    trans = self.translation_table[self.translation_table.iloc[:,0] == hap]
-                    if self.phase_sets[i] in trans["PHASE_SET"].unique():
-                        psv.append(1)
-                    else:
-                        psv.append(0)
-                phase_set_haps.append(psv)
-        haplotypes = [LpVariable(hap, cat = "Integer", lowBound=0, upBound=2) for hap in self.haplotypes]
-        variants = [LpVariable(var, cat = "Binary") for var in self.variants["VAR_ID"]]
+        # Haplotypes that use the same variants (and phase sets) are interchangeable in the LP,
+        # only one variable per class is used and calls are expanded to every class member after solving
+        # Coefficients from one pass over the matched rows (grouped by haplotype), not a scan of the table per candidate
+        hap_column = self.translation_table.iloc[:,0]
+        matched_rows = (self.translation_table["MATCH"] > 0).groupby(hap_column, sort = False).sum()
+        hap_coefs = [int(matched_rows.get(hap, 0)) for hap in candidates]
+        if phased:
+            in_phase_set = self.translation_table["PHASE_SET"] != -1
+            phase_set_vars = self.translation_table[in_phase_set].groupby([hap_column[in_phase_set], "PHASE_SET"], sort = False)["VAR_CODE"].nunique().to_dict()
+            phase_set_coefs = [[phase_set_vars.get((hap, phase_set), 0) for phase_set in self.phase_sets] for hap in candidates]
+        else:
+            phase_set_coefs = [[] for _ in range(num_haps)]
+        # CNV haplotypes (e.g. *2.001_x2) are not candidates, they are a copy of a sub-allele used with a copy-number modifier 
+        # of its base haplotype (see _match_cnv_haps), so the LP has one variable per modifier, not per combination. 
+        # Modifiers a sub-allele can carry (if phased, not one on the other strand) keep it out of classes of sub-alleles that cannot.
+        # CNV haplotypes with only the modifier row are candidates. 
+        hap_modifiers = [tuple(j for j, modifier in enumerate(self.modifiers) if hap in modifier["subs"] and (not phased or self._can_carry(hap_strands, hap, modifier))) for hap in candidates]
+        bare = [(name, var_index[modifier["var"]], modifier["weights"][name]) for modifier in self.modifiers for name in modifier["bare"]]
+        candidates = candidates + [name for name, _, _ in bare]
+        hap_vars = hap_vars + [(var,) for _, var, _ in bare]
+        hap_coefs = hap_coefs + [weight for _, _, weight in bare]
+        phase_set_coefs = phase_set_coefs + [[0] * (num_phase_sets if phased else 0) for _ in bare]
+        hap_modifiers = hap_modifiers + [()] * len(bare)
+        num_haps = len(candidates)
+        hap_classes = self._get_hap_classes(hap_vars, hap_coefs, phase_set_coefs, hap_modifiers)
+        reps = [members[0] for members in hap_classes]
+        haplotypes = [LpVariable(f"h{i}", cat = "Integer", lowBound=0, upBound=2 * len(members)) for i, members in enumerate(hap_classes)]
+        self.lp_haplotypes = [(haplotypes[i], self.hap_labels[candidates[members[0]]]) for i, members in enumerate(hap_classes)]
+        # Class members, with the CNV haplotypes that have the same rows as a member (the modifier is missing)
+        self.class_members = {self.hap_labels[candidates[members[0]]]: [label for k in members for label in [self.hap_labels[candidates[k]]] + 
+            [self.hap_labels[name] for name in self.cnv_members.get(candidates[k], [])]] for members in hap_classes}
+        # CNV haplotypes of the class members for each modifier they can carry
+        self.class_cnv_haps = {self.hap_labels[candidates[members[0]]]: {j: [self.hap_labels[name] for k in members for name in self.modifiers[j]["subs"][candidates[k]]] 
+            for j in hap_modifiers[members[0]]} for members in hap_classes if len(hap_modifiers[members[0]]) > 0}
+        self.reduction_stats = {"haplotypes": num_haps, "classes": len(hap_classes)}
+        modifier_classes = [hap_modifiers[k] for k in reps]
+        hap_vars = [hap_vars[k] for k in reps]
+        hap_coefs = [hap_coefs[k] for k in reps]
+        phase_set_coefs = [phase_set_coefs[k] for k in reps]
+        num_haps = len(reps)
+        # Modifiers that no candidate can carry (e.g. on the other strand of every sub-allele) have no variable
+        modifiers = {j: LpVariable(f"m{j}", cat = "Integer", lowBound = 0, upBound = 2) for j in sorted(set().union(*modifier_classes))}
+        self.lp_modifiers = [(modifiers[j], j) for j in modifiers]
+        modifier_coefs = {j: self._modifier_coef(self.modifiers[j], phased) for j in modifiers}
+        variants = [LpVariable(f"v{var}", cat = "Binary") for var in self.variants["VAR_CODE"]]
+        self.lp_variants = [(variants[i], self.var_labels[var]) for i, var in enumerate(self.variants["VAR_CODE"])]
+        var_matches = self.variants["MATCH"].to_numpy()
+        var_types = self.variants["Type"].to_numpy()
+        # Haplotypes (classes) and modifiers that carry each variant, so each constraint only has its non-zero terms
+        var_haps = [[] for _ in range(num_vars)]
+        for k in range(num_haps):
+            for i in hap_vars[k]:
+                var_haps[i].append(k)
+        var_modifiers = [[] for _ in range(num_vars)]
+        for j in modifiers:
+            var_modifiers[var_index[self.modifiers[j]["var"]]].append(j)
+        # Link the modifiers to their base haplotype: each copy of a sub-allele carries at most one modifier,
+        # so a modifier (and all modifiers of a base haplotype together) cannot be used more often than the sub-alleles that can carry it
+        bases = {}
+        for j in modifiers:
+            bases.setdefault(self.modifiers[j]["base"], []).append(j)
+        for linked in [[j] for j in modifiers] + [base for base in bases.values() if len(base) > 1]:
+            hap_prob += (lpSum(modifiers[j] for j in linked) <= lpSum(haplotypes[k] for k in range(num_haps) if set(linked) & set(modifier_classes[k])))
         # Set constraint of two haplotypes selected
-        hap_prob += (lpSum(haplotypes[i] for i in range(num_haps)) <= int(self.config.LP_PARAMS["max_haps"])) # Cannot choose more than x haplotypes (may be increased to find novel sub-alleles or complex SV)
+        hap_prob += (lpSum(haplotypes[i] for i in range(num_haps)) <= int(self.lp_params["max_haps"])) # Cannot choose more than x haplotypes (may be increased to find novel sub-alleles or complex SV)
         # Limit alleles that can be chosen based on zygosity
         for i in range(num_vars): # Iterate over every variant
+            var_used = lpSum(haplotypes[k] for k in var_haps[i]) + lpSum(modifiers[j] for j in var_modifiers[i])
             # A variant allele can only be used once per haplotype, up to two alleles per variant
-            hap_prob += (variants[i] <= (lpSum(hap_vars[k][i] * haplotypes[k] for k in range(num_haps))))
+            hap_prob += (variants[i] <= var_used)
             # A given variant cannot be used more than "MATCH"
-            hap_prob += ((lpSum(hap_vars[k][i] * haplotypes[k] for k in range(num_haps))) <= self.variants.iloc[i,1] * variants[i])
+            hap_prob += (var_used <= int(var_matches[i]) * variants[i])
             # Any CNV variants defined, if matched with a haplotype, MUST be used
             # Otherwise, variants like CYP2D6*5 will be missed by the other methods
-            if self.variants.iloc[i,3] == "CNV":
-                hap_prob += ((lpSum(hap_vars[k][i] * haplotypes[k] for k in range(num_haps))) == self.variants.iloc[i,1])
+            if var_types[i] == "CNV":
+                hap_prob += (var_used == int(var_matches[i]))
         # Set to maximize the number of variant alleles used (broken by phased or not phased to add an additional maximize constraint)
-        if self.phased: 
-            for i in range(num_phase_sets):
-                # Single phase set cannot be used more than max_haps (probably a redundant constraint)
-                hap_prob += lpSum(phase_set_haps[i][k] * haplotypes[k] for k in range(num_haps)) <= int(self.config.LP_PARAMS["max_haps"])
-            # All variants in a phase set must be together on a single haplotype
+        if phased: 
+            # Single phase set cannot be used more than max_haps
+            # (this is also the constraint that all variants in a phase set must be together on a single haplotype)
             for i in range(num_phase_sets):
-                hap_prob += lpSum(
-                    self.translation_table[
-                            (self.translation_table.iloc[:,0] == self.haplotypes[j]) &
-                            (self.translation_table["PHASE_SET"] == self.phase_sets[i])
-                        ]["Haplotype Name"].unique().shape[0] * haplotypes[j] for j in range(num_haps)) <= int(self.config.LP_PARAMS["max_haps"])
+                hap_prob += lpSum(haplotypes[k] for k in range(num_haps) if phase_set_coefs[k][i] > 0) <= int(self.lp_params["max_haps"])
              # Maximize the number of variants - per - phase set
              ## Helps to ensure that it doesn't split phase sets across two haplotypes, which is surprisingly hard to stop
              ## Because this is easy to over-constrain
             hap_prob += lpSum(
-                sum(list(self.translation_table[
-                        (self.translation_table.iloc[:,0] == self.haplotypes[i]) &
-                        (self.translation_table["MATCH"] > 0)].shape[0] * haplotypes[i] for i in range(num_haps))) + 
-                sum(list(self.translation_table[
-                        (self.translation_table.iloc[:,0] == self.haplotypes[j]) &
-                        (self.translation_table["PHASE_SET"] == self.phase_sets[k])]["VAR_ID"].unique().shape[0]**2 * haplotypes[j] for j in range(num_haps) for k in range(num_phase_sets))))
+                (hap_coefs[k] + sum(c**2 for c in phase_set_coefs[k])) * haplotypes[k] for k in range(num_haps)) + lpSum(modifier_coefs[j] * modifiers[j] for j in modifiers)
         else:
-            hap_prob += lpSum(
-                sum(list(self.translation_table[
-                        (self.translation_table.iloc[:,0] == self.haplotypes[i]) &
-                        (self.translation_table["MATCH"] > 0)].shape[0] * haplotypes[i] for i in range(num_haps)))
-            )
-        self._solve(hap_prob)
+            hap_prob += lpSum(hap_coefs[k] * haplotypes[k] for k in range(num_haps)) + lpSum(modifier_coefs[j] * modifiers[j] for j in modifiers)
+        # Non-zeros of the haplotype (class) and modifier x variant incidence, and terms of all constraints (linear in the non-zeros)
+        nonzeros = sum(len(hap_var) for hap_var in hap_vars) + len(modifiers)
+        terms = sum(len(constraint) for constraint in hap_prob.constraints.values())
+        self.problems.append({"phased": bool(phased), "classes": num_haps, "modifiers": len(modifiers), "variables": len(hap_prob.variables()), 
+            "constraints": len(hap_prob.constraints), "phase_sets": num_phase_sets if phased else 0, "nonzeros": nonzeros, "terms": terms})
+        self._solve(hap_prob, phased)
         if hap_prob.status != 1:
-            if self.phased:
+            if phased:
                 LOGGING.warning(f"No feasible solution found, {self.sample_prefix} will be re-attempted with phasing off.")
                 return None, None
             else:
                 LOGGING.warning(f"No feasible solution found, {self.sample_prefix} will not be called")
                 return [], []
         else:
-            called, variants, hap_len, refs, phase_sets = self._haps_from_prob(hap_prob)
+            called, variants, _, refs, used_modifiers = self._haps_from_prob(hap_prob)
             if refs == 2:
                 possible_haplotypes.append((called, refs))
                 haplotype_variants.append(tuple(variants))
                 return possible_haplotypes, haplotype_variants
             max_opt = hap_prob.objective.value()
             opt = max_opt
-            while opt >= (max_opt - float(self.config.LP_PARAMS["optimal_decay"])) and refs < 2 and hap_prob.status >= 0:
-                possible_haplotypes.append(tuple([sorted(called), refs]))
-                haplotype_variants.append(tuple(sorted(variants)))
-                hap_prob += lpSum([h.value() * h for h in haplotypes]) <= hap_len - 1
-                self._solve(hap_prob)
+            while opt >= (max_opt - float(self.lp_params["optimal_decay"])) and refs < 2 and hap_prob.status >= 0:
+                for expanded in self._expand_call(called, refs, used_modifiers):
+                    possible_haplotypes.append(tuple([sorted(expanded), refs]))
+                    haplotype_variants.append(tuple(sorted(variants)))
+                if self._out_of_time():
+                    break
+                hap_prob += self._exclude_solution(haplotypes, list(modifiers.values()))
+                self._solve(hap_prob, phased)
                 if hap_prob.status != 1:
                     break
                 opt = hap_prob.objective.value()
-                new_called, variants, hap_len, refs, phase_sets = self._haps_from_prob(hap_prob)
-                if new_called == called or len(new_called) == 0:
+                new_called, variants, _, refs, new_modifiers = self._haps_from_prob(hap_prob)
+                if (new_called, new_modifiers) == (called, used_modifiers) or len(new_called) == 0:
                     break
-                called = new_called
+                called, used_modifiers = new_called, new_modifiers
             return possible_haplotypes, haplotype_variants
 
+    def _exclude_solution(self, haplotypes: list, modifiers: list) -> object:
+        """
+        Constraint that excludes the current solution (and lets the next solve find another one)
+        The CNV modifiers are part of the solution, so the same sub-alleles with other modifiers (e.g. *2.001_x3 instead of 
+        *2.001_x2) are still enumerated. 
+
+        Args:
+            haplotypes (list): haplotype (class) variables
+            modifiers (list): CNV modifier variables
+
+        Returns:
+            object: pulp constraint
+        """
+        used = [(round(v.value()), v) for v in haplotypes + modifiers if v.value() and round(v.value()) > 0]
+        return lpSum(copies * v for copies, v in used) <= len(used) - 1
+
+    def _get_hap_strands(self) -> dict:
+        """
+        Phase set and strand of the matched rows of each candidate haplotype (rows on both strands are left out)
+
+        Returns:
+            dict: set of (PHASE_SET, STRAND) for each haplotype
+        """
+        hap_strands = {}
+        for hap, phase_set, strand in zip(self.translation_table.iloc[:,0], self.translation_table["PHASE_SET"], self.translation_table["STRAND"]):
+            if strand != 3:
+                hap_strands.setdefault(hap, set()).add((phase_set, strand))
+        return hap_strands
+
+    def _can_carry(self, hap_strands: dict, hap: str, modifier: dict) -> bool:
+        """
+        Can a copy of a sub-allele carry a CNV modifier in the phased LP?
+        The CNV haplotype uses the strand constraint (see _get_strand_constraint) with the modifier row added, 
+        so no row of the sub-allele in the modifier's phase set can be on another strand. 
+
+        Args:
+            hap_strands (dict): phase sets and strands of each haplotype (see _get_hap_strands)
+            hap (str): sub-allele
+            modifier (dict): modifier (see _match_cnv_haps)
+
+        Returns:
+            bool: True if the CNV haplotype is in phase
+        """
+        if modifier["strand"] == 3:
+            return True
+        return all(strand == modifier["strand"] for phase_set, strand in hap_strands.get(hap, ()) if phase_set == modifier["phase_set"])
+
+    def _modifier_coef(self, modifier: dict, phased: bool) -> int:
+        """
+        Objective coefficient of a CNV modifier, added to the sub-allele that carries it
+        The weight of its heaviest CNV haplotype (see AbstractGene._set_cnv_combinations), 
+        if phased, plus one for its variant when the modifier is in a phase set. 
+
+        Args:
+            modifier (dict): modifier (see _match_cnv_haps)
+            phased (bool): the LP uses the phased constraints
+
+        Returns:
+            int: coefficient
+        """
+        weight = max([modifier["weights"][name] for names in modifier["subs"].values() for name in names], default = 0)
+        if phased and modifier["phase_set"] in self.phase_sets:
+            weight += 1
+        return weight
+
+    def _fast_path(self) -> tuple:
+        """
+        Result of lp_hap for samples that do not need the solver (None for any other sample)
+        reference: no candidate haplotype (no alternate allele matched), the only solution is the reference twice.
+        single: one candidate haplotype, the optimum uses it as often as every variant allows (up to max_haps),
+            which must also be as often as every matched CNV requires. Any other solution uses it less often 
+            and scores lower, so nothing else is enumerated. 
+        A phased candidate with variants out of phase is solved, the phased LP drops it.
+
+        Returns:
+            tuple: fast path (reference or single), list of possible haplotypes and list of associated variants, as from lp_hap
+        """
+        if len(self.modifiers) > 0 or len(self.cnv_members) > 0:
+            return None # CNV haplotypes are solved as a sub-allele and a modifier
+        if len(self.haplotypes) == 0:
+            self.reduction_stats = {"haplotypes": 0, "classes": 0}
+            return "reference", [([self.reference, self.reference], 2)], [()]
+        if len(self.haplotypes) > 1 or float(self.lp_params["optimal_decay"]) < 0 or not self.variants["VAR_CODE"].is_unique:
+            return None
+        if self.phased and not self._get_strand_constraint(0):
+            return None
+        var_matches = self.variants["MATCH"].to_numpy()
+        copies = min(int(self.lp_params["max_haps"]), 2, int(var_matches.min()))
+        if copies < 1 or (var_matches[self.variants["Type"].to_numpy() == "CNV"] != copies).any():
+            return None
+        self.reduction_stats = {"haplotypes": 1, "classes": 1}
+        label = self.hap_labels[self.haplotypes[0]]
+        called = [label, label] if copies == 2 else [label, self.reference]
+        variants = tuple(sorted(self.var_labels[var] for var in self.variants["VAR_CODE"]))
+        return "single", [(sorted(called), 2 - copies)], [variants]
+
+    def _get_hap_classes(self, hap_vars: list, hap_coefs: list, phase_set_coefs: list, hap_modifiers: list = None) -> list:
+        """
+        Group haplotypes that are interchangeable in the LP (same variants, objective, phase set use, and CNV modifiers they can carry)
+
+        Args:
+            hap_vars (list): indices of the variants used by each haplotype
+            hap_coefs (list): objective coefficient for each haplotype
+            phase_set_coefs (list): number of variants in each phase set for each haplotype
+            hap_modifiers (list, optional): CNV modifiers (indices into self.modifiers) each haplotype can carry. Defaults to None.
+
+        Returns:
+            list: lists of haplotype indices, one list per class (first index is the representative)
+        """
+        hap_modifiers = hap_modifiers if hap_modifiers is not None else [()] * len(hap_vars)
+        classes = {}
+        for i in range(len(hap_vars)):
+            classes.setdefault((tuple(hap_vars[i]), hap_coefs[i], tuple(phase_set_coefs[i]), hap_modifiers[i]), []).append(i)
+        return list(classes.values())
+
+    def _expand_call(self, called: list, refs: int, used: tuple = ()) -> list:
+        """
+        Expand a call made with class representatives to the calls of the class members
+        A class used twice expands to each member used twice (as enumerated without classes when the solver
+        finds a member used twice first), mixed pairs of members are never reported.
+        Used CNV modifiers are placed on copies of the classes that can carry them (at most one per copy), every placement
+        is a call with the CNV haplotypes (e.g. *2.001_x2) of the members of that class. 
+
+        Args:
+            called (list): called haplotypes (representatives), reference fills are last
+            refs (int): number of reference fills
+            used (tuple, optional): (modifier, copies) of the used CNV modifiers. Defaults to ().
+
+        Returns:
+            list: list of calls
+        """
+        fill = called[len(called) - refs:] if refs > 0 else []
+        copies = called[:len(called) - refs]
+        used = Counter(dict(used))
+        carried = [[None] + list(self.class_cnv_haps.get(rep, {})) if len(used) > 0 else [None] for rep in copies]
+        placements = sorted(set(tuple(sorted(zip(copies, placement), key = str)) for placement in product(*carried) 
+            if Counter(j for j in placement if j is not None) == used))
+        calls = []
+        for placement in placements:
+            options = []
+            for (rep, modifier), count in Counter(placement).items():
+                members = self.class_members.get(rep, [rep]) if modifier is None else self.class_cnv_haps[rep][modifier]
+                if count <= 2:
+                    options.append([[member] * int(count) for member in members])
+                else:
+                    options.append([list(c) for c in combinations_with_replacement(members, int(count)) if max(Counter(c).values()) <= 2])
+            calls += [sum(combination, []) + fill for combination in product(*options)]
+        return calls
+
+    def _covers_cnvs(self, hap_vars: list) -> bool:
+        """
+        Is every matched CNV carried by at least one candidate haplotype?
+        CNV variants must be used exactly as many times as they matched, so the LP is infeasible otherwise.
+
+        Args:
+            hap_vars (list): indices (into self.variants) of the variants used by each candidate haplotype
+
+        Returns:
+            bool: False if the LP over these candidates is infeasible
+        """
+        var_types = self.variants["Type"].to_numpy()
+        var_matches = self.variants["MATCH"].to_numpy()
+        cnvs = {i for i in range(len(var_types)) if var_types[i] == "CNV" and var_matches[i] > 0}
+        if not cnvs:
+            return True
+        covered = set()
+        for variants in hap_vars:
+            covered.update(variants)
+        return cnvs <= covered
 
     def _get_strand_constraint(self, i: int) -> int:
         """
@@ -339,9 +698,13 @@ class Haplotype:
         return True
     
 
-    def optimize_hap(self) -> ():
+    def optimize_hap(self, lp_params: dict = None) -> ():
         """
         Solve for the most likely diplotype
+        Can be run again on the same matched table (e.g. with other LP parameters)
+
+        Args:
+            lp_params (dict, optional): LP parameters (max_haps, optimal_decay) for this solve. Defaults to the config LP_PARAMS.
 
         Returns:
             (): Results
@@ -349,17 +712,53 @@ class Haplotype:
         if not self.matched:
             print("You need to run the table_matcher function with genotyped before you can optimize")
             sys.exit(1)
-        called, variants = self.lp_hap()
-        refs = max([i[1] for i in called]) if len(called) > 0 else 0
-        if called is None:
-            # Happens when a phased call attempt fails
-            self.phased = False
+        self.deadline = perf_counter() + self.sample_time_limit if self.sample_time_limit > 0 else None
+        self.timed_out = False
+        self.max_solve_time = 0
+        self.problems = []
+        self.solves = []
+        self.fallback = None
+        self.lp_params = self.config.LP_PARAMS if lp_params is None else {**self.config.LP_PARAMS, **lp_params}
+        fast_path = self._fast_path()
+        self.fast_path = fast_path[0] if fast_path is not None else None
+        _count_fast_path(self.fast_path or "solved")
+        if fast_path is not None:
+            called, variants = fast_path[1:]
+        else:
             called, variants = self.lp_hap()
+        if called is None and self._out_of_time():
+            called, variants = [], []
+        elif called is None:
+            # Happens when a phased call attempt fails (and was not predicted by the pre-check in lp_hap)
+            self.fallback = "triggered"
+            _count_fallback("triggered")
+            called, variants = self.lp_hap(phased = False)
+        refs = max([i[1] for i in called]) if len(called) > 0 else 0
         if refs > 0 and len(called) > 1:
             called_prefer_ref = [i for i in called if i[1] > 0]
             called = called_prefer_ref
         if len(called) > 1:
             LOGGING.warning(f"Multiple genotypes possible for {self.sample_prefix}.")
         called_final = [i[0] for i in called]
+        self.refs = [i[1] for i in called] # Reference haplotypes filled in for each call
         return called_final, variants
       
+
+    def trace_stats(self) -> dict:
+        """
+        Problem size and solves of the last match and solve (for trace.TraceLog)
+
+        Returns:
+            dict: candidates and variants after matching, classes, problems (one per LP built), 
+                solves (status, seconds, phased), fallback (triggered or avoided, see PHASED_FALLBACKS), 
+                fast_path (reference or single, see _fast_path), timed_out
+        """
+        return {
+            "candidates": len(self.haplotypes) if self.matched else 0,
+            "variants": int(self.variants.shape[0]) if self.matched else 0,
+            "classes": self.reduction_stats["classes"],
+            "problems": self.problems,
+            "solves": self.solves,
+            "fallback": self.fallback,
+            "fast_path": self.fast_path,
+            "timed_out": self.timed_out}
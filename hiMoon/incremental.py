@@ -0,0 +1,177 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import threading
+
+import pandas as pd
+
+from . import LOGGING
+
+
+def _haplotype_variants(gene) -> dict:
+    table = gene.get_full_table()
+    haplotypes = {}
+    for hap, var_id in zip(table.iloc[:,0], table["VAR_ID"]):
+        haplotypes.setdefault(hap, []).append(var_id)
+    return {hap: sorted(var_ids) for hap, var_ids in haplotypes.items()} # Repeated rows count in the LP
+
+
+def diff_tables(old_gene, new_gene) -> dict:
+    """
+    Differences between two versions of a gene's processed translation table
+
+    Args:
+        old_gene (AbstractGene): gene with the earlier table
+        new_gene (AbstractGene): gene with the updated table
+
+    Returns:
+        dict: added, removed, and changed haplotypes (sets of names),
+            variants (set of VAR_IDs of every added, removed, or changed haplotype, in either table),
+            and reference (True if the reference haplotype changed)
+    """
+    old_haps = _haplotype_variants(old_gene)
+    new_haps = _haplotype_variants(new_gene)
+    added = set(new_haps) - set(old_haps)
+    removed = set(old_haps) - set(new_haps)
+    changed = {hap for hap in set(old_haps) & set(new_haps) if old_haps[hap] != new_haps[hap]}
+    variants = set()
+    for hap in added | removed | changed:
+        variants.update(old_haps.get(hap, ()))
+        variants.update(new_haps.get(hap, ()))
+    return {
+        "added": added,
+        "removed": removed,
+        "changed": changed,
+        "variants": variants,
+        "reference": old_gene.reference != new_gene.reference}
+
+
+class IncrementalCalls:
+
+    def __init__(self, previous_genes: list, genes: list, previous_calls: dict) -> None:
+        """
+        Carries calls from a run with earlier translation tables forward to updated tables
+        Only candidate haplotypes (every genotyped variant matched) are used in the LP, so a sample 
+        for which none of the added, removed, or changed haplotypes is a candidate (with the earlier or the updated table) 
+        keeps its call. Those samples are not solved, their earlier call is reported with the new table version.
+        Genes with a different reference haplotype, genes without an earlier table, and
+        samples without an earlier call (or with a timed out call) are called as usual.
+        The run must use the same config, solver, and phasing as the earlier run.
+
+        Args:
+            previous_genes (list): gene.AbstractGene objects with the earlier tables (variants are not needed)
+            genes (list): gene.AbstractGene objects with the updated tables
+            previous_calls (dict): calls of the earlier run, from vcf.read_flat_file
+        """
+        previous = {str(gene): gene for gene in previous_genes}
+        self.previous_calls = previous_calls
+        self.updates = {}
+        for gene in genes:
+            old_gene = previous.get(str(gene))
+            if old_gene is None:
+                LOGGING.warning(f"No earlier translation table for {gene}, all samples will be called")
+                continue
+            diff = diff_tables(old_gene, gene)
+            if diff["reference"]:
+                LOGGING.warning(f"Reference haplotype of {gene} changed, all samples will be called")
+                continue
+            if old_gene.min < gene.min or old_gene.max > gene.max:
+                LOGGING.warning(f"The earlier {gene} table covers positions outside the updated gene region, all samples will be called")
+                continue
+            # Rows of the updated haplotypes in both tables, resolved against each gene view's records
+            changed = diff["added"] | diff["removed"] | diff["changed"]
+            old_table = old_gene.get_full_table()
+            new_table = gene.get_full_table()
+            old_rows = old_table[old_table.iloc[:,0].isin(changed)]
+            new_rows = new_table[new_table.iloc[:,0].isin(changed)]
+            groups = [("old", hap) for hap in old_rows.iloc[:,0]] + [("new", hap) for hap in new_rows.iloc[:,0]]
+            self.updates[str(gene)] = {"version": old_gene.version, "rows": pd.concat([old_rows, new_rows]), "groups": groups, "resolved": {}}
+            LOGGING.info(f"{gene} {old_gene.version} -> {gene.version}: {len(diff['added'])} added, {len(diff['removed'])} removed, {len(diff['changed'])} changed haplotypes ({len(diff['variants'])} variants)")
+        self.lock = threading.Lock()
+        self.carried = 0
+        self.called = 0
+
+    def _resolve(self, update: dict, gene) -> tuple:
+        # Once per gene view (e.g. per chunk), workers calling different chunks keep their own entries.
+        # The entry holds the variants it is keyed on, so the id is not reused while the entry is kept
+        resolved = update["resolved"].get(id(gene.variants))
+        if resolved is None or resolved[0] is not gene.variants:
+            resolved = (gene.variants,) + gene.resolve_table(update["rows"])
+            update["resolved"][id(gene.variants)] = resolved
+        return resolved[1:]
+
+    def release(self, genes: list) -> None:
+        """
+        Drop the resolved rows of gene views whose samples are all called (e.g. when a chunk is finished)
+
+        Args:
+            genes (list): gene.AbstractGene views
+        """
+        for gene in genes:
+            update = self.updates.get(str(gene))
+            if update is not None:
+                update["resolved"].pop(id(gene.variants), None)
+
+    def _any_candidate(self, update: dict, gene, haplotype) -> bool:
+        """
+        Is any updated haplotype a candidate for the sample (as in Haplotype.table_matcher)?
+        """
+        records, alleles = self._resolve(update, gene)
+        matched = {}
+        for group, record, row_alleles in zip(update["groups"], records, alleles):
+            match = haplotype._match(record, row_alleles)[0]
+            if match == 99: # Missing, the row is dropped
+                continue
+            matched[group] = matched.get(group, True) and match > 0
+        return any(matched.values())
+
+    def get(self, gene, haplotype) -> dict:
+        """
+        Earlier call of a sample if the table update cannot change it
+
+        Args:
+            gene (AbstractGene): gene with the updated table
+            haplotype (Haplotype): haplotype object for the sample (before matching)
+
+        Returns:
+            dict: earlier call (as in Subject.called_haplotypes, stamped with the new version), None if the sample must be called
+        """
+        update = self.updates.get(str(gene))
+        call = self.previous_calls.get((haplotype.sample_prefix, str(gene)))
+        carry = update is not None and call is not None and not call["TIMED_OUT"] and call["VERSION"] in ("", update["version"])
+        if carry:
+            carry = not self._any_candidate(update, gene, haplotype)
+        with self.lock:
+            if carry:
+                self.carried += 1
+            else:
+                self.called += 1
+        if not carry:
+            return None
+        return {
+            "HAPS": call["HAPS"],
+            "REFS": call["REFS"],
+            "TIMED_OUT": False,
+            "SOLVE_TIME": 0,
+            "CANDIDATES": {"haplotypes": 0, "classes": 0},
+            "VERSION": gene.version}
+
+    def stats(self) -> dict:
+        """
+        Number of sample/gene calls carried forward and called
+
+        Returns:
+            dict: carried, called
+        """
+        return {"carried": self.carried, "called": self.called}
@@ -0,0 +1,266 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+from bisect import bisect_left, bisect_right
+from collections import ChainMap
+
+import numpy as np
+
+# Record code of rows that are not in the VCF
+MISSING_RECORD = -1
+
+# How far (bp) from the translation table position a shifted indel or SV record is looked for
+SHIFT_WINDOW = 20
+
+
+def mod_vcf_allele(alt: str, ref: str) -> str:
+    """
+    Modifies an allele from the VCF to standardized form
+
+    Args:
+        alt (str): alt allele
+        ref (str): ref allele
+
+    Returns:
+        str: reformatted alt allele
+    """
+    if alt is None:
+        return "-"
+    if "<" in alt:
+        return f"s{alt.strip('<>')}"
+    elif len(ref) > len(alt):
+        return "id-"
+    elif len(ref) < len(alt):
+        return f'id{alt[1:]}' # Remove first position
+    else:
+        return f's{alt}'
+
+
+def mod_tt_allele(var_type: str, alt: str, iupac_codes: dict) -> list:
+    """
+    Modifies the translation table allele to a standardized form
+
+    Args:
+        var_type (str): insertion, deletion, or substitution
+        alt (str): allele from translation table
+        iupac_codes (dict): IUPAC code -> nucleotides
+
+    Returns:
+        list: modified allele as list based on iupac
+    """
+    alt = alt.strip("<>")
+    if var_type == "insertion":
+        return [f'id{alt}']
+    elif var_type == "deletion":
+        return [f'id-']
+    else:
+        try:
+            return [f's{a}' for a in iupac_codes[alt]]
+        except KeyError:
+            return [f's{alt}']
+
+
+def bits_to_mask(bits: int, size: int) -> np.ndarray:
+    """
+    Boolean array of a bitset (bit i -> element i)
+
+    Args:
+        bits (int): bitset
+        size (int): number of elements
+
+    Returns:
+        np.ndarray: boolean array of length size
+    """
+    packed = np.frombuffer(bits.to_bytes((size + 7) // 8, "little"), dtype = np.uint8)
+    return np.unpackbits(packed, count = size, bitorder = "little").astype(bool)
+
+
+def _vcf_event(pos: int, ref: str, alt: str) -> tuple:
+    """
+    Trim the bases shared by ref and alt
+
+    Returns:
+        tuple: position of the first changed base, removed bases, inserted bases
+    """
+    while ref and alt and ref[0] == alt[0]:
+        ref, alt, pos = ref[1:], alt[1:], pos + 1
+    while ref and alt and ref[-1] == alt[-1]:
+        ref, alt = ref[:-1], alt[:-1]
+    return pos, ref, alt
+
+
+def _table_events(var_type: str, start: int, ref: str, alt: str, iupac_codes: dict) -> list:
+    """
+    Translation table row in the same form as _vcf_event (one event per IUPAC base)
+    """
+    ref = "" if ref in ("-", ".") else ref
+    alt = "" if alt in ("-", ".") else alt
+    if var_type == "insertion":
+        return [(start + 1, "", alt)]
+    elif var_type == "deletion":
+        return [(start, ref, "")]
+    return [(start, ref, a) for a in iupac_codes.get(alt, [alt])]
+
+
+def _shifts_to(left: tuple, right: tuple, reference) -> bool:
+    """
+    Is the indel right the indel left shifted to the right within a repeat?
+    The indel is moved one base at a time, which is only the same event when the next reference base
+    repeats the inserted (or deleted) sequence. Every base has to be known, otherwise the shift is rejected. 
+
+    Args:
+        left (tuple): indel (as from _vcf_event) at or before right
+        right (tuple): indel of the same type and length
+        reference (dict): position -> reference base
+
+    Returns:
+        bool: True if both describe the same event
+    """
+    pos, bases = left[0], left[1] or left[2]
+    deletion = bool(left[1])
+    while pos < right[0]:
+        if reference.get(pos + len(bases) if deletion else pos) != bases[0]:
+            return False
+        pos, bases = pos + 1, bases[1:] + bases[0]
+    return pos == right[0] and bases == (right[1] or right[2])
+
+
+def _same_event(row_event: tuple, record_event: tuple, reference) -> bool:
+    """
+    Does a VCF allele describe the translation table allele?
+    Same substitution (also inside a longer VCF substitution), or the same indel
+    (also shifted within a repeat, checked against the reference bases, see _shifts_to).
+    """
+    row_pos, row_ref, row_alt = row_event
+    pos, ref, alt = record_event
+    if row_ref and row_alt: # Substitution
+        if len(ref) != len(alt) or len(ref) == 0:
+            return False
+        offset = row_pos - pos
+        return 0 <= offset and offset + len(row_alt) <= len(alt) and alt[offset:offset + len(row_alt)] == row_alt
+    if bool(ref) != bool(row_ref) or bool(alt) != bool(row_alt) or len(ref + alt) != len(row_ref + row_alt):
+        return False # Not an indel of the same type and length
+    left, right = sorted([row_event, record_event], key = lambda e: e[0])
+    return _shifts_to(left, right, reference)
+
+
+class RecordIndex:
+
+    def __init__(self, variants: dict, iupac_codes: dict, nearby: bool = False) -> None:
+        """
+        Sorted positional index over the VCF records of a gene
+        Built once per gene (and set of variants), resolves translation table rows
+        to the record and VCF alleles that describe them, so matching a sample only
+        compares that sample's alleles with the resolved alleles.
+        Rows are resolved from the record's own REF and ALT alleles, never from sample genotypes,
+        so a row resolves the same way whichever samples are loaded. Variants without ALT alleles
+        (built by the caller, see himoon.get_haps_from_variants) use the non-reference sample alleles. 
+
+        Args:
+            variants (dict): variants from vcf.VarFile.get_range
+            iupac_codes (dict): IUPAC code -> nucleotides
+            nearby (bool, optional): resolve rows without a record at their ID to the closest record 
+                with an equivalent allele (see _nearby_alleles). Defaults to False (missing, as an exact ID lookup).
+        """
+        self.nearby = nearby
+        self.codes = {key: code for code, key in enumerate(variants)}
+        self.iupac_codes = iupac_codes
+        records = []
+        self.keys = list(variants) # Record code -> record ID
+        self.record_alleles = [] # Record code -> ref, alts
+        self.reference = {} # Position -> reference base, from the REF alleles of the records
+        for code, (key, sample_genotypes) in enumerate(variants.items()):
+            _, pos, var_type = key.split("_", 2)
+            ref = ""
+            alts = set()
+            for genotype in sample_genotypes.values(): # Records merged under one ID (e.g. from several files) are combined
+                ref = genotype["ref"] if genotype["ref"] is not None else ""
+                if "alts" in genotype:
+                    alts.update(genotype["alts"])
+                else: # Variants built by the caller (himoon.get_haps_from_variants) may not list the record's alts
+                    alts.update(a for a in genotype["alleles"] or () if a is not None and a != ref)
+            self.record_alleles.append((ref, alts))
+            if "<" not in ref:
+                for i, base in enumerate(ref):
+                    self.reference.setdefault(int(pos) + i, base)
+            records.append((int(pos), var_type, code, ref, alts))
+        records.sort(key = lambda r: r[0])
+        self.records = records
+        self.positions = [r[0] for r in records]
+        self.max_ref_len = max([len(r[3]) for r in records], default = 1)
+
+    def _exact_alleles(self, code: int, var_type: str, alt: str) -> frozenset:
+        """
+        Alleles of the record with the translation table ID that match the row
+        """
+        ref, alts = self.record_alleles[code]
+        tt_alleles = mod_tt_allele(var_type, alt, self.iupac_codes)
+        return frozenset(a for a in alts | {ref} if mod_vcf_allele(a, ref) in tt_alleles)
+
+    def _nearby_alleles(self, var_type: str, start: int, stop: int, ref: str, alt: str) -> tuple:
+        """
+        Closest record in the row's position range (padded for shifted indels and SVs)
+        with an allele that describes the row
+        """
+        if start is None:
+            return MISSING_RECORD, frozenset()
+        stop = start if stop is None else stop
+        pad = SHIFT_WINDOW if var_type in ("insertion", "deletion", "CNV") else 0
+        lo = bisect_left(self.positions, start - max(pad, self.max_ref_len))
+        hi = bisect_right(self.positions, stop + pad)
+        candidates = sorted(self.records[lo:hi], key = lambda r: abs(r[0] - start))
+        if var_type == "CNV":
+            symbol = alt.strip("<>")
+            for pos, record_type, code, record_ref, alleles in candidates:
+                matched = frozenset(a for a in alleles if record_type != "SID" and a.strip("<>") == symbol)
+                if matched:
+                    return code, matched
+            return MISSING_RECORD, frozenset()
+        row_events = _table_events(var_type, start, ref, alt, self.iupac_codes)
+        reference = self.reference
+        if var_type == "deletion": # The deleted bases are reference bases too
+            reference = ChainMap({pos: base for pos, base in enumerate(row_events[0][1], start)}, self.reference)
+        for pos, record_type, code, record_ref, alleles in candidates:
+            if record_type != "SID":
+                continue
+            matched = frozenset(a for a in alleles if "<" not in a and
+                any(_same_event(e, _vcf_event(pos, record_ref, a), reference) for e in row_events))
+            if matched:
+                return code, matched
+        return MISSING_RECORD, frozenset()
+
+    def resolve(self, match_id: str, var_type: str, start: int, stop: int, ref: str, alt: str) -> tuple:
+        """
+        Record and VCF alleles for a translation table row
+        The record with the row's ID is used when present (same as an exact ID lookup),
+        otherwise (if nearby is set) the closest overlapping record with an equivalent allele.
+
+        Args:
+            match_id (str): ID of the row (MATCH_ID in the gene translation table)
+            var_type (str): variant type of the row
+            start (int): variant start of the row
+            stop (int): variant stop of the row
+            ref (str): reference allele of the row
+            alt (str): variant allele of the row
+
+        Returns:
+            tuple: record code (index into self.keys, MISSING_RECORD if not in the VCF), frozenset of matching VCF alleles
+        """
+        try:
+            code = self.codes[match_id]
+        except KeyError:
+            if not self.nearby:
+                return MISSING_RECORD, frozenset()
+            return self._nearby_alleles(var_type, start, stop, str(ref), str(alt))
+        return code, self._exact_alleles(code, var_type, alt)
@@ -0,0 +1,201 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import csv
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Active report (None = memory reporting is off)
+REPORT = None
+
+
+class MemoryReport:
+
+    def __init__(self) -> None:
+        """
+        Allocation peaks and retained memory per stage and gene (from tracemalloc)
+        For each stage (e.g. get_range) and gene, the report keeps the number of calls,
+        the largest peak above the memory in use when the stage started,
+        and the memory still held when the stage ended (summed over calls).
+        Python allocations only, measured for the whole process (the peak is reset at the start of each stage),
+        so stages must run one at a time: the CLI rejects --memory-report with --pipeline or --gene-workers above 1.
+        """
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started_tracing = False
+
+    def start(self) -> None:
+        """
+        Start tracing allocations
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def stop(self) -> None:
+        """
+        Stop tracing allocations (if this report started it)
+        """
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def _get_stack(self) -> list:
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    @contextmanager
+    def stage(self, name: str, gene: str = None, samples: int = 1):
+        """
+        Measure a stage, the yielded record can be updated (e.g. gene name) before the stage ends
+
+        Args:
+            name (str): stage name
+            gene (str, optional): gene name. Defaults to None.
+            samples (int, optional): number of samples the stage handles. Defaults to 1.
+        """
+        stack = self._get_stack()
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        record = {"stage": name, "gene": gene, "samples": samples, "start": current, "peak": current}
+        stack.append(record)
+        try:
+            yield record
+        finally:
+            stack.pop()
+            current, peak = tracemalloc.get_traced_memory()
+            record["peak"] = max(record["peak"], peak)
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], record["peak"])
+            self._add(record, current)
+
+    def _add(self, record: dict, current: int) -> None:
+        key = (record["stage"], record["gene"] if record["gene"] is not None else "")
+        with self.lock:
+            totals = self.stages.setdefault(key, {"calls": 0, "samples": 0, "peak": 0, "retained": 0})
+            totals["calls"] += 1
+            totals["samples"] += record["samples"]
+            totals["peak"] = max(totals["peak"], record["peak"] - record["start"])
+            totals["retained"] += current - record["start"]
+
+    def records(self) -> list:
+        """
+        Report rows
+
+        Returns:
+            list: one dict per stage and gene (STAGE, GENE, CALLS, SAMPLES, PEAK_BYTES, RETAINED_BYTES, RETAINED_BYTES_PER_SAMPLE)
+        """
+        rows = []
+        with self.lock:
+            for (name, gene), totals in self.stages.items():
+                rows.append({
+                    "STAGE": name,
+                    "GENE": gene,
+                    "CALLS": totals["calls"],
+                    "SAMPLES": totals["samples"],
+                    "PEAK_BYTES": totals["peak"],
+                    "RETAINED_BYTES": totals["retained"],
+                    "RETAINED_BYTES_PER_SAMPLE": round(totals["retained"] / totals["samples"]) if totals["samples"] else 0})
+        return rows
+
+    def estimate(self, samples: int) -> int:
+        """
+        Rough estimate of the memory (bytes) needed to call a number of samples with the same genes
+        Translation tables, plus the per-sample retained memory of get_range (genotypes) and 
+        subject (calls) times samples, plus the largest single peak.
+        With --chunked, use the chunk size for get_range instead of the number of samples.
+
+        Args:
+            samples (int): number of samples
+
+        Returns:
+            int: bytes
+        """
+        total = 0
+        peak = 0
+        for row in self.records():
+            if row["STAGE"] == "translation_table":
+                total += row["RETAINED_BYTES"]
+            elif row["STAGE"] in ("get_range", "subject"): # match and solve are part of subject
+                total += max(row["RETAINED_BYTES_PER_SAMPLE"], 0) * samples
+            peak = max(peak, row["PEAK_BYTES"])
+        return total + peak
+
+    def write(self, directory: str, prefix: str) -> None:
+        """
+        Write the report to {prefix}.memory.tsv
+
+        Args:
+            directory (str): output directory
+            prefix (str): prefix for filename
+        """
+        with open(directory + f"/{prefix}.memory.tsv", "w") as memory_out:
+            memory_file = csv.DictWriter(memory_out, ["STAGE", "GENE", "CALLS", "SAMPLES", "PEAK_BYTES", "RETAINED_BYTES", "RETAINED_BYTES_PER_SAMPLE"], delimiter = "\t")
+            memory_file.writeheader()
+            memory_file.writerows(self.records())
+
+
+def enable() -> MemoryReport:
+    """
+    Start memory reporting, stages run after this are added to the returned report
+
+    Returns:
+        MemoryReport: the active report
+    """
+    global REPORT
+    if REPORT is None:
+        REPORT = MemoryReport()
+        REPORT.start()
+    return REPORT
+
+
+def disable() -> MemoryReport:
+    """
+    Stop memory reporting
+
+    Returns:
+        MemoryReport: the report that was active (None if reporting was off)
+    """
+    global REPORT
+    report = REPORT
+    REPORT = None
+    if report is not None:
+        report.stop()
+    return report
+
+
+@contextmanager
+def stage(name: str, gene: str = None, samples: int = 1):
+    """
+    Measure a stage in the active report (does nothing when reporting is off)
+
+    Args:
+        name (str): stage name
+        gene (str, optional): gene name. Defaults to None.
+        samples (int, optional): number of samples the stage handles. Defaults to 1.
+    """
+    report = REPORT
+    if report is None:
+        yield {"stage": name, "gene": gene, "samples": samples}
+    else:
+        with report.stage(name, gene, samples) as record:
+            yield record
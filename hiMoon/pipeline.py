@@ -0,0 +1,219 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import queue
+import threading
+
+from .subject import Subject
+from . import LOGGING
+from . import memory
+
+_DONE = object()
+
+
+def chunk_samples(samples: list, chunk_size: int) -> list:
+    """
+    Split samples into consecutive chunks
+
+    Args:
+        samples (list): sample IDs
+        chunk_size (int): samples per chunk
+
+    Returns:
+        list: list of sample lists
+    """
+    chunk_size = max(1, int(chunk_size))
+    return [samples[i:i + chunk_size] for i in range(0, len(samples), chunk_size)]
+
+
+def get_chunk_genes(vcf, genes: list, chunk: list) -> list:
+    """
+    Gene views with variants for a chunk of samples
+    Regions are decoded from the VCF for just the chunk (with file handles that only unpack 
+    the chunk's samples), unless the genes already have variants loaded (e.g. streaming input), 
+    in which case they are sliced.
+
+    Args:
+        vcf (VarFile): VarFile or RegionStore, None if genes already have variants
+        genes (list): gene.AbstractGene objects
+        chunk (list): sample IDs
+
+    Returns:
+        list: gene.AbstractGene views
+    """
+    chunk_genes = []
+    sliced = vcf is None or getattr(vcf, "stream", False)
+    chunk_vcf = vcf.for_samples(chunk) if not sliced and hasattr(vcf, "for_samples") else vcf
+    for gene in genes:
+        if sliced:
+            chunk_set = set(chunk)
+            variants = {var_id: {s: v for s, v in sub_vars.items() if s in chunk_set} for var_id, sub_vars in gene.variants.items()}
+        else:
+            with memory.stage("get_range", str(gene), len(chunk)):
+                variants = chunk_vcf.get_range(gene.chromosome, gene.min, gene.max, samples = chunk)
+        chunk_genes.append(gene.with_variants(variants))
+    if chunk_vcf is not vcf:
+        chunk_vcf.close()
+    return chunk_genes
+
+
+def call_chunks(vcf, genes: list, callback, config = None, chunk_size: int = 100, cache = None, previous = None, gene_workers: int = 1, trace = None) -> None:
+    """
+    Call samples one chunk at a time (serial)
+    Gene regions are decoded for a chunk, every gene is called for its samples, and 
+    the chunk's genotypes are released before the next chunk is read, so memory use 
+    depends on chunk size and window size rather than cohort size. 
+
+    Args:
+        vcf (VarFile): VarFile or RegionStore, None if genes already have variants
+        genes (list): gene.AbstractGene objects (variants are not needed unless vcf is None or streaming)
+        callback (function): called with each Subject in sample order
+        config (ConfigData, optional): config.ConfigData object
+        chunk_size (int, optional): samples per chunk. Defaults to 100.
+        cache (CallCache, optional): cache.CallCache of solved calls
+        previous (IncrementalCalls, optional): incremental.IncrementalCalls, calls carried forward from earlier translation tables
+        gene_workers (int, optional): number of genes called at the same time for each sample. Defaults to 1.
+        trace (TraceLog, optional): trace.TraceLog, one record per sample and gene
+    """
+    chunks = chunk_samples(vcf.samples if vcf is not None else [], chunk_size)
+    for i, chunk in enumerate(chunks):
+        chunk_genes = get_chunk_genes(vcf, genes, chunk)
+        for sub_id in chunk:
+            callback(Subject(prefix = sub_id, genes = chunk_genes, config = config, cache = cache, previous = previous, gene_workers = gene_workers, trace = trace))
+        if previous is not None:
+            previous.release(chunk_genes)
+        del chunk_genes
+        LOGGING.info(f"Finished chunk {i + 1} of {len(chunks)}")
+
+
+class Pipeline:
+
+    def __init__(self, vcf, genes: list, config = None, chunk_size: int = 100,
+                    workers: int = 2, queue_size: int = 4, cache = None, previous = None, gene_workers: int = 1, trace = None) -> None:
+        """
+        Pipelined calling: a producer thread decodes gene regions for chunks of samples into a bounded queue,
+        worker threads match and solve the chunks, and results are handed to the writer (run callback)
+        in sample order. Decoding, solving (CBC/GLPK run as subprocesses), and writing overlap.
+        At most queue_size + workers chunks are decoded, solved, or waiting for an earlier chunk to be written at a time, 
+        so a slow chunk holds back decoding instead of collecting the results of the chunks after it. 
+
+        Args:
+            vcf (VarFile): VarFile or RegionStore, None if genes already have variants
+            genes (list): gene.AbstractGene objects (variants are not needed unless vcf is None or streaming)
+            config (ConfigData, optional): config.ConfigData object
+            chunk_size (int, optional): samples per chunk. Defaults to 100.
+            workers (int, optional): number of matching/solving threads. Defaults to 2.
+            queue_size (int, optional): maximum number of decoded chunks waiting to be solved. Defaults to 4.
+            cache (CallCache, optional): cache.CallCache of solved calls (shared by the workers)
+            previous (IncrementalCalls, optional): incremental.IncrementalCalls, calls carried forward from earlier translation tables
+            gene_workers (int, optional): number of genes called at the same time for each sample. Defaults to 1.
+            trace (TraceLog, optional): trace.TraceLog, one record per sample and gene (shared by the workers)
+        """
+        self.vcf = vcf
+        self.genes = genes
+        self.config = config
+        self.cache = cache
+        self.previous = previous
+        self.gene_workers = gene_workers
+        self.trace = trace
+        self.workers = max(1, int(workers))
+        self.chunks = chunk_samples(vcf.samples if vcf is not None else [], chunk_size)
+        self.chunk_queue = queue.Queue(maxsize = max(1, int(queue_size)))
+        self.result_queue = queue.Queue(maxsize = max(1, int(queue_size)) + self.workers)
+        # Chunks that are decoded but not written yet, released by run as chunks are written
+        self.window = threading.Semaphore(max(1, int(queue_size)) + self.workers)
+        self.stop = threading.Event()
+
+    def _put(self, target: queue.Queue, item) -> bool:
+        while not self.stop.is_set():
+            try:
+                target.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _acquire_window(self) -> bool:
+        while not self.stop.is_set():
+            if self.window.acquire(timeout = 0.1):
+                return True
+        return False
+
+    def _produce(self) -> None:
+        try:
+            for i, chunk in enumerate(self.chunks):
+                if not self._acquire_window():
+                    return
+                if not self._put(self.chunk_queue, (i, chunk, get_chunk_genes(self.vcf, self.genes, chunk))):
+                    return
+        except Exception as e:
+            self._put(self.result_queue, (None, e))
+        finally:
+            for _ in range(self.workers):
+                self._put(self.chunk_queue, _DONE)
+
+    def _consume(self) -> None:
+        while not self.stop.is_set():
+            try:
+                item = self.chunk_queue.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                self._put(self.result_queue, _DONE)
+                return
+            i, chunk, chunk_genes = item
+            try:
+                subjects = [Subject(prefix = sub_id, genes = chunk_genes, config = self.config, cache = self.cache, previous = self.previous, gene_workers = self.gene_workers, trace = self.trace) for sub_id in chunk]
+            except Exception as e:
+                self._put(self.result_queue, (None, e))
+                continue
+            finally:
+                if self.previous is not None:
+                    self.previous.release(chunk_genes)
+            self._put(self.result_queue, (i, subjects))
+
+    def run(self, callback) -> None:
+        """
+        Run the pipeline, callback is called with every Subject in sample order
+
+        Args:
+            callback (function): called with each Subject as it is written
+        """
+        threads = [threading.Thread(target = self._produce, daemon = True)]
+        threads += [threading.Thread(target = self._consume, daemon = True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        pending = {}
+        next_chunk = 0
+        finished = 0
+        try:
+            while finished < self.workers:
+                item = self.result_queue.get()
+                if item is _DONE:
+                    finished += 1
+                    continue
+                i, result = item
+                if i is None:
+                    raise result
+                pending[i] = result
+                while next_chunk in pending:
+                    for subject in pending.pop(next_chunk):
+                        callback(subject)
+                    LOGGING.info(f"Finished chunk {next_chunk + 1} of {len(self.chunks)}")
+                    next_chunk += 1
+                    self.window.release()
+        finally:
+            self.stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,212 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import os
+
+import numpy as np
+
+from .vcf import norm_contig
+from . import LOGGING
+
+STORE_FORMAT = "himoon-region-store"
+STORE_VERSION = 2
+
+# Allele codes, anything >= 0 indexes the record allele list
+MISSING_ALLELE = -1 # "." allele
+NO_ALLELE = -2 # Slot not used (e.g. haploid call)
+NO_GENOTYPE = -3 # Alleles could not be determined (stored in the first slot)
+NO_SAMPLE = -4 # Sample is not in the file the record came from (stored in the first slot)
+
+# Stored in place of a missing (None) phase set
+MISSING_PHASE_SET = np.iinfo(np.int64).min
+
+
+def write_store(store_dir: str, genes: list, samples: list) -> None:
+    """
+    Write the variants of all genes to a region store
+    Genotypes are kept as columnar numpy arrays (records x samples) that are memory mapped
+    when read back, record and allele information is kept in metadata.json.
+
+    Args:
+        store_dir (str): output directory
+        genes (list): gene.AbstractGene objects with variants loaded
+        samples (list): sample IDs
+    """
+    os.makedirs(store_dir, exist_ok = True)
+    sample_index = {s: i for i, s in enumerate(samples)}
+    regions = []
+    records = []
+    for gene in genes:
+        regions.append({
+            "gene": str(gene),
+            "chrom": norm_contig(gene.chromosome),
+            "min": int(gene.min),
+            "max": int(gene.max),
+            "start": len(records),
+            "stop": len(records) + len(gene.variants)})
+        records += list(gene.variants.items())
+    alleles = np.full((len(records), len(samples), 2), NO_ALLELE, dtype = np.int16)
+    alleles[:, :, 0] = NO_SAMPLE
+    phased = np.zeros((len(records), len(samples)), dtype = bool)
+    phase_set = np.full((len(records), len(samples)), -1, dtype = np.int64)
+    record_meta = []
+    for i, (var_id, sample_genotypes) in enumerate(records):
+        allele_codes = {}
+        ref = None
+        alts = []
+        for sample, genotype in sample_genotypes.items():
+            j = sample_index[sample]
+            ref = genotype["ref"]
+            alts += [a for a in genotype["alts"] if a not in alts]
+            phased[i, j] = genotype["phased"]
+            phase_set[i, j] = MISSING_PHASE_SET if genotype["phase_set"] is None else genotype["phase_set"]
+            alleles[i, j, 0] = NO_ALLELE
+            if genotype["alleles"] is None:
+                alleles[i, j, 0] = NO_GENOTYPE
+                continue
+            for k, allele in enumerate(genotype["alleles"][:2]):
+                if allele is None:
+                    alleles[i, j, k] = MISSING_ALLELE
+                else:
+                    alleles[i, j, k] = allele_codes.setdefault(allele, len(allele_codes))
+        record_meta.append({
+            "id": var_id,
+            "ref": ref,
+            "alts": alts,
+            "alleles": list(allele_codes)})
+    np.save(os.path.join(store_dir, "alleles.npy"), alleles)
+    np.save(os.path.join(store_dir, "phased.npy"), phased)
+    np.save(os.path.join(store_dir, "phase_set.npy"), phase_set)
+    with open(os.path.join(store_dir, "metadata.json"), "w") as metadata:
+        json.dump({
+            "format": STORE_FORMAT,
+            "version": STORE_VERSION,
+            "samples": samples,
+            "regions": regions,
+            "records": record_meta}, metadata)
+
+
+def is_store(path: str) -> bool:
+    """
+    Is the path a region store directory?
+
+    Args:
+        path (str): path
+
+    Returns:
+        bool: True if path is a region store
+    """
+    return os.path.isfile(os.path.join(path, "metadata.json"))
+
+
+class RegionStore:
+
+    def __init__(self, store_dir: str, sample: str = None) -> None:
+        """
+        Region store written by write_store (hiMoon extract)
+        Can be used in place of vcf.VarFile, without any VCF decoding.
+
+        Args:
+            store_dir (str): path to store directory
+            sample (str, optional): single sample to read
+        """
+        self.stream = False
+        with open(os.path.join(store_dir, "metadata.json"), "rt") as metadata:
+            meta = json.load(metadata)
+        if meta.get("format") != STORE_FORMAT or meta.get("version") != STORE_VERSION:
+            raise ValueError(f"{store_dir} is not a version {STORE_VERSION} hiMoon region store")
+        self.regions = meta["regions"]
+        self.records = meta["records"]
+        self.all_samples = meta["samples"]
+        if sample:
+            self.samples = [sample]
+        else:
+            self.samples = list(self.all_samples)
+        self.sample_index = {s: i for i, s in enumerate(self.all_samples)}
+        self.alleles = np.load(os.path.join(store_dir, "alleles.npy"), mmap_mode = "r")
+        self.phased = np.load(os.path.join(store_dir, "phased.npy"), mmap_mode = "r")
+        self.phase_set = np.load(os.path.join(store_dir, "phase_set.npy"), mmap_mode = "r")
+
+    def _get_records(self, chrom: str, minloc: int, maxloc: int) -> list:
+        """
+        Record indices for a region
+        Exact gene windows are read as extracted, other windows are filtered on POS 
+        (so an SV that starts before such a window is not included). 
+
+        Args:
+            chrom (str): chromosome
+            minloc (int): starting position
+            maxloc (int): ending position
+
+        Returns:
+            list: record indices
+        """
+        chrom = norm_contig(chrom)
+        regions = [r for r in self.regions if r["chrom"] == chrom]
+        for region in regions:
+            if region["min"] == minloc and region["max"] == maxloc:
+                return list(range(region["start"], region["stop"]))
+        covered = [r for r in regions if r["min"] <= minloc and r["max"] >= maxloc]
+        if len(covered) == 0:
+            LOGGING.warning(f"{chrom}:{minloc}-{maxloc} was not fully extracted, only stored records will be used")
+            covered = regions
+        records = []
+        for region in covered:
+            for i in range(region["start"], region["stop"]):
+                if minloc < int(self.records[i]["id"].split("_")[1]) <= maxloc:
+                    records.append(i)
+        return records
+
+    def get_range(self, chrom: str, minloc: int, maxloc: int, samples: list = None) -> dict:
+        """
+        Returns a range of variants for all samples, same as vcf.VarFile.get_range
+
+        Args:
+            chrom (str): chromosome
+            minloc (int): starting position
+            maxloc (int): ending position
+            samples (list, optional): only return these samples (e.g. a chunk). Defaults to all samples.
+
+        Returns:
+            dict: variants with a common ID schema that is matched by other methods
+        """
+        positions_out = {}
+        samples = self.samples if samples is None else samples
+        for i in self._get_records(chrom, minloc, maxloc):
+            record = self.records[i]
+            alleles = np.asarray(self.alleles[i])
+            phased = np.asarray(self.phased[i])
+            phase_set = np.asarray(self.phase_set[i])
+            sample_genotypes = {}
+            for sample in samples:
+                try:
+                    j = self.sample_index[sample]
+                except KeyError:
+                    continue
+                codes = alleles[j]
+                if codes[0] == NO_SAMPLE:
+                    continue
+                elif codes[0] == NO_GENOTYPE:
+                    sample_alleles = None
+                else:
+                    sample_alleles = tuple(None if c == MISSING_ALLELE else record["alleles"][c] for c in codes if c != NO_ALLELE)
+                sample_genotypes[sample] = {
+                    "alleles": sample_alleles,
+                    "phased": bool(phased[j]),
+                    "phase_set": None if phase_set[j] == MISSING_PHASE_SET else int(phase_set[j]),
+                    "ref": record["ref"],
+                    "alts": tuple(record["alts"])}
+            positions_out.setdefault(record["id"], {}).update(sample_genotypes)
+        return positions_out
@@ -12,37 +12,189 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import multiprocessing
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
-from .haplotype import Haplotype, NoVariantsException
+from .haplotype import Haplotype, NoVariantsException, count_call
 from .gene import AbstractGene
 from . import LOGGING
+from . import memory
+
+# Genes (by name) and config of a gene worker process, set when the process starts (see GeneProcesses)
+_PROCESS_GENES = {}
+_PROCESS_CONFIG = None
+
+def _start_gene_process(genes: [AbstractGene], config) -> None:
+    global _PROCESS_GENES, _PROCESS_CONFIG
+    _PROCESS_GENES = {str(gene): gene for gene in genes}
+    _PROCESS_CONFIG = config
+
+def _solve_gene(gene_name: str, prefix: str) -> tuple:
+    haplotype = Haplotype(_PROCESS_GENES[gene_name], prefix, _PROCESS_CONFIG)
+    haplotype.table_matcher()
+    return haplotype.optimize_hap(), solve_stats(haplotype)
+
+def solve_stats(haplotype: Haplotype) -> dict:
+    """
+    Results of a solved haplotype, other than the calls
+
+    Args:
+        haplotype (Haplotype): matched and solved haplotype.Haplotype
+
+    Returns:
+        dict: REFS, TIMED_OUT, SOLVE_TIME, CANDIDATES, and TRACE (haplotype.trace_stats)
+    """
+    return {
+        "REFS": haplotype.refs,
+        "TIMED_OUT": haplotype.timed_out,
+        "SOLVE_TIME": haplotype.max_solve_time,
+        "CANDIDATES": haplotype.reduction_stats,
+        "TRACE": haplotype.trace_stats()}
+
+
+class GeneProcesses:
+
+    def __init__(self, genes: [AbstractGene], config, processes: int) -> None:
+        """
+        Worker processes that match and solve genes for Subject
+        Table matching holds the GIL, so genes called on threads (gene_workers) only overlap in the solver subprocesses. 
+        The processes are forked once with the genes and their variants loaded, a call only sends the gene name and sample ID. 
+        Only these gene objects can be solved (not gene views, e.g. the chunks of pipeline.Pipeline), 
+        and the fork start method is needed (not available on Windows). 
+
+        Args:
+            genes ([AbstractGene]): genes with variants
+            config (ConfigData): config.ConfigData object
+            processes (int): number of processes
+        """
+        self.genes = {str(gene): gene for gene in genes}
+        # Processes are forked here, before the gene threads of any subject run
+        self.pool = multiprocessing.get_context("fork").Pool(max(1, int(processes)), initializer = _start_gene_process, initargs = (genes, config))
+
+    def solve(self, gene: AbstractGene, prefix: str) -> tuple:
+        """
+        Match and solve a gene for a sample in a worker process
+
+        Args:
+            gene (AbstractGene): one of the genes the processes were started with
+            prefix (str): sample ID
+
+        Returns:
+            tuple: calls (as from Haplotype.optimize_hap) and solve_stats
+        """
+        if self.genes.get(str(gene)) is not gene:
+            raise ValueError(f"{gene} was not loaded in the gene processes")
+        haps, stats = self.pool.apply(_solve_gene, (str(gene), prefix))
+        count_call(stats["TRACE"]["fast_path"], stats["TRACE"]["fallback"])
+        return haps, stats
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
 
 class Subject:
 
-    def __init__(self, prefix: str, genes: [AbstractGene], config = None) -> None:
+    def __init__(self, prefix: str, genes: [AbstractGene], config = None, cache = None, previous = None, gene_workers: int = 1, trace = None, gene_processes = None) -> None:
         """
         Subject object - manages data and functions for a single sample in a VCF file
         
         Args:
             prefix (str): Subject ID (comes from the VCF file)
             genes ([Gene]): List of gene.Gene objects
+            cache (CallCache, optional): cache.CallCache of solved calls, looked up before matching and solving
+            previous (IncrementalCalls, optional): incremental.IncrementalCalls, calls from earlier translation tables that are carried forward
+            gene_workers (int, optional): number of genes called at the same time. Defaults to 1.
+            trace (TraceLog, optional): trace.TraceLog, one record is written per gene
+            gene_processes (GeneProcesses, optional): GeneProcesses that match and solve the genes (cache and previous calls are looked up here)
         """
         self.config = config
+        self.cache = cache
+        self.previous = previous
+        self.trace = trace
+        self.gene_processes = gene_processes
+        self.gene_workers = max(1, int(gene_workers))
         self.prefix = prefix
         self.called_haplotypes = {}
-        for gene in genes:
-            try:
+        with memory.stage("subject"):
+            self._call_genes(genes)
+
+    def _call_genes(self, genes: [AbstractGene]) -> None:
+        if self.gene_workers > 1 and len(genes) > 1:
+            # Solvers run as subprocesses (and with gene_processes, matching too), so genes are solved in parallel; results are kept in gene order
+            with ThreadPoolExecutor(max_workers = min(self.gene_workers, len(genes))) as executor:
+                calls = list(executor.map(self._call_gene, genes))
+        else:
+            calls = [self._call_gene(gene) for gene in genes]
+        for gene, call in zip(genes, calls):
+            self.called_haplotypes[str(gene)] = call
+
+    def _call_gene(self, gene: AbstractGene) -> dict:
+        if self.trace is None:
+            return self._get_call(gene)[0]
+        start = perf_counter()
+        call, source, stats = self._get_call(gene)
+        record = {"sample": self.prefix, "gene": str(gene), "version": gene.version, "source": source, "seconds": round(perf_counter() - start, 4)}
+        if stats is not None:
+            record.update(stats)
+        self.trace.write(record)
+        return call
+
+    def _get_call(self, gene: AbstractGene) -> tuple:
+        """
+        Call a gene
+
+        Returns:
+            tuple: call, source (previous, cache, solved, or no_variants), and the haplotype's trace_stats (None without variants)
+        """
+        try:
+            with memory.stage("match", str(gene)):
                 haplotype = Haplotype(gene, self.prefix, self.config)
-                haplotype.table_matcher()
-                self.called_haplotypes[str(gene)] = {
-                    "HAPS": haplotype.optimize_hap(),
-                    "CONTIG": gene.chromosome}
-            except NoVariantsException:
-                LOGGING.warning(f"{self.prefix} has no variants, returning NA")
-                self.called_haplotypes[str(gene)] = {
-                    "HAPS": ("NA", "NA", "NA", "NA"),
-                    "CONTIG": gene.chromosome}
+                if self.previous is not None:
+                    carried = self.previous.get(gene, haplotype)
+                    if carried is not None:
+                        return {**carried, "CONTIG": gene.chromosome}, "previous", haplotype.trace_stats()
+                if self.cache is not None:
+                    cache_key, cached = self.cache.get(gene, haplotype, self.config)
+                    if cached is not None:
+                        return {
+                            "HAPS": (cached["HAPS"][0], [tuple(v) for v in cached["HAPS"][1]]),
+                            "REFS": cached["REFS"],
+                            "TIMED_OUT": False,
+                            "SOLVE_TIME": 0,
+                            "CANDIDATES": cached["CANDIDATES"],
+                            "VERSION": gene.version,
+                            "CONTIG": gene.chromosome}, "cache", haplotype.trace_stats()
+                if self.gene_processes is None:
+                    haplotype.table_matcher()
+            with memory.stage("solve", str(gene)):
+                if self.gene_processes is not None:
+                    haps, stats = self.gene_processes.solve(gene, self.prefix)
+                else:
+                    haps = haplotype.optimize_hap()
+                    stats = solve_stats(haplotype)
+            if self.cache is not None and not stats["TIMED_OUT"]: # Time limited calls depend on machine load
+                self.cache.put(cache_key, {"HAPS": haps, "REFS": stats["REFS"], "CANDIDATES": stats["CANDIDATES"]})
+            return {
+                "HAPS": haps,
+                "REFS": stats["REFS"],
+                "TIMED_OUT": stats["TIMED_OUT"],
+                "SOLVE_TIME": stats["SOLVE_TIME"],
+                "CANDIDATES": stats["CANDIDATES"],
+                "VERSION": gene.version,
+                "CONTIG": gene.chromosome}, "solved", stats["TRACE"]
+        except NoVariantsException:
+            LOGGING.warning(f"{self.prefix} has no variants, returning NA")
+            return {
+                "HAPS": ("NA", "NA", "NA", "NA"),
+                "REFS": [],
+                "TIMED_OUT": False,
+                "SOLVE_TIME": 0,
+                "CANDIDATES": {"haplotypes": 0, "classes": 0},
+                "VERSION": gene.version,
+                "CONTIG": gene.chromosome}, "no_variants", None
 
     
     def __str__(self):
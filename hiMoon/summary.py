@@ -0,0 +1,117 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import csv
+from collections import Counter
+
+ALL_GROUP = "ALL"
+
+
+def read_groups(groups_path: str) -> dict:
+    """
+    Read a sample to group mapping (tab-delimited, sample then group, no header)
+
+    Args:
+        groups_path (str): path/to/mapping/file
+
+    Returns:
+        dict: sample ID -> group
+    """
+    groups = {}
+    with open(groups_path, "rt") as groups_file:
+        for row in csv.reader(groups_file, delimiter = "\t"):
+            if len(row) >= 2 and not row[0].startswith("#"):
+                groups[row[0]] = row[1]
+    return groups
+
+
+class CohortSummary:
+
+    def __init__(self, groups: dict = None) -> None:
+        """
+        Running haplotype and diplotype counts per gene and group
+        Subjects are added as they are called, memory depends only on the number of
+        distinct haplotypes/diplotypes, not the number of subjects.
+        When a subject has several possible genotypes, each is counted with weight 1 / (number of genotypes).
+
+        Args:
+            groups (dict, optional): sample ID -> group (e.g. population). Defaults to None.
+        """
+        self.groups = groups if groups else {}
+        self.counts = {}
+
+    def _get_counts(self, group: str, gene: str) -> dict:
+        try:
+            return self.counts[(group, gene)]
+        except KeyError:
+            self.counts[(group, gene)] = {
+                "subjects": Counter(),
+                "haplotype": Counter(),
+                "diplotype": Counter(),
+                "reference_fill": Counter()
+            }
+            return self.counts[(group, gene)]
+
+    def add(self, subject) -> None:
+        """
+        Add a called subject
+
+        Args:
+            subject (Subject): called subject
+        """
+        sample_groups = [ALL_GROUP]
+        if str(subject) in self.groups:
+            sample_groups.append(self.groups[str(subject)])
+        for gene, haps in subject.called_haplotypes.items():
+            calls = haps["HAPS"][0] if haps["HAPS"][0] != "NA" else []
+            refs = haps.get("REFS", [])
+            for group in sample_groups:
+                counts = self._get_counts(group, gene)
+                counts["subjects"]["total"] += 1
+                if len(calls) == 0:
+                    counts["subjects"]["no_call"] += 1
+                    continue
+                elif len(calls) > 1:
+                    counts["subjects"]["multi_call"] += 1
+                counts["subjects"]["called"] += 1
+                weight = 1 / len(calls)
+                for i, call in enumerate(calls):
+                    counts["diplotype"]["/".join(sorted(call))] += weight
+                    for hap in call:
+                        counts["haplotype"][hap] += weight
+                    if i < len(refs):
+                        counts["reference_fill"][str(refs[i])] += weight
+
+    def write(self, directory: str, prefix: str) -> None:
+        """
+        Write the summary to {prefix}.summary.tsv
+        FREQUENCY is relative to all subjects (subject rows), called subjects (diplotype and reference_fill rows),
+        or all called haplotypes (haplotype rows).
+
+        Args:
+            directory (str): output directory
+            prefix (str): prefix for filename
+        """
+        with open(directory + f"/{prefix}.summary.tsv", "w") as summary_out:
+            summary_file = csv.writer(summary_out, delimiter = "\t")
+            summary_file.writerow(["GROUP", "GENE", "CATEGORY", "NAME", "COUNT", "FREQUENCY"])
+            for (group, gene), counts in sorted(self.counts.items()):
+                total = counts["subjects"]["total"]
+                called = counts["subjects"]["called"]
+                n_haps = sum(counts["haplotype"].values())
+                for name in ["total", "called", "no_call", "multi_call"]:
+                    summary_file.writerow([group, gene, "subjects", name, counts["subjects"][name], round(counts["subjects"][name] / total, 6) if total else 0])
+                for category, denominator in [("haplotype", n_haps), ("diplotype", called), ("reference_fill", called)]:
+                    for name, count in counts[category].most_common():
+                        summary_file.writerow([group, gene, category, name, round(count, 6), round(count / denominator, 6) if denominator else 0])
@@ -0,0 +1,229 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import csv
+
+try:
+    import yaml
+except ImportError: # Optional, only needed for truth files
+    yaml = None
+
+from .haplotype import Haplotype, NoVariantsException, reset_phased_fallbacks, reset_fast_paths
+from . import LOGGING
+
+SWEEP_COLUMNS = ["SETTING", "SUBJECT", "GENE", "GENOTYPE", "VARIANTS", "CONFIDENCE", "TIMED_OUT", "MAX_SOLVE_TIME", "REFS"]
+CONCORDANCE_COLUMNS = ["SETTING", "GENE", "SAMPLES", "CONCORDANT", "UNIQUE", "CONCORDANCE"]
+
+
+def parse_settings(settings: str) -> list:
+    """
+    Parse LP parameter sets
+    Sets are separated by ";", parameters by ",", e.g. "max_haps=2;max_haps=3,optimal_decay=0.1"
+
+    Args:
+        settings (str): parameter sets
+
+    Returns:
+        list: one dict of LP parameters per set
+    """
+    parsed = []
+    for setting in settings.split(";"):
+        if not setting.strip():
+            continue
+        params = {}
+        for param in setting.split(","):
+            try:
+                key, value = param.split("=")
+            except ValueError:
+                raise ValueError(f"LP parameters must be given as name=value, got '{param}'")
+            params[key.strip()] = value.strip()
+        parsed.append(params)
+    return parsed
+
+
+def setting_name(params: dict) -> str:
+    """
+    Label of an LP parameter set (as in the SETTING column)
+    """
+    return ",".join(f"{key}={value}" for key, value in params.items())
+
+
+def rm_sub_allele(allele: str) -> str:
+    """
+    Remove suballele from a called named allele.
+    (star)2.001 -> (star)2
+    (star)2.001_x2 -> (star)2x2
+
+    Args:
+        allele (str): called allele
+
+    Returns:
+        str: allele without the suballele
+    """
+    sv = allele.split("_")[-1] if "_" in allele else None
+    main_allele = allele.split(".")[0]
+    return "".join([main_allele, sv]) if sv else main_allele
+
+
+def read_truth(truth_path: str) -> dict:
+    """
+    Read a truth file (YAML with GENE and SAMPLES (ID, ALLELES), as in tests/test_files)
+
+    Args:
+        truth_path (str): path/to/truth.yaml
+
+    Returns:
+        dict: full definition, with the parsed YAML keys
+    """
+    if yaml is None:
+        raise ImportError("Truth files require PyYAML (pip install pyyaml)")
+    with open(truth_path, "r") as truth_file:
+        try:
+            return yaml.load(truth_file, Loader = yaml.CLoader)
+        except AttributeError: # Happens if libyaml headers are not available
+            truth_file.seek(0)
+            return yaml.load(truth_file, Loader = yaml.Loader)
+
+
+def truth_alleles(definitions: list) -> dict:
+    """
+    Expected diplotypes from truth definitions
+
+    Args:
+        definitions (list): definitions from read_truth
+
+    Returns:
+        dict: (sample, gene) -> sorted alleles
+    """
+    truth = {}
+    for definition in definitions:
+        for sample in definition["SAMPLES"]:
+            truth[(sample["ID"], definition["GENE"])] = sorted(sample["ALLELES"])
+    return truth
+
+
+class ParameterSweep:
+
+    def __init__(self, settings: list, config = None) -> None:
+        """
+        Calls samples with several LP parameter sets
+        Genotypes are read and matched once per sample and gene, only the LP (lp_hap/optimize_hap)
+        is run for each parameter set. Time limits (solve_time_limit, sample_time_limit) come from the config.
+
+        Args:
+            settings (list): LP parameter dicts (e.g. from parse_settings)
+            config (ConfigData, optional): config.ConfigData object
+        """
+        self.settings = settings
+        self.config = config
+        self.rows = []
+        reset_phased_fallbacks()
+        reset_fast_paths()
+
+    def call(self, sample: str, genes: list) -> list:
+        """
+        Call a sample with every parameter set
+
+        Args:
+            sample (str): sample ID
+            genes (list): gene.AbstractGene objects with variants
+
+        Returns:
+            list: rows (SWEEP_COLUMNS) added for the sample
+        """
+        rows = []
+        for gene in genes:
+            try:
+                haplotype = Haplotype(gene, sample, self.config)
+                haplotype.table_matcher()
+            except NoVariantsException:
+                LOGGING.warning(f"{sample} has no variants, returning NA")
+                haplotype = None
+            for params in self.settings:
+                if haplotype is None:
+                    rows.append(self._row(params, sample, gene, ["NA"], [], "", 1, False, 0))
+                    continue
+                calls, variants = haplotype.optimize_hap(params)
+                for i in range(len(calls)):
+                    rows.append(self._row(
+                        params, sample, gene, calls[i], variants[i],
+                        haplotype.refs[i] if i < len(haplotype.refs) else "",
+                        len(calls), haplotype.timed_out, haplotype.max_solve_time))
+        self.rows += rows
+        return rows
+
+    def _row(self, params: dict, sample: str, gene, genotype: list, variants: list, refs, calls: int, timed_out: bool, solve_time: float) -> dict:
+        return {
+            "SETTING": setting_name(params),
+            "SUBJECT": sample,
+            "GENE": str(gene),
+            "GENOTYPE": "/".join(genotype),
+            "VARIANTS": "|".join(variants),
+            "CONFIDENCE": 1 / calls,
+            "TIMED_OUT": int(timed_out),
+            "MAX_SOLVE_TIME": round(solve_time, 3),
+            "REFS": refs}
+
+    def concordance(self, truth: dict) -> list:
+        """
+        Concordance of each parameter set with expected diplotypes
+        A sample is concordant if the expected diplotype is one of its calls (suballeles removed),
+        and unique if it is also the only call.
+
+        Args:
+            truth (dict): (sample, gene) -> sorted alleles, from truth_alleles
+
+        Returns:
+            list: rows (CONCORDANCE_COLUMNS), one per parameter set and gene
+        """
+        calls = {}
+        for row in self.rows:
+            if (row["SUBJECT"], row["GENE"]) not in truth:
+                continue
+            genotype = sorted(rm_sub_allele(a) for a in row["GENOTYPE"].split("/"))
+            calls.setdefault((row["SETTING"], row["GENE"], row["SUBJECT"]), []).append(genotype)
+        summary = {}
+        for (setting, gene, sample), genotypes in calls.items():
+            counts = summary.setdefault((setting, gene), {"samples": 0, "concordant": 0, "unique": 0})
+            concordant = truth[(sample, gene)] in genotypes
+            counts["samples"] += 1
+            counts["concordant"] += int(concordant)
+            counts["unique"] += int(concordant and len(genotypes) == 1)
+        return [{
+            "SETTING": setting,
+            "GENE": gene,
+            "SAMPLES": counts["samples"],
+            "CONCORDANT": counts["concordant"],
+            "UNIQUE": counts["unique"],
+            "CONCORDANCE": round(counts["concordant"] / counts["samples"], 4)} for (setting, gene), counts in summary.items()]
+
+    def write(self, directory: str, prefix: str, truth: dict = None) -> None:
+        """
+        Write calls to {prefix}.sweep.tsv, and the concordance to {prefix}.sweep_concordance.tsv if truth is given
+
+        Args:
+            directory (str): output directory
+            prefix (str): prefix for filename
+            truth (dict, optional): (sample, gene) -> sorted alleles, from truth_alleles. Defaults to None.
+        """
+        with open(directory + f"/{prefix}.sweep.tsv", "w") as sweep_out:
+            sweep_file = csv.DictWriter(sweep_out, SWEEP_COLUMNS, delimiter = "\t")
+            sweep_file.writeheader()
+            sweep_file.writerows(self.rows)
+        if truth is None:
+            return
+        with open(directory + f"/{prefix}.sweep_concordance.tsv", "w") as concordance_out:
+            concordance_file = csv.DictWriter(concordance_out, CONCORDANCE_COLUMNS, delimiter = "\t")
+            concordance_file.writeheader()
+            concordance_file.writerows(self.concordance(truth))
@@ -15,10 +15,14 @@
 import unittest
 import csv
 import os
+import tempfile
+import time
+import weakref
+from unittest import mock
 
 import pandas as pd
 
-from hiMoon import gene, vcf, subject, config, himoon, get_config
+from hiMoon import gene, vcf, subject, haplotype, index, store, summary, pipeline, memory, cache, incremental, sweep, trace, config, himoon, get_config
 
 CONFIG = get_config()
 
@@ -27,8 +31,36 @@ PATH = os.path.dirname(os.path.abspath(__file__))
 VCF = vcf.VarFile(PATH + "/test_files/vcf/test_samples.bcf")
 CYP2D6_TABLE = PATH + "/test_files/translation_tables/CYP2D6.NC_000022.11.haplotypes.tsv"
 GENE = gene.AbstractGene(CYP2D6_TABLE, vcf = VCF, config = CONFIG)
+# GRCh37 CYP2D6 table with CNV definitions (.cnv) and a VCF with matching SV calls
+GRCH37_VCF = PATH + "/test_files/vcf/test_samples.GRCh37.SV_SID.bcf"
+CYP2D6_CNV_TABLE = PATH + "/test_files/translation_tables/CYP2D6.NC_000022.10.haplotypes.tsv"
+CNV_VCF = vcf.VarFile(GRCH37_VCF)
+CNV_GENE = gene.AbstractGene(CYP2D6_CNV_TABLE, vcf = CNV_VCF, config = CONFIG)
+TABLE_COLUMNS = ["Haplotype Name", "Gene", "rsID", "ReferenceSequence", "Variant Start", "Variant Stop", "Reference Allele", "Variant Allele", "Type"]
+
 SUBJ = subject.Subject("NA12878", genes = [GENE], config = CONFIG)
 
+def eager_cnv_table(table_path: str) -> pd.DataFrame:
+    """
+    Translation table with every CNV haplotype (modifier x sub-allele) written out as rows, as read before CNV haplotypes were matched lazily
+    """
+    read = lambda path: pd.read_csv(path, skipinitialspace = True, delim_whitespace = True, skiprows = 2, na_values = {4: ".", 5: "."}, 
+        dtype = {4: pd.Int64Dtype(), 5: pd.Int64Dtype()}, names = TABLE_COLUMNS)
+    table = read(table_path)
+    cnv_table = read(table_path.replace(".tsv", ".cnv"))
+    table_bases = table["Haplotype Name"].str.split(".").str[0]
+    table_suffixes = table["Haplotype Name"].str.split(".").str[-1]
+    rows = []
+    for _, cnv_row in cnv_table.iterrows():
+        base, suffix = cnv_row["Haplotype Name"].split("_")[0], cnv_row["Haplotype Name"].split("_")[-1]
+        base_rows = table[table_bases == base]
+        rows += [dict(cnv_row, **{"Haplotype Name": f"{base}.{sub}_{suffix}"}) for sub in table_suffixes[base_rows.index]]
+        rows += [dict(row, **{"Haplotype Name": f"{base}.{table_suffixes[i]}_{suffix}"}) for i, row in base_rows.iterrows()]
+    plain_cnvs = cnv_table[~cnv_table["Haplotype Name"].str.contains("_")]
+    table = pd.concat([table, pd.DataFrame(rows, columns = TABLE_COLUMNS), plain_cnvs], ignore_index = True)
+    table["Haplotype Name"] = table["Haplotype Name"].str.replace("*", "(star)", regex = False)
+    return table
+
 class TestConfig(unittest.TestCase):
 
     def test_load(self):
@@ -54,7 +86,571 @@ class TestSubject(unittest.TestCase):
     def test_subject_prefix(self):
         self.assertEqual(SUBJ.prefix, "NA12878")
 
+    def test_gene_workers(self):
+        # A second gene that is solved too: the CYP2D6 table under another gene name
+        with tempfile.TemporaryDirectory() as table_dir:
+            with open(CYP2D6_TABLE) as table_in, open(table_dir + "/CYP2D6B.haplotypes.tsv", "w") as table_out:
+                table_out.write(table_in.read().replace("\tCYP2D6\t", "\tCYP2D6B\t"))
+            copy_gene = gene.AbstractGene(table_dir + "/CYP2D6B.haplotypes.tsv", vcf = VCF, config = CONFIG)
+        genes = [copy_gene, GENE]
+        serial = subject.Subject("NA12878", genes = genes, config = CONFIG)
+        concurrent = subject.Subject("NA12878", genes = genes, config = CONFIG, gene_workers = 2)
+        # Matched and solved in gene worker processes
+        gene_processes = subject.GeneProcesses(genes, CONFIG, 2)
+        solved = haplotype.fast_path_stats()
+        processes = subject.Subject("NA12878", genes = genes, config = CONFIG, gene_workers = 2, gene_processes = gene_processes)
+        self.assertEqual(sum(haplotype.fast_path_stats().values()) - sum(solved.values()), 2) # Counted in this process
+        with self.assertRaises(ValueError):
+            gene_processes.solve(GENE.with_variants(GENE.variants), "NA12878")
+        gene_processes.close()
+        for called in [concurrent, processes]:
+            self.assertEqual(list(called.called_haplotypes), ["CYP2D6B", "CYP2D6"])
+            for gene_name, call in serial.called_haplotypes.items():
+                self.assertIn("SOLVE_TIME", call) # Solved, not called without variants
+                self.assertEqual({k: v for k, v in called.called_haplotypes[gene_name].items() if k != "SOLVE_TIME"}, {k: v for k, v in call.items() if k != "SOLVE_TIME"})
+
+    def test_call_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            call_cache = cache.CallCache(cache_dir, max_entries = 1)
+            first = subject.Subject("NA12878", genes = [GENE], config = CONFIG, cache = call_cache)
+            call_cache.close()
+            call_cache = cache.CallCache(cache_dir, max_entries = 1)
+            second = subject.Subject("NA12878", genes = [GENE], config = CONFIG, cache = call_cache)
+            self.assertEqual(call_cache.stats()["hits"], 1)
+            self.assertEqual(second.called_haplotypes["CYP2D6"]["HAPS"], first.called_haplotypes["CYP2D6"]["HAPS"])
+            self.assertEqual(second.called_haplotypes["CYP2D6"]["REFS"], first.called_haplotypes["CYP2D6"]["REFS"])
+            # The access time of a hit is written on close, not on every lookup
+            self.assertEqual(len(call_cache.accessed), 1)
+            self.assertEqual(call_cache.connection.execute("SELECT hits FROM calls").fetchone()[0], 0)
+            call_cache.close()
+            call_cache = cache.CallCache(cache_dir, max_entries = 1)
+            self.assertEqual(call_cache.connection.execute("SELECT hits FROM calls").fetchone()[0], 1)
+            call_cache.close()
+
+    def test_cache_entries(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            call_cache = cache.CallCache(cache_dir, max_entries = 2)
+            first = ("CYP2D6", "1", "a", "p1")
+            call_cache.put(first, {"HAPS": []})
+            # Two workers that missed on the same key both add it
+            call_cache.put(("CYP2D6", "1", "a", "p2"), {"HAPS": []})
+            call_cache.put(("CYP2D6", "1", "a", "p2"), {"HAPS": []})
+            self.assertEqual(call_cache.stats()["entries"], 2)
+            self.assertEqual(call_cache.stats()["evictions"], 0)
+            self.assertIsNotNone(call_cache.connection.execute("SELECT 1 FROM calls WHERE pattern = 'p1'").fetchone())
+            # A hit that is not yet written still counts when put evicts
+            call_cache.accessed[first] = (time.time() + 1, 1)
+            call_cache.put(("CYP2D6", "1", "a", "p3"), {"HAPS": []})
+            self.assertEqual(call_cache.stats()["evictions"], 1)
+            self.assertEqual(call_cache.accessed, {})
+            self.assertIsNone(call_cache.connection.execute("SELECT 1 FROM calls WHERE pattern = 'p2'").fetchone())
+            self.assertEqual(call_cache.connection.execute("SELECT hits FROM calls WHERE pattern = 'p1'").fetchone()[0], 1)
+            # Configs are told apart by their contents
+            other_config = get_config()
+            other_config.config["LINEAR PROGRAM PARAMETERS"]["max_haps"] = "3"
+            haplotype_obj = haplotype.Haplotype(GENE, "NA12878", CONFIG)
+            self.assertNotEqual(call_cache._key(GENE, haplotype_obj, CONFIG)[2], call_cache._key(GENE, haplotype_obj, other_config)[2])
+            call_cache.close()
+
+    def test_cache_key_resolution(self):
+        # Without records every row is missing, calls solved with other records must not be used
+        self.assertNotEqual(cache.config_hash(CONFIG, GENE.with_variants({})), cache.config_hash(CONFIG, GENE))
+        self.assertEqual(cache.config_hash(CONFIG, GENE.with_variants(GENE.variants)), cache.config_hash(CONFIG, GENE))
+
+class TestPipeline(unittest.TestCase):
+
+    def test_pipeline(self):
+        single_vcf = vcf.VarFile(PATH + "/test_files/vcf/test_samples.bcf", "NA12878")
+        subjects = []
+        pipeline.Pipeline(single_vcf, [GENE], config = CONFIG, chunk_size = 1, workers = 2).run(subjects.append)
+        self.assertEqual([str(s) for s in subjects], ["NA12878"])
+        self.assertEqual(subjects[0].called_haplotypes[str(GENE)]["HAPS"], SUBJ.called_haplotypes[str(GENE)]["HAPS"])
+
+    def test_pipeline_window(self):
+        # The first chunk is slow, the chunks after it are not decoded more than queue_size + workers ahead of the writer
+        samples = CNV_VCF.samples[:10]
+        decoded, written, ahead = [], [], []
+        get_chunk_genes = pipeline.get_chunk_genes
+        def chunk_genes(vcf_file, genes, chunk):
+            decoded.append(chunk)
+            ahead.append(len(decoded) - len(written))
+            return get_chunk_genes(vcf_file, genes, chunk)
+        def slow_subject(prefix, **kwargs):
+            if prefix == samples[0]:
+                time.sleep(1)
+            return subject.Subject(prefix, **kwargs)
+        with mock.patch.object(pipeline, "get_chunk_genes", chunk_genes), mock.patch.object(pipeline, "Subject", slow_subject):
+            pipeline.Pipeline(vcf.VarFile(GRCH37_VCF, samples), [CNV_GENE], config = CONFIG, chunk_size = 1, workers = 2, queue_size = 1).run(written.append)
+        self.assertEqual([str(s) for s in written], samples)
+        self.assertEqual(max(ahead), 1 + 2)
+
+    def test_call_chunks(self):
+        subjects = []
+        pipeline.call_chunks(VCF.for_samples(["NA12878"]), [GENE], subjects.append, config = CONFIG, chunk_size = 1)
+        self.assertEqual([str(s) for s in subjects], ["NA12878"])
+        self.assertEqual(subjects[0].called_haplotypes[str(GENE)]["HAPS"], SUBJ.called_haplotypes[str(GENE)]["HAPS"])
+
+    def test_get_chunk_genes(self):
+        chunk = VCF.samples[:2]
+        chunk_gene = pipeline.get_chunk_genes(VCF, [GENE], chunk)[0]
+        self.assertEqual(chunk_gene.variants, {var_id: {s: g for s, g in genotypes.items() if s in chunk} for var_id, genotypes in GENE.variants.items()})
+
+    def test_chunk_samples(self):
+        self.assertEqual(pipeline.chunk_samples(["a", "b", "c"], 2), [["a", "b"], ["c"]])
+
 class TestVCF(unittest.TestCase):
 
     def test_samples(self):
         self.assertEqual(VCF.samples[0], "HG00111")
+
+    def test_multiple_files(self):
+        multi_vcf = vcf.VarFile([PATH + "/test_files/vcf/test_samples.bcf"] * 2)
+        self.assertEqual(multi_vcf.samples, VCF.samples)
+        self.assertEqual(multi_vcf.get_range("22", GENE.min, GENE.max), GENE.variants)
+
+    def test_text_reader(self):
+        text_vcf = vcf.VarFile(PATH + "/test_files/vcf/test_samples.bcf", reader = "text")
+        self.assertEqual(text_vcf.get_range(GENE.chromosome, GENE.min, GENE.max), GENE.variants)
+        # Only the requested sample columns are decoded
+        for samples in (VCF.samples[-1:], []):
+            self.assertEqual(text_vcf.get_range(GENE.chromosome, GENE.min, GENE.max, samples = samples), VCF.get_range(GENE.chromosome, GENE.min, GENE.max, samples = samples))
+        with self.assertRaises(TypeError):
+            vcf.RecordReader()
+
+    def test_stream(self):
+        stream_vcf = vcf.VarFile(PATH + "/test_files/vcf/test_samples.bcf", stream = True)
+        stream_gene = gene.AbstractGene(CYP2D6_TABLE, vcf = stream_vcf, config = CONFIG)
+        stream_vcf.fill_genes([stream_gene])
+        self.assertEqual(stream_gene.variants, GENE.variants)
+
+class TestStore(unittest.TestCase):
+
+    def test_store_round_trip(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            store.write_store(store_dir, [GENE], VCF.samples)
+            region_store = store.RegionStore(store_dir)
+            self.assertEqual(region_store.samples, VCF.samples)
+            self.assertEqual(region_store.get_range(GENE.chromosome, GENE.min, GENE.max), GENE.variants)
+
+class TestHaplotype(unittest.TestCase):
+
+    def test_shared_translation_table(self):
+        hap = haplotype.Haplotype(CNV_GENE, "HG00463", config = CONFIG)
+        hap.table_matcher()
+        assert "MATCH" not in CNV_GENE.translation_table.columns
+        # Only the matched rows of the table, CNV haplotypes (e.g. *2.001_x2) are a sub-allele plus a modifier
+        assert len(hap.modifiers) > 0
+        self.assertEqual(hap.translation_table.shape[0], hap.row_mask.sum())
+
+    def test_cnv_combinations(self):
+        eager_gene = gene.AbstractGene(eager_cnv_table(CYP2D6_CNV_TABLE), vcf = CNV_VCF, config = CONFIG)
+        # Combinations are not stored in the table, only the modifier rows at its end
+        assert len(CNV_GENE.cnv_rows) > 0
+        self.assertLess(CNV_GENE.translation_table.shape[0], eager_gene.translation_table.shape[0])
+        columns = TABLE_COLUMNS + ["VAR_ID"]
+        self.assertEqual(CNV_GENE.get_full_table()[columns].astype(str).values.tolist(), eager_gene.translation_table[columns].astype(str).values.tolist())
+        # Same calls as solving the written out table, without matching combination rows
+        calls = lambda hap: sorted(zip(*[map(tuple, result) for result in hap.optimize_hap()]))
+        for sample in ["HG00463", "HG00337", "HG00421", "NA12717"]:
+            for phased in [False, True]:
+                lazy = haplotype.Haplotype(CNV_GENE, sample, config = CONFIG)
+                eager = haplotype.Haplotype(eager_gene, sample, config = CONFIG)
+                lazy.phased = eager.phased = phased
+                lazy.table_matcher()
+                eager.table_matcher()
+                assert not lazy.translation_table.iloc[:,0].isin(CNV_GENE.cnv_names).any()
+                self.assertEqual(calls(lazy), calls(eager))
+                # One variable per modifier a sub-allele can carry instead of one per CNV haplotype
+                self.assertLessEqual(lazy.problems[0]["variables"], eager.problems[0]["variables"])
+                if lazy.problems[0]["modifiers"] > 0:
+                    self.assertLess(lazy.problems[0]["variables"], eager.problems[0]["variables"])
+
+    def test_cnv_lp_size(self):
+        # A sample with two copy number alleles, solved with one and then two matching modifiers per base allele
+        sample = "HG00463"
+        variants = {var_id: {sample: dict(genotypes[sample])} for var_id, genotypes in CNV_GENE.variants.items()}
+        variants["c22_42523949_CNV"][sample]["alleles"] = ("<CN3>", "<CN4>")
+        cnv_lines = open(CYP2D6_CNV_TABLE.replace(".tsv", ".cnv")).read().splitlines()
+        sizes = []
+        with tempfile.TemporaryDirectory() as tmp:
+            table_path = os.path.join(tmp, "CYP2D6.haplotypes.tsv")
+            with open(CYP2D6_CNV_TABLE) as table, open(table_path, "w") as out:
+                out.write(table.read())
+            for copies in [(3,), (3, 4)]:
+                with open(table_path.replace(".tsv", ".cnv"), "w") as out:
+                    out.write("\n".join(cnv_lines + [l.replace("_x2", f"_x{n}").replace("<CN2>", f"<CN{n}>") for n in copies for l in cnv_lines if "_x2" in l]) + "\n")
+                haps = [haplotype.Haplotype(gene.AbstractGene(table, variants = variants, config = CONFIG), sample, config = CONFIG) for table in [table_path, eager_cnv_table(table_path)]]
+                for hap in haps:
+                    hap.table_matcher()
+                lazy, eager = haps
+                self.assertEqual(sorted(map(tuple, lazy.optimize_hap()[0])), sorted(map(tuple, eager.optimize_hap()[0])))
+                self.assertEqual(lazy.translation_table.shape[0], lazy.row_mask.sum())
+                self.assertEqual(lazy.problems[0]["modifiers"], len(lazy.modifiers))
+                sizes.append([(p["classes"] + p["modifiers"], p["variables"]) for p in (lazy.problems[0], eager.problems[0])])
+        (lazy_one, eager_one), (lazy_two, eager_two) = sizes
+        self.assertLess(lazy_one[1], eager_one[1])
+        self.assertLess(lazy_two[1], eager_two[1])
+        # Each added definition adds at most its modifier and its CNV haplotype with only the modifier row, not one per sub-allele
+        self.assertLessEqual(lazy_two[0] - lazy_one[0], 2 * 2)
+        self.assertLess(lazy_two[0] - lazy_one[0], eager_two[0] - eager_one[0])
+
+    def test_record_resolution(self):
+        # Number of diplotypes and of variants (summed over diplotypes) with exact record IDs, as before the positional index
+        baseline = {"NA19238": (102, 1938), "NA12717": (34, 612), "HG00436": (1, 703)}
+        nearby_config = get_config()
+        nearby_config.VARIANT_QUERY_PARAMETERS["nearby_records"] = "1"
+        for resolve_config in [CONFIG, nearby_config]:
+            cohort_gene = CNV_GENE if resolve_config is CONFIG else gene.AbstractGene(CYP2D6_CNV_TABLE, vcf = CNV_VCF, config = resolve_config)
+            for sample, counts in baseline.items():
+                calls = subject.Subject(sample, genes = [cohort_gene], config = resolve_config).called_haplotypes[str(cohort_gene)]["HAPS"]
+                if resolve_config is CONFIG:
+                    self.assertEqual((len(calls[0]), sum(len(v) for v in calls[1])), counts)
+                # Resolution does not depend on the other samples that are loaded
+                sample_gene = gene.AbstractGene(CYP2D6_CNV_TABLE, vcf = vcf.VarFile(GRCH37_VCF, sample), config = resolve_config)
+                self.assertEqual(subject.Subject(sample, genes = [sample_gene], config = resolve_config).called_haplotypes[str(sample_gene)]["HAPS"], calls)
+
+    def test_record_index(self):
+        genotype = {"alleles": ("C", "C"), "phased": False, "phase_set": None, "ref": "C", "alts": ("CAG",)}
+        record_index = index.RecordIndex({"c22_100_SID": {"S1": genotype}}, CONFIG.IUPAC_CODES, nearby = True)
+        self.assertEqual(record_index.resolve("c22_100_SID", "insertion", 101, 102, "-", "AG"), (0, frozenset(["CAG"])))
+        # A rotated insertion one base to the right, without reference bases to show it is in a repeat
+        self.assertEqual(record_index.resolve("c22_101_SID", "insertion", 101, 102, "-", "GA"), (index.MISSING_RECORD, frozenset()))
+        self.assertEqual(record_index.keys, ["c22_100_SID"])
+        # AT inserted after 100 in ATAT (the REF of the SNV at 101), and unique sequence (the REF of the MNV at 110)
+        variants = {
+            "c22_100_SID": {"S1": dict(genotype, ref = "C", alts = ("CAT",))},
+            "c22_101_SID": {"S1": dict(genotype, ref = "ATATG", alts = ("GTATG",))},
+            "c22_110_SID": {"S1": dict(genotype, ref = "TAGCATCGAC", alts = ("CAGCATCGAC",))}}
+        record_index = index.RecordIndex(variants, CONFIG.IUPAC_CODES, nearby = True)
+        self.assertEqual(record_index.resolve("c22_99_SID", "insertion", 101, 102, "-", "TA"), (0, frozenset(["CAT"])))
+        self.assertEqual(record_index.resolve("c22_98_SID", "insertion", 102, 103, "-", "AT"), (0, frozenset(["CAT"])))
+        self.assertEqual(record_index.resolve("c22_99_SID", "insertion", 101, 102, "-", "GA"), (index.MISSING_RECORD, frozenset()))
+        # A rotation that is not in a repeat is a different insertion
+        self.assertEqual(record_index.resolve("c22_112_SID", "insertion", 113, 114, "-", "TA"), (index.MISSING_RECORD, frozenset()))
+        self.assertEqual(record_index.resolve("c22_115_SID", "insertion", 115, 116, "-", "TA"), (index.MISSING_RECORD, frozenset()))
+        self.assertEqual(record_index.resolve("c22_115_SID", "insertion", 115, 116, "-", "AT"), (index.MISSING_RECORD, frozenset()))
+
+    def test_sparse_lp(self):
+        # n haplotypes with one variant each and one with all n variants: 2n non-zeros of (n + 1) x n
+        for n in [10, 40]:
+            rows = [[f"GENE*{k + 2}", "GENE", f"rs{k}", "NC_000022.11", 100 + k, 100 + k, "C", "T", "substitution"] for k in range(n)]
+            rows += [["GENE*99", "GENE", f"rs{k}", "NC_000022.11", 100 + k, 100 + k, "C", "T", "substitution"] for k in range(n)]
+            table = pd.DataFrame(rows, columns = TABLE_COLUMNS).astype({"Variant Start": pd.Int64Dtype(), "Variant Stop": pd.Int64Dtype()})
+            variants = {f"c22_{100 + k}_SID": {"S1": {"alleles": ("C", "T"), "phased": False, "phase_set": None, "ref": "C", "alts": ("T",)}} for k in range(n)}
+            hap = haplotype.Haplotype(gene.AbstractGene(table, variants = variants, config = CONFIG), "S1", config = CONFIG)
+            hap.table_matcher()
+            self.assertEqual(hap.optimize_hap()[0], [["GENE*99", "REF"]])
+            problem = hap.problems[0]
+            self.assertEqual(problem["nonzeros"], 2 * n)
+            # Constraint terms follow the non-zeros, not haplotypes x variants
+            self.assertLessEqual(problem["terms"], 4 * problem["nonzeros"])
+        self.assertLess(problem["terms"], problem["classes"] * n)
+
+    def test_nearby_records(self):
+        # Rows described by a record at another position: an insertion shifted left in a CA repeat (the record's REF),
+        # a substitution inside a longer MNV, a deletion shifted right in a GT repeat, and a <DEL> called 5 bp away
+        rows = [
+            ["GENE*2", "GENE", "rs2", "NC_000022.11", 302, 303, "-", "CA", "insertion"],
+            ["GENE*3", "GENE", "rs3", "NC_000022.11", 403, 403, "T", "A", "substitution"],
+            ["GENE*4", "GENE", "rs4", "NC_000022.11", 503, 504, "GT", "-", "deletion"],
+            ["GENE*5", "GENE", "rs5", "NC_000022.11", 600, 700, "A", "<DEL>", "CNV"]]
+        table = pd.DataFrame(rows, columns = TABLE_COLUMNS).astype({"Variant Start": pd.Int64Dtype(), "Variant Stop": pd.Int64Dtype()})
+        records = {"c22_300_SID": ("GCACAC", "GCACACAC", "S2"), "c22_400_SID": ("ACGT", "TCGA", "S3"), "c22_500_SID": ("TGT", "T", "S4"), "c22_605_DEL": ("A", "<DEL>", "S5")}
+        variants = {var_id: {sample: {"alleles": (ref, alt if sample == carrier else ref), "phased": False, "phase_set": None, "ref": ref, "alts": (alt,)}
+            for _, _, sample in records.values()} for var_id, (ref, alt, carrier) in records.items()}
+        nearby_config = get_config()
+        nearby_config.VARIANT_QUERY_PARAMETERS["nearby_records"] = "1"
+        for resolve_config in [CONFIG, nearby_config]:
+            nearby_gene = gene.AbstractGene(table.copy(), variants = variants, config = resolve_config)
+            codes, _, keys = nearby_gene.resolve_rows()[:3]
+            if resolve_config is CONFIG:
+                # Same as looking up each row's ID, none of the records is at a row's ID
+                self.assertEqual(list(codes), [keys.index(match_id) if match_id in keys else index.MISSING_RECORD for match_id in nearby_gene.translation_table["MATCH_ID"]])
+            else:
+                self.assertEqual(list(codes), [0, 1, 2, 3])
+            for name, (_, _, sample) in zip(table["Haplotype Name"], records.values()):
+                hap = haplotype.Haplotype(nearby_gene, sample, config = resolve_config)
+                hap.table_matcher()
+                self.assertEqual(hap.optimize_hap()[0], [["REF", "REF"]] if resolve_config is CONFIG else [[name, "REF"]])
+
+    def test_variants_without_alts(self):
+        # Variants from another input, in the format without the record's ALT alleles
+        for sample in ["HG00463", "HG00337"]:
+            variants = {var_id: {sample: {key: genotypes[sample][key] for key in ["alleles", "phased", "phase_set", "ref"]}} for var_id, genotypes in CNV_GENE.variants.items()}
+            self.assertEqual(himoon.get_haps_from_variants(CYP2D6_CNV_TABLE, variants, sample), himoon.get_haps_from_vcf(CYP2D6_CNV_TABLE, GRCH37_VCF, sample))
+
+    def test_variant_index(self):
+        row_variants, _, _, variant_haps = GENE.get_variant_index()
+        for variant, hap_code in zip(row_variants, GENE.hap_codes):
+            assert variant_haps[variant] >> int(hap_code) & 1
+        self.assertEqual(index.bits_to_mask(0b101, 4).tolist(), [True, False, True, False])
+
+    def test_hap_classes(self):
+        hap = haplotype.Haplotype(GENE, "NA12878", config = CONFIG)
+        hap.table_matcher()
+        called, variants = hap.optimize_hap()
+        self.assertLessEqual(hap.reduction_stats["classes"], hap.reduction_stats["haplotypes"])
+        self.assertEqual(len(called), len(set(tuple(c) for c in called)))
+        # Two sub-alleles with the same variant are one class, each is called for both haplotypes, never mixed
+        rows = [
+            ["GENE*2.001", "GENE", "rs1", "NC_000022.11", 100, 100, "C", "T", "substitution"],
+            ["GENE*2.002", "GENE", "rs1", "NC_000022.11", 100, 100, "C", "T", "substitution"],
+            ["GENE*3", "GENE", "rs2", "NC_000022.11", 200, 200, "C", "T", "substitution"]]
+        table = pd.DataFrame(rows, columns = TABLE_COLUMNS).astype({"Variant Start": pd.Int64Dtype(), "Variant Stop": pd.Int64Dtype()})
+        genotypes = {"HOM": [("T", "T"), ("C", "C")], "HET": [("C", "T"), ("T", "C")]}
+        variants = {f"c22_{pos}_SID": {sample: {"alleles": alleles[i], "phased": True, "phase_set": 1, "ref": "C", "alts": ("T",)} for sample, alleles in genotypes.items()} 
+            for i, pos in enumerate([100, 200])}
+        expected = {
+            "HOM": ([["GENE*2.001", "GENE*2.001"], ["GENE*2.002", "GENE*2.002"]], {"haplotypes": 2, "classes": 1}),
+            "HET": ([["GENE*2.001", "GENE*3"], ["GENE*2.002", "GENE*3"]], {"haplotypes": 3, "classes": 2})}
+        for phased in [False, True]:
+            class_gene = gene.AbstractGene(table, variants = variants, config = CONFIG, phased = phased)
+            for sample, (calls, reduction_stats) in expected.items():
+                hap = haplotype.Haplotype(class_gene, sample, config = CONFIG)
+                hap.table_matcher()
+                self.assertEqual(hap.optimize_hap()[0], calls)
+                self.assertEqual(hap.reduction_stats, reduction_stats)
+                self.assertEqual(hap.class_members["GENE*2.001"], ["GENE*2.001", "GENE*2.002"])
+        # Samples with a class of several sub-alleles used for both haplotypes (e.g. *1.001/*1.001 and *1.005/*1.005)
+        for sample in ["HG00111", "NA06989", "NA12717"]:
+            for phased in [False, True]:
+                hap = haplotype.Haplotype(CNV_GENE, sample, config = CONFIG)
+                hap.phased = phased
+                hap.table_matcher()
+                called, variants = hap.optimize_hap()
+                self.assertLess(hap.reduction_stats["classes"], hap.reduction_stats["haplotypes"])
+                assert any(len(members) > 1 and call[0] == call[1] and call[0] in members for call in called for members in hap.class_members.values())
+
+    def test_phased_precheck(self):
+        hap = haplotype.Haplotype(GENE, "NA12878", config = CONFIG)
+        hap.table_matcher()
+        has_cnv = bool((hap.variants["Type"] == "CNV").any())
+        self.assertTrue(hap._covers_cnvs([tuple(range(hap.variants.shape[0]))]))
+        self.assertEqual(hap._covers_cnvs([]), not has_cnv)
+        # Counts are kept per run
+        haplotype.reset_phased_fallbacks()
+        self.assertEqual(haplotype.phased_fallback_stats(), {"triggered": 0, "avoided": 0})
+        # *2 has its two variants on different strands of a phase set. S1 has one <DEL>, only *2 covers it (avoided).
+        # S2 has two, *4 covers them too, so the phased LP is solved, is infeasible, and solved again unphased (triggered).
+        rows = [
+            ["GENE*2", "GENE", "rs1", "NC_000022.11", 100, 100, "C", "T", "substitution"],
+            ["GENE*2", "GENE", "rs2", "NC_000022.11", 200, 200, "C", "T", "substitution"],
+            ["GENE*2", "GENE", "rs3", "NC_000022.11", 600, 700, "A", "<DEL>", "CNV"],
+            ["GENE*3", "GENE", "rs1", "NC_000022.11", 100, 100, "C", "T", "substitution"],
+            ["GENE*4", "GENE", "rs4", "NC_000022.11", 300, 300, "C", "T", "substitution"],
+            ["GENE*4", "GENE", "rs3", "NC_000022.11", 600, 700, "A", "<DEL>", "CNV"]]
+        table = pd.DataFrame(rows, columns = TABLE_COLUMNS).astype({"Variant Start": pd.Int64Dtype(), "Variant Stop": pd.Int64Dtype()})
+        genotypes = {"S1": [("C", "T"), ("T", "C"), ("C", "C"), ("A", "<DEL>")], "S2": [("C", "T"), ("T", "C"), ("C", "T"), ("<DEL>", "<DEL>")]}
+        variants = {f"c22_{pos}_SID": {sample: {"alleles": alleles[i], "phased": True, "phase_set": 1, "ref": "C", "alts": ("T",)} for sample, alleles in genotypes.items()} 
+            for i, pos in enumerate([100, 200, 300])}
+        variants["c22_600_CNV"] = {sample: {"alleles": alleles[3], "phased": False, "phase_set": None, "ref": "A", "alts": ("<DEL>",)} for sample, alleles in genotypes.items()}
+        expected = {"S1": ("avoided", [["GENE*2", "REF"]]), "S2": ("triggered", [["GENE*2", "GENE*4"]])}
+        for sample, (fallback, calls) in expected.items():
+            results = []
+            for phased in [True, False]:
+                hap = haplotype.Haplotype(gene.AbstractGene(table, variants = variants, config = CONFIG, phased = phased), sample, config = CONFIG)
+                hap.table_matcher()
+                before = haplotype.phased_fallback_stats()
+                results.append(hap.optimize_hap())
+                after = haplotype.phased_fallback_stats()
+                if phased:
+                    self.assertFalse(hap._get_strand_constraint(hap.haplotypes.index("GENE*2")))
+                    self.assertEqual(hap.fallback, fallback)
+                    self.assertEqual({kind: after[kind] - before[kind] for kind in after}, {kind: int(kind == fallback) for kind in after})
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[0][0], calls)
+
+    def test_fast_path(self):
+        # Counts are kept per run
+        haplotype.reset_fast_paths()
+        self.assertEqual(haplotype.fast_path_stats(), {"reference": 0, "single": 0, "solved": 0})
+        # One candidate haplotype (*2, two variants), for samples without its variants, with them, and phased on both strands
+        rows = [
+            ["GENE*2", "GENE", "rs1", "NC_000022.11", 100, 100, "C", "T", "substitution"],
+            ["GENE*2", "GENE", "rs2", "NC_000022.11", 200, 200, "C", "T", "substitution"]]
+        table = pd.DataFrame(rows, columns = TABLE_COLUMNS).astype({"Variant Start": pd.Int64Dtype(), "Variant Stop": pd.Int64Dtype()})
+        # *5 (rs1 only) is a second candidate for the samples with variants, so their calls are solved
+        solved_table = pd.concat([table, pd.DataFrame([["GENE*5", "GENE", "rs1", "NC_000022.11", 100, 100, "C", "T", "substitution"]], columns = TABLE_COLUMNS)], 
+            ignore_index = True).astype({"Variant Start": pd.Int64Dtype(), "Variant Stop": pd.Int64Dtype()})
+        genotypes = {"REF": [("C", "C"), ("C", "C")], "HET": [("C", "T"), ("C", "T")], "HOM": [("T", "T"), ("T", "T")], "TRANS": [("C", "T"), ("T", "C")]}
+        variants = {f"c22_{pos}_SID": {sample: {"alleles": alleles[i], "phased": True, "phase_set": 1, "ref": "C", "alts": ("T",)} for sample, alleles in genotypes.items()} 
+            for i, pos in enumerate([100, 200])}
+        expected = {"REF": ("reference", [["REF", "REF"]]), "HET": ("single", [["GENE*2", "REF"]]), "HOM": ("single", [["GENE*2", "GENE*2"]]), "TRANS": ("single", [["GENE*2", "REF"]])}
+        for phased in [False, True]:
+            fast_gene = gene.AbstractGene(table, variants = variants, config = CONFIG, phased = phased)
+            solved_gene = gene.AbstractGene(solved_table, variants = variants, config = CONFIG, phased = phased)
+            # Phased, *2 is out of phase for TRANS, it is left to the LP (which drops it)
+            expected["TRANS"] = (None, [["REF", "REF"]]) if phased else expected["TRANS"]
+            for sample, (fast_path, calls) in expected.items():
+                hap = haplotype.Haplotype(fast_gene, sample, config = CONFIG)
+                hap.table_matcher()
+                called = hap.optimize_hap()
+                self.assertEqual(called[0], calls)
+                self.assertEqual(hap.fast_path, fast_path)
+                if fast_path == "single":
+                    # Same call and variants as solving the LP
+                    solved = haplotype.Haplotype(solved_gene, sample, config = CONFIG)
+                    solved.table_matcher()
+                    self.assertEqual(solved.optimize_hap(), called)
+                    self.assertIsNone(solved.fast_path)
+        # A fast path call is complete, a used up sample budget does not flag it as timed out
+        budget_config = get_config()
+        budget_config.LP_PARAMS["sample_time_limit"] = 1e-6
+        hap = haplotype.Haplotype(fast_gene, "HOM", config = budget_config)
+        hap.table_matcher()
+        self.assertEqual(hap.optimize_hap()[0], [["GENE*2", "GENE*2"]])
+        self.assertEqual(hap.fast_path, "single")
+        self.assertFalse(hap.timed_out)
+
+    def test_sample_time_limit(self):
+        budget_config = get_config()
+        budget_config.LP_PARAMS["sample_time_limit"] = 1e-6
+        hap = haplotype.Haplotype(GENE, "NA12878", config = budget_config)
+        hap.table_matcher()
+        called, variants = hap.optimize_hap()
+        assert hap.timed_out
+        self.assertLessEqual(len(set(variants)), 1) # Only the first solution (expanded to its class members)
+        assert hap.max_solve_time > 0
+
+class TestOutput(unittest.TestCase):
+
+    @unittest.skipIf(vcf.pa is None, "pyarrow is not installed")
+    def test_columnar_output(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            writer = vcf.ColumnarWriter(out_dir, "test", row_group_size = 1)
+            writer.write(SUBJ)
+            writer.close()
+            table = vcf.pq.read_table(out_dir + "/test.haplotypes.parquet")
+        self.assertEqual(table.num_rows, len(SUBJ.called_haplotypes[str(GENE)]["HAPS"][0]))
+        self.assertEqual(table.column("subject")[0].as_py(), "NA12878")
+
+    def test_compressed_variant_file(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            vcf.write_variant_file(out_dir, [SUBJ], "test", [GENE], compress = True)
+            assert os.path.exists(out_dir + "/test.haplotypes.vcf.gz.csi")
+            records = list(vcf.VariantFile(out_dir + "/test.haplotypes.vcf.gz").fetch(f"chr{GENE.chromosome}", GENE.min, GENE.max))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(list(records[0].samples), ["NA12878"])
+
+    def test_flat_file_columns(self):
+        # The original columns keep their positions, new ones are appended
+        with tempfile.TemporaryDirectory() as out_dir:
+            writer = vcf.FlatFileWriter(out_dir, "cols")
+            writer.close()
+            with open(out_dir + "/cols.haplotypes.tsv") as flat_in:
+                header = flat_in.readline().rstrip("\n").split("\t")
+        self.assertEqual(header[:5], ["SUBJECT", "GENE", "GENOTYPE", "VARIANTS", "CONFIDENCE"])
+        self.assertEqual(header, vcf.FLAT_FILE_COLUMNS)
+
+    def test_read_baseline_flat_file(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            # Columns of flat files written before TIMED_OUT, MAX_SOLVE_TIME, REFS, and VERSION
+            with open(out_dir + "/old.haplotypes.tsv", "w") as old_file:
+                old_file.write("SUBJECT\tGENE\tGENOTYPE\tVARIANTS\tCONFIDENCE\n")
+                old_file.write("S1\tCYP2D6\tCYP2D6(star)1/CYP2D6(star)4.001\tc22_1_SID_A_G|c22_2_SID_C_T\t1.0\n")
+                old_file.write("S2\tCYP2D6\tN\t\t0.5\n")
+                old_file.write("S2\tCYP2D6\tA\t\t0.5\n")
+            calls = vcf.read_flat_file(out_dir + "/old.haplotypes.tsv")
+        self.assertEqual(list(calls), [("S1", "CYP2D6")])
+        self.assertEqual(calls[("S1", "CYP2D6")], {
+            "HAPS": ([["CYP2D6(star)1", "CYP2D6(star)4.001"]], [("c22_1_SID_A_G", "c22_2_SID_C_T")]),
+            "REFS": [],
+            "TIMED_OUT": False,
+            "VERSION": ""})
+
+    def test_variant_file_writer(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            writer = vcf.VariantFileWriter(out_dir, "test", [GENE])
+            called = subject.Subject("NA12878", genes = [GENE], config = CONFIG)
+            writer.write(called)
+            # The subject is not kept until the file is written
+            called_ref = weakref.ref(called)
+            del called
+            self.assertIsNone(called_ref())
+            writer.close()
+            record = next(vcf.VariantFile(out_dir + "/test.haplotypes.vcf").fetch())
+        self.assertEqual(list(record.samples), ["NA12878"])
+
+    def test_incremental_calls(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            vcf.write_flat_file(out_dir, [SUBJ], "test")
+            previous_calls = vcf.read_flat_file(out_dir + "/test.haplotypes.tsv")
+        self.assertEqual(incremental.diff_tables(GENE, GENE)["variants"], set())
+        previous = incremental.IncrementalCalls([GENE], [GENE], previous_calls)
+        carried = subject.Subject("NA12878", genes = [GENE], config = CONFIG, previous = previous)
+        self.assertEqual(previous.stats()["carried"], 1)
+        self.assertEqual(carried.called_haplotypes[str(GENE)]["HAPS"][0], SUBJ.called_haplotypes[str(GENE)]["HAPS"][0])
+        # An earlier table without *2.001, samples of two chunks called in turn (as pipeline workers do)
+        samples = CNV_VCF.samples[:4]
+        with tempfile.TemporaryDirectory() as out_dir:
+            old_table = out_dir + "/CYP2D6.haplotypes.tsv"
+            with open(CYP2D6_CNV_TABLE) as table_in, open(old_table, "w") as table_out:
+                table_out.writelines(line for line in table_in if not line.startswith("CYP2D6*2.001\t"))
+            with open(CYP2D6_CNV_TABLE.replace(".tsv", ".cnv")) as cnv_in, open(old_table.replace(".tsv", ".cnv"), "w") as cnv_out:
+                cnv_out.write(cnv_in.read())
+            old_gene = gene.AbstractGene(old_table, vcf = CNV_VCF, config = CONFIG)
+            vcf.write_flat_file(out_dir, [subject.Subject(sample, genes = [old_gene], config = CONFIG) for sample in samples], "old")
+            previous_calls = vcf.read_flat_file(out_dir + "/old.haplotypes.tsv")
+        previous = incremental.IncrementalCalls([old_gene], [CNV_GENE], previous_calls)
+        chunks = [samples[::2], samples[1::2]]
+        chunk_genes = [CNV_GENE.with_variants({var_id: {s: genotypes[s] for s in chunk} for var_id, genotypes in CNV_GENE.variants.items()}) for chunk in chunks]
+        resolves = []
+        for chunk_gene in chunk_genes:
+            chunk_gene.resolve_table = lambda rows, resolve = chunk_gene.resolve_table: resolves.append(rows) or resolve(rows)
+        for pair in zip(*chunks):
+            for sample, chunk_gene in zip(pair, chunk_genes):
+                self.assertEqual(subject.Subject(sample, genes = [chunk_gene], config = CONFIG, previous = previous).called_haplotypes[str(CNV_GENE)]["HAPS"][0],
+                    subject.Subject(sample, genes = [CNV_GENE], config = CONFIG).called_haplotypes[str(CNV_GENE)]["HAPS"][0])
+        # Resolved once per chunk, dropped when the chunk is finished
+        self.assertEqual(len(resolves), 2)
+        self.assertEqual(len(previous.updates[str(CNV_GENE)]["resolved"]), 2)
+        previous.release(chunk_genes[:1])
+        self.assertEqual(list(previous.updates[str(CNV_GENE)]["resolved"]), [id(chunk_genes[1].variants)])
+
+    def test_parameter_sweep(self):
+        settings = sweep.parse_settings("max_haps=2;max_haps=3,optimal_decay=0.1")
+        self.assertEqual(settings[1], {"max_haps": "3", "optimal_decay": "0.1"})
+        param_sweep = sweep.ParameterSweep(settings, config = CONFIG)
+        rows = param_sweep.call("NA12878", [GENE])
+        calls = [r["GENOTYPE"] for r in rows if r["SETTING"] == "max_haps=2"]
+        self.assertEqual(calls, ["/".join(c) for c in SUBJ.called_haplotypes[str(GENE)]["HAPS"][0]])
+        truth = {("NA12878", str(GENE)): sorted(sweep.rm_sub_allele(a) for a in calls[0].split("/"))}
+        concordance = {r["SETTING"]: r for r in param_sweep.concordance(truth)}
+        self.assertEqual(concordance["max_haps=2"]["CONCORDANT"], 1)
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            trace_log = trace.TraceLog(out_dir + "/test.trace.jsonl")
+            subject.Subject("NA12878", genes = [GENE], config = CONFIG, trace = trace_log)
+            trace_log.close()
+            records = trace.read_trace(out_dir + "/test.trace.jsonl")
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["source"], "solved")
+        self.assertGreaterEqual(records[0]["candidates"], records[0]["classes"])
+        self.assertGreater(len(records[0]["solves"]), 0)
+
+    def test_memory_report(self):
+        report = memory.enable()
+        try:
+            subject.Subject("NA12878", genes = [GENE], config = CONFIG)
+        finally:
+            memory.disable()
+        stages = {(r["STAGE"], r["GENE"]): r for r in report.records()}
+        self.assertEqual(stages[("subject", "")]["CALLS"], 1)
+        self.assertEqual(stages[("solve", str(GENE))]["SAMPLES"], 1)
+        self.assertGreater(report.estimate(1000), 0)
+        with tempfile.TemporaryDirectory() as out_dir:
+            report.write(out_dir, "test")
+            with open(out_dir + "/test.memory.tsv") as memory_file:
+                self.assertEqual(len(memory_file.readlines()), len(stages) + 1)
+
+    def test_summary(self):
+        cohort_summary = summary.CohortSummary({"NA12878": "CEU"})
+        cohort_summary.add(SUBJ)
+        with tempfile.TemporaryDirectory() as out_dir:
+            cohort_summary.write(out_dir, "test")
+            with open(out_dir + "/test.summary.tsv") as summary_file:
+                rows = list(csv.DictReader(summary_file, delimiter = "\t"))
+        self.assertEqual(set(r["GROUP"] for r in rows), {"ALL", "CEU"})
+        diplotypes = [float(r["COUNT"]) for r in rows if r["GROUP"] == "ALL" and r["CATEGORY"] == "diplotype"]
+        self.assertAlmostEqual(sum(diplotypes), 1)
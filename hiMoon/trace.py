@@ -0,0 +1,68 @@
+#    Copyright 2021 Solomon M. Adams
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import threading
+
+
+class TraceLog:
+
+    def __init__(self, path: str) -> None:
+        """
+        JSON lines trace with one record per sample and gene
+        Records hold the problem size after matching (candidate haplotypes, classes, variants),
+        the size of the LP (constraints, phase sets), every solve (status, seconds, phased),
+        and where the call came from (solved, cache, previous, no_variants).
+        Records are built from counts the caller keeps anyway, so tracing only adds a write per record.
+
+        Args:
+            path (str): path/to/trace.jsonl
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = 0
+        self.trace_out = open(path, "w")
+
+    def write(self, record: dict) -> None:
+        """
+        Add a record
+
+        Args:
+            record (dict): trace record (JSON serializable)
+        """
+        line = json.dumps(record, separators = (",", ":"))
+        with self.lock:
+            self.trace_out.write(line + "\n")
+            self.records += 1
+
+    def close(self) -> None:
+        """
+        Close the file
+        """
+        with self.lock:
+            self.trace_out.close()
+
+
+def read_trace(path: str) -> list:
+    """
+    Read a trace
+
+    Args:
+        path (str): path/to/trace.jsonl
+
+    Returns:
+        list: one dict per sample and gene
+    """
+    with open(path, "r") as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
@@ -11,192 +11,502 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
+import abc
 import csv
 import math
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
+from pysam import VariantFile, tabix_index
 
-from pysam import VariantFile
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Optional, only needed for columnar output
+    pa = None
+    pq = None
 
 from .template import PATH
 
 from . import LOGGING, SPECIAL_CHROM
 
+MANIFEST_SUFFIXES = (".txt", ".list", ".manifest")
 
-class VarFile:
-    def __init__(self, vcf_file: str, sample: str = None, vcf_file_index: str = None, config = None) -> None:
+# New flat file columns are only appended after the original ones, so files can still be read by position
+FLAT_FILE_COLUMNS = ["SUBJECT", "GENE", "GENOTYPE", "VARIANTS", "CONFIDENCE"] + ["TIMED_OUT", "MAX_SOLVE_TIME", "REFS", "VERSION"]
+
+
+def norm_contig(chrom) -> str:
+    """
+    Contig name without a chr prefix, with special chromosomes (23, 24) named
+
+    Args:
+        chrom (str): contig name
+
+    Returns:
+        str: normalized contig name
+    """
+    chrom = str(chrom)
+    chrom = chrom[3:] if chrom.startswith("chr") else chrom
+    return SPECIAL_CHROM.get(chrom, chrom)
+
+
+def cnv_alleles(cn) -> tuple:
+    """
+    Alleles of a CNV coded as CN (copy number) rather than GT
+    Distributes copies across an assumed diploid sample (e.g. cn2 == 1/1, cn3 == 1/2, cn>=4 == 2/2)
+
+    Args:
+        cn (int): copy number (None if missing)
+
+    Returns:
+        tuple: alleles, None if the copy number is missing
+    """
+    if cn is None:
+        return None
+    elif cn == 0:
+        return ("0", "0")
+    if cn > 4: # TODO: design table functionality for CNV > 2 copies each
+        cn = 4
+    half_round = math.floor(int(cn) / 2)
+    return (str(half_round), str(cn - half_round))
+
+
+class RecordReader(abc.ABC):
+    """
+    Genotype decoding backend of VarFile
+    Decodes the genotypes of a record (pysam VariantRecord) into the per-sample dicts used for matching:
+    alleles (tuple of allele strings, None for missing alleles), phased, phase_set (PS, -1 if not in FORMAT), 
+    and the record's ref and alts (the same for every sample).
+    """
+
+    @abc.abstractmethod
+    def genotypes(self, position, var_type: str, samples: list, columns: dict) -> dict:
         """
-        VarFile object, basically a wrapper for pysam VariantFile
-        
+        Genotypes of a record
+
         Args:
-            vcf_file (str): path to VCF/VCF.GZ/BCF file (needs to be indexed)
+            position (VariantRecord): pysam VariantRecord
+            var_type (str): SID or the SVTYPE of the record
+            samples (list): samples to decode
+            columns (dict): sample -> sample column of the file (after subsetting)
+
+        Returns:
+            dict: sample -> genotype dict
         """
-        self.vcf_file = VariantFile(vcf_file, index_filename = vcf_file_index)
-        if sample:
-            self.samples = [sample]
-        else:
-            self.samples = list(self.vcf_file.header.samples)
-        self.vcf_file.subset_samples(self.samples)
-    
+
+
+class PysamReader(RecordReader):
+    """
+    Decodes each sample through pysam's per-sample API (default)
+    """
+
     def _get_alleles(self, sample, var_type):
         """
         Get alleles if coded as GT, catch if coded as CN (for CNV)
-        Distributes copies across an assumed diploid sample (e.g. cn2 == 1/1, cn3 == 1/2, cn>=4 == 2/2)
         """
         alleles = sample.alleles
         if len(alleles) == 0 and var_type == "CNV":
             try:
-                cn = sample["CN"]
-                if cn is None:
-                    alleles = None
-                elif cn == 0:
-                    alleles = ("0", "0")
-                else:
-                    if cn > 4: # TODO: design table functionality for CNV > 2 copies each
-                        cn = 4
-                    half_round = math.floor(int(cn) / 2)
-                    alleles = (str(half_round), str(cn - half_round))
+                alleles = cnv_alleles(sample["CN"])
             except KeyError:
                 alleles = None
         return alleles
 
+    def genotypes(self, position, var_type: str, samples: list, columns: dict) -> dict:
+        alts = position.alts or ()
+        return {
+            sample: {
+                "alleles": self._get_alleles(position.samples[sample], var_type), "phased": position.samples[sample].phased, "phase_set": position.samples[sample].get("PS", -1),  "ref": position.ref, "alts": alts} for sample in samples}
+
+
+class TextReader(RecordReader):
+    """
+    Decodes GT, PS, and CN for the requested samples of a record at once from the record's VCF text
+    Avoids pysam's per-sample objects, which dominate decoding time for wide VCFs. 
+    The text only has the samples the file was subset to (formatted by htslib), 
+    only the columns of the requested samples are split and decoded. 
+    Gives the same genotypes as PysamReader.
+    """
+
+    def _split_column(self, fields: list, key: str, format_keys: list) -> list:
+        """
+        One FORMAT field for every sample column (None if the key is not in FORMAT, "." if missing)
+        """
+        try:
+            k = format_keys.index(key)
+        except ValueError:
+            return None
+        if k == 0: # GT is always first
+            return [values.split(":", 1)[0] for values in fields]
+        split_fields = [values.split(":") for values in fields]
+        return [values[k] if k < len(values) else "." for values in split_fields]
+
+    def _number(self, value: str):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+
+    def _parse_gt(self, gt: str, alleles: list) -> tuple:
+        phased = "/" not in gt
+        return tuple(None if a == "." else alleles[int(a)] for a in gt.replace("/", "|").split("|")), phased
+
+    def genotypes(self, position, var_type: str, samples: list, columns: dict) -> dict:
+        sample_columns = [columns[sample] for sample in samples]
+        if not sample_columns:
+            return {}
+        # Columns after the last requested sample are left unsplit
+        line = str(position).rstrip("\n").split("\t", 10 + max(sample_columns))
+        ref = line[3]
+        alts = tuple(line[4].split(",")) if line[4] != "." else ()
+        alleles = [ref] + list(alts)
+        format_keys = line[8].split(":") if len(line) > 8 and line[8] != "." else []
+        fields = [line[9 + column] for column in sample_columns]
+        # Decode each column for the requested samples, each distinct GT string is parsed once
+        gts = self._split_column(fields, "GT", format_keys)
+        if gts is None:
+            decoded_gts = [((), False)] * len(fields)
+        else:
+            parsed = {gt: self._parse_gt(gt, alleles) for gt in set(gts)}
+            decoded_gts = [parsed[gt] for gt in gts]
+        phase_sets = self._split_column(fields, "PS", format_keys)
+        if phase_sets is None:
+            phase_sets = [-1] * len(fields)
+        else:
+            phase_sets = [None if ps == "." else int(ps) for ps in phase_sets]
+        cns = self._split_column(fields, "CN", format_keys) if var_type == "CNV" else None
+        genotypes = {}
+        for i, sample in enumerate(samples):
+            sample_alleles, phased = decoded_gts[i]
+            if len(sample_alleles) == 0 and var_type == "CNV":
+                if cns is None:
+                    sample_alleles = None
+                else:
+                    sample_alleles = cnv_alleles(None if cns[i] == "." else self._number(cns[i]))
+            genotypes[sample] = {"alleles": sample_alleles, "phased": phased, "phase_set": phase_sets[i], "ref": ref, "alts": alts}
+        return genotypes
+
+
+# Genotype decoding backends for VarFile (reader)
+READERS = {"pysam": PysamReader, "text": TextReader}
+
+
+class VarFile:
+    def __init__(self, vcf_file, sample: str = None, vcf_file_index: str = None, config = None, stream: bool = False, reader: str = None) -> None:
+        """
+        VarFile object, basically a wrapper for pysam VariantFile
+        Several files (e.g. split by chromosome or SV and SNV/indel calls) can be read as one,
+        each region is fetched from the files that contain its contig and merged. 
+        
+        Args:
+            vcf_file (str): path to VCF/VCF.GZ/BCF file (needs to be indexed), 
+                a list of paths, or a manifest file (.txt/.list/.manifest) with one path per line
+            sample (str or list, optional): single sample (or list of samples) to read
+            vcf_file_index (str, optional): path to the index (single file only)
+            config (ConfigData, optional): config.ConfigData object
+            stream (bool, optional): read with a single linear pass (fill_genes) instead of indexed fetches. 
+                Does not need an index, "-" reads from stdin. Defaults to False.
+            reader (str, optional): genotype decoding backend, a key of READERS ("pysam" or "text"). 
+                Defaults to "reader" in the VARIANT QUERY PARAMETERS section of the config, or "pysam".
+        """
+        self.stream = stream
+        query_params = config.VARIANT_QUERY_PARAMETERS if config else {}
+        self.fetch_threads = int(query_params.get("fetch_threads", 4))
+        decompression_threads = int(query_params.get("decompression_threads", 1))
+        self.reader_name = reader or query_params.get("reader", "pysam")
+        try:
+            self.reader = READERS[self.reader_name]()
+        except KeyError:
+            raise ValueError(f"Unknown reader {self.reader_name}, use one of: {', '.join(READERS)}")
+        self.config = config
+        self.vcf_file_index = vcf_file_index
+        paths = self._get_paths(vcf_file)
+        self.paths = paths
+        if len(paths) > 1 and vcf_file_index:
+            LOGGING.warning("vcf_file_index is ignored when reading multiple VCF files")
+            vcf_file_index = None
+        self.vcf_files = [VariantFile(path, index_filename = vcf_file_index, threads = decompression_threads) for path in paths]
+        self.vcf_file = self.vcf_files[0]
+        if sample:
+            self.samples = [sample] if isinstance(sample, str) else list(sample)
+        else:
+            self.samples = []
+            for var_file in self.vcf_files:
+                self.samples += [s for s in var_file.header.samples if s not in self.samples]
+        self.file_samples = []
+        for var_file in self.vcf_files:
+            file_samples = [s for s in self.samples if s in var_file.header.samples]
+            var_file.subset_samples(file_samples)
+            self.file_samples.append(file_samples)
+        self.file_contigs = [self._get_contigs(var_file) for var_file in self.vcf_files]
+        self.file_columns = [{s: i for i, s in enumerate(var_file.header.samples)} for var_file in self.vcf_files] # Sample -> column after subsetting
+
+    def for_samples(self, samples: list) -> "VarFile":
+        """
+        New VarFile (with its own file handles) that only reads some samples
+        Only these samples are unpacked when records are read, used to process a cohort in chunks. 
+
+        Args:
+            samples (list): sample IDs
+
+        Returns:
+            VarFile: VarFile for the samples
+        """
+        return VarFile(self.paths, samples, vcf_file_index = self.vcf_file_index, config = self.config, reader = self.reader_name)
+
+    def close(self) -> None:
+        """
+        Close the underlying file handles
+        """
+        for var_file in self.vcf_files:
+            var_file.close()
+
+    def _get_paths(self, vcf_file) -> list:
+        """
+        Resolve the input to a list of VCF paths
+
+        Args:
+            vcf_file (str or list): path, list of paths, or manifest
+
+        Returns:
+            list: paths to VCF/BCF files
+        """
+        if not isinstance(vcf_file, str):
+            return list(vcf_file)
+        if vcf_file.endswith(MANIFEST_SUFFIXES):
+            with open(vcf_file, "rt") as manifest:
+                return [line.strip() for line in manifest if line.strip() and not line.startswith("#")]
+        return [vcf_file]
+
+    def _get_contigs(self, var_file: VariantFile) -> set:
+        """
+        Contigs with indexed records (falls back to the header)
+
+        Args:
+            var_file (VariantFile): pysam VariantFile
+
+        Returns:
+            set: contig names
+        """
+        try:
+            return set(var_file.index)
+        except (AttributeError, ValueError, TypeError):
+            return set(var_file.header.contigs)
+    
+    def _parse_record(self, position, samples: list, file_index: int) -> tuple:
+        """
+        Convert a single VCF record to the ID schema and per-sample genotypes used for matching
 
-    def get_range(self, chrom: str, minloc: int, maxloc: int) -> dict:
+        Args:
+            position (VariantRecord): pysam VariantRecord
+            samples (list): samples to extract
+            file_index (int): index into self.vcf_files of the record's file
+
+        Returns:
+            tuple: variant ID, dict of sample genotypes
+        """
+        chrom = position.chrom.strip("chr")
+        var_type = "SID"
+        try:
+            var_type = position.info["SVTYPE"]
+        except KeyError:
+            pass
+        return f"c{chrom}_{position.pos}_{var_type}", self.reader.genotypes(position, var_type, samples, self.file_columns[file_index])
+
+    def _fetch_file(self, file_index: int, chrom: str, minloc: int, maxloc: int, samples: list = None) -> list:
+        """
+        Fetch and parse a region from one of the VCF files
+
+        Args:
+            file_index (int): index into self.vcf_files
+            chrom (str): chromosome
+            minloc (int): starting position
+            maxloc (int): ending position
+            samples (list, optional): only parse these samples. Defaults to all samples.
+
+        Returns:
+            list: parsed records
+        """
+        contigs = self.file_contigs[file_index]
+        if str(chrom) in contigs:
+            contig = str(chrom)
+        elif f"chr{chrom}" in contigs:
+            contig = f"chr{chrom}"
+        else:
+            return []
+        if samples is None:
+            samples = self.file_samples[file_index]
+        else:
+            file_samples = set(self.file_samples[file_index])
+            samples = [s for s in samples if s in file_samples]
+        return [self._parse_record(position, samples, file_index) for position in self.vcf_files[file_index].fetch(contig, minloc, maxloc)]
+
+    def stream_ranges(self, regions: list) -> list:
+        """
+        Read variants for several regions in one linear pass over the file(s)
+        Each record is checked against the sorted regions on its contig with a binary search. 
+        Uses the same overlap rules as an indexed fetch. 
+
+        Args:
+            regions (list): (chrom, minloc, maxloc) tuples
+
+        Returns:
+            list: dict of variants for each region, in the same order as regions
+        """
+        positions_out = [{} for _ in regions]
+        windows = {}
+        for i, (chrom, minloc, maxloc) in enumerate(regions):
+            windows.setdefault(norm_contig(chrom), []).append((int(minloc), int(maxloc), i))
+        lookup = {}
+        for chrom, contig_windows in windows.items():
+            contig_windows.sort()
+            max_ends = []
+            for window in contig_windows:
+                max_ends.append(max(window[1], max_ends[-1]) if max_ends else window[1])
+            lookup[chrom] = ([w[0] for w in contig_windows], max_ends, contig_windows)
+        for file_index, var_file in enumerate(self.vcf_files):
+            samples = self.file_samples[file_index]
+            for position in var_file:
+                try:
+                    starts, max_ends, contig_windows = lookup[norm_contig(position.chrom)]
+                except KeyError:
+                    continue
+                parsed = None
+                j = bisect_left(starts, position.stop) - 1 # Windows that start before the record ends
+                while j >= 0 and max_ends[j] > position.start:
+                    minloc, maxloc, i = contig_windows[j]
+                    if maxloc > position.start:
+                        if parsed is None:
+                            parsed = self._parse_record(position, samples, file_index)
+                        positions_out[i].setdefault(parsed[0], {}).update(parsed[1])
+                    j -= 1
+        return positions_out
+
+    def fill_genes(self, genes: list) -> None:
+        """
+        Fill the variants of every gene with a single pass over the VCF (streaming mode)
+
+        Args:
+            genes (list): gene.AbstractGene objects created without a VCF
+        """
+        gene_variants = self.stream_ranges([(gene.chromosome, gene.min, gene.max) for gene in genes])
+        for gene, variants in zip(genes, gene_variants):
+            gene.variants = variants
+
+    def get_range(self, chrom: str, minloc: int, maxloc: int, samples: list = None) -> dict:
         """
         Returns a range of variants for all samples in a VCF file
+        With multiple files, the region is fetched concurrently from every file with the contig
         
         Args:
             chrom (str): chromosome
             minloc (int): starting position
             maxloc (int): ending position
+            samples (list, optional): only return these samples (e.g. a chunk). Defaults to all samples.
         
         Returns:
             dict: variants with a common ID schema that is matched by other methods
         """
+        if self.stream:
+            raise ValueError("get_range needs indexed input, use fill_genes to read a VCF stream")
         positions_out = {}
         try:
             chrom = SPECIAL_CHROM[chrom.replace("chr", "")]
         except KeyError:
             pass
-        try:
-            positions = self.vcf_file.fetch(str(chrom), minloc, maxloc)
-        except ValueError:
-            positions = self.vcf_file.fetch(f"chr{chrom}", minloc, maxloc)
-        for position in positions:
-            chrom = position.chrom.strip("chr")
-            var_type = "SID"
-            try:
-                var_type = position.info["SVTYPE"]
-            except KeyError:
-                pass
-            positions_out[f"c{chrom}_{position.pos}_{var_type}"] = {
-                sample: {
-                    "alleles": self._get_alleles(position.samples[sample], var_type), "phased": position.samples[sample].phased, "phase_set": position.samples[sample].get("PS", -1),  "ref": position.ref} for sample in self.samples}
+        file_indices = range(len(self.vcf_files))
+        if len(self.vcf_files) == 1:
+            fetched = [self._fetch_file(0, chrom, minloc, maxloc, samples)]
+        else:
+            with ThreadPoolExecutor(max_workers = max(1, min(self.fetch_threads, len(self.vcf_files)))) as executor:
+                fetched = list(executor.map(lambda i: self._fetch_file(i, chrom, minloc, maxloc, samples), file_indices))
+        for records in fetched:
+            for var_id, sample_genotypes in records:
+                positions_out.setdefault(var_id, {}).update(sample_genotypes)
         return positions_out
         
-def get_alleles(gene: object, subjects: list) -> list:
+def _subject_calls(gene_name: str, subject) -> tuple:
+    """
+    Calls and variants of a subject for a gene (empty for NA calls)
+    """
+    calls = subject.called_haplotypes[gene_name]["HAPS"]
+    if calls[0] == "NA":
+        return [], []
+    return calls[0], calls[1]
+
+def get_alleles(reference: str, alts: dict) -> list:
     """
     Prep for the ref/alt columns in a VCF
 
     Args:
-        gene (Gene): gene object
-        subjects (list): list of subjects
+        reference (str): reference haplotype of the gene
+        alts (dict): every called haplotype (keys, in order of first appearance)
 
     Returns:
-        list: list of all possible alt alleles
-    """
-    ref = gene.reference
-    alts = []
-    for s in subjects:
-        subject_haps = [h for h in s.called_haplotypes[str(gene)]["HAPS"][0]]
-        alts += np.array(subject_haps).flatten().tolist()
-    try:
-        alts = list(filter((ref).__ne__, alts))
-    except ValueError:
-        pass
-    if len(alts) == 0:
-        alts = ["NON_REF"]
-    return([ref] + list(set(alts)))
-
-def get_dosage(haps: list, alleles: list) -> list:
+        list: reference, then every called alt allele (in order of first appearance)
+    """
+    alts = [hap for hap in alts if hap != reference]
+    return [reference] + (alts if len(alts) > 0 else ["NON_REF"])
+
+def get_allele_index(alleles: list) -> dict:
+    """
+    Allele -> index in the REF/ALT columns (built once per gene)
+
+    Args:
+        alleles (list): alleles from get_alleles
+
+    Returns:
+        dict: allele -> index
+    """
+    return {allele: i for i, allele in enumerate(alleles)}
+
+def get_dosage(haps: list, allele_index: dict) -> list:
     """
     Get index for GT fiels for a given sample
 
     Args:
         haps (list): possible haplotypes
-        alleles (list): alleles
+        allele_index (dict): allele -> index, from get_allele_index
 
     Returns:
         list: sample dosages for each allele
     """
-    return [alleles.index(s) for s in haps]
+    return [allele_index[s] for s in haps]
 
-def get_samples(gene_name: str, subjects: list, alleles: list) -> list:
+def get_sample_call(calls: list, variants: list) -> tuple:
     """
-    Generate the sample/format field for each sample in the multi-sample output VCF
+    What the multi-sample output VCF needs from a sample's calls for a gene
+    Samples with several possible genotypes (or no call) have a missing GT.
 
     Args:
-        gene_name (str): gene name
-        subjects (list): list of subjects to be written
-        alleles (list): subject alleles
+        calls (list): possible genotypes (from _subject_calls)
+        variants (list): variants of each possible genotype
 
     Returns:
-        list: list of format field for each each sample
-    """
-    formats = []
-    for s in subjects:
-        calls = s.called_haplotypes[gene_name]["HAPS"]
-        if len(calls[0]) > 1 or len(calls[0]) == 0:
-            formats.append(
-                {
-                    "GT": [None, None],
-                    "VA": ",".join(list(set([v for i in calls[1] for v in i]))),
-                    "HC": None
-                }
-            )
-        else:
-            formats.append(
-                {
-                    "GT": get_dosage(calls[0][0], alleles),
-                    "VA": calls[1][0],
-                    "HC": 1 / len(calls[0])
-                }
-            )
-    return formats
-
+        tuple: haplotypes of the genotype (None if missing), VA, and HC
+    """
+    if len(calls) == 1:
+        return tuple(calls[0]), variants[0], 1.0
+    return None, ",".join(sorted(set(v for i in variants for v in i))) or None, None
 
-def write_variant_file(directory: str, subjects: [], prefix: str, genes: list) -> None:
+def write_variant_file(directory: str, subjects: [], prefix: str, genes: list, compress: bool = False, threads: int = 0) -> None:
     """
     Write the output VCF file
+    With compress, the file is BGZF compressed ({prefix}.haplotypes.vcf.gz) and CSI indexed.
 
     Args:
         directory (str): output directory
         subjects ([type]): list of subjects
         prefix (str): prefix for filename
         genes (list): list of gene objects
+        compress (bool, optional): write a BGZF compressed, indexed VCF. Defaults to False.
+        threads (int, optional): extra compression threads. Defaults to 0.
     """
-    contigs = list(set([f"chr{gene.chromosome.strip('chr')}" for gene in genes]))
-    template = VariantFile(PATH + "/template.vcf", "r")
-    outfile = VariantFile(directory+f"/{prefix}.haplotypes.vcf", "w", header = template.header)
-    for contig in contigs:
-        outfile.header.add_line(f"##contig=<ID={contig},length=0>")
-    for sub in subjects:
-        outfile.header.add_sample(str(sub))
-    for gene in genes:
-        alleles = get_alleles(gene, subjects)
-        nr =outfile.new_record(
-            contig = f"chr{gene.chromosome}",
-            start = gene.min,
-            stop = gene.max,
-            alleles = [f'<{a.replace(str(gene), "").replace("(star)", "*")}>' for a in alleles],
-            id = f"{str(gene)}_pgx",
-            qual = None,
-            filter = None,
-            info = {"VARTYPE": "HAP"},
-            samples = get_samples(str(gene), subjects, alleles)
-        )
-        outfile.write(nr)
-    outfile.close()
+    variant_file = VariantFileWriter(directory, prefix, genes, compress = compress, threads = threads)
+    for subject in subjects:
+        variant_file.write(subject)
+    variant_file.close()
 
 def write_flat_file(directory: str, subjects: [], prefix: str) -> None:
     """
@@ -207,18 +517,224 @@ def write_flat_file(directory: str, subjects: [], prefix: str) -> None:
         subjects ([type]): list of subjects
         prefix (str): prefix for filename
     """
-    lines = []
+    flat_file = FlatFileWriter(directory, prefix)
     for subject in subjects:
+        flat_file.write(subject)
+    flat_file.close()
+
+
+def read_flat_file(flat_file_path: str) -> dict:
+    """
+    Read calls from a flat file written by an earlier run (e.g. to carry them forward)
+    Subjects and genes without calls (no rows) are not included, nor are NA calls. 
+    Files written before the TIMED_OUT, REFS, and VERSION columns were added can be read (not timed out, no REFS, no version).
+
+    Args:
+        flat_file_path (str): path/to/{prefix}.haplotypes.tsv
+
+    Returns:
+        dict: (subject, gene) -> dict with HAPS, REFS, TIMED_OUT, and VERSION (as in Subject.called_haplotypes)
+    """
+    calls = {}
+    with open(flat_file_path) as flat_in:
+        for row in csv.DictReader(flat_in, delimiter = "\t"):
+            if row["GENOTYPE"] in ("N", "A"): # NA call
+                continue
+            call = calls.setdefault((row["SUBJECT"], row["GENE"]), {
+                "HAPS": ([], []),
+                "REFS": [],
+                "TIMED_OUT": False,
+                "VERSION": row.get("VERSION") or ""})
+            call["HAPS"][0].append(row["GENOTYPE"].split("/"))
+            call["HAPS"][1].append(tuple(row["VARIANTS"].split("|")) if row["VARIANTS"] else ())
+            if row.get("REFS"):
+                call["REFS"].append(int(row["REFS"]))
+            call["TIMED_OUT"] = call["TIMED_OUT"] or row.get("TIMED_OUT") == "1"
+    return calls
+
+
+class FlatFileWriter:
+
+    def __init__(self, directory: str, prefix: str) -> None:
+        """
+        Writes the output flat file as subjects are called
+        Same output as write_flat_file, without keeping the subjects. 
+
+        Args:
+            directory (str): output directory
+            prefix (str): prefix for filename
+        """
+        self.flat_out = open(directory + f"/{prefix}.haplotypes.tsv", "w")
+        self.flat_file = csv.DictWriter(self.flat_out, FLAT_FILE_COLUMNS, delimiter = "\t")
+        self.flat_file.writeheader()
+
+    def write(self, subject) -> None:
+        """
+        Write the calls of a subject
+
+        Args:
+            subject (Subject): called subject
+        """
         for gene, haps in subject.called_haplotypes.items():
             for i in range(len(haps["HAPS"][0])):
-                lines.append({
+                self.flat_file.writerow({
                     "SUBJECT": str(subject),
                     "GENE": gene,
                     "GENOTYPE": "/".join(haps["HAPS"][0][i]),
                     "VARIANTS": "|".join(haps["HAPS"][1][i]),
-                    "CONFIDENCE": 1 / len(haps["HAPS"][0])
+                    "CONFIDENCE": 1 / len(haps["HAPS"][0]),
+                    "TIMED_OUT": int(haps.get("TIMED_OUT", False)),
+                    "MAX_SOLVE_TIME": round(haps.get("SOLVE_TIME", 0), 3),
+                    "REFS": haps["REFS"][i] if i < len(haps.get("REFS", [])) else "",
+                    "VERSION": haps.get("VERSION", "")
                 })
-    with open(directory + f"/{prefix}.haplotypes.tsv", "w") as flat_out:
-        flat_file = csv.DictWriter(flat_out, ["SUBJECT", "GENE", "GENOTYPE", "VARIANTS", "CONFIDENCE"], delimiter = "\t")
-        flat_file.writeheader()
-        flat_file.writerows(lines)
+
+    def close(self) -> None:
+        """
+        Close the file
+        """
+        self.flat_out.close()
+
+
+class VariantFileWriter:
+
+    def __init__(self, directory: str, prefix: str, genes: list, compress: bool = False, threads: int = 0) -> None:
+        """
+        Writes the output VCF as subjects are called, same output as write_variant_file
+        The VCF has one record per gene and one column per sample, so it is written on close. 
+        Only the haplotypes and variants of each call are kept (see get_sample_call), not the subjects. 
+
+        Args:
+            directory (str): output directory
+            prefix (str): prefix for filename
+            genes (list): list of gene objects
+            compress (bool, optional): write a BGZF compressed, indexed VCF ({prefix}.haplotypes.vcf.gz). Defaults to False.
+            threads (int, optional): extra compression threads. Defaults to 0.
+            """
+        self.out_path = directory + f"/{prefix}.haplotypes.vcf" + (".gz" if compress else "")
+        self.genes = genes
+        self.compress = compress
+        self.threads = threads
+        self.samples = []
+        self.calls = {str(gene): [] for gene in genes}
+        self.alts = {str(gene): {} for gene in genes} # Called haplotypes in order of first appearance
+
+    def write(self, subject) -> None:
+        """
+        Add the calls of a subject
+
+        Args:
+            subject (Subject): called subject
+        """
+        self.samples.append(str(subject))
+        for gene_name, gene_calls in self.calls.items():
+            calls, variants = _subject_calls(gene_name, subject)
+            alts = self.alts[gene_name]
+            for call in calls:
+                for hap in call:
+                    alts[hap] = None
+            gene_calls.append(get_sample_call(calls, variants))
+
+    def close(self) -> None:
+        """
+        Write the VCF (and index it if compressed)
+        """
+        contigs = list(set([f"chr{gene.chromosome.strip('chr')}" for gene in self.genes]))
+        header = VariantFile(PATH + "/template.vcf", "r").header.copy()
+        for contig in contigs:
+            header.add_line(f"##contig=<ID={contig},length=0>")
+        header.add_samples(self.samples) # One call, adding samples one at a time is quadratic
+        outfile = VariantFile(self.out_path, "wz" if self.compress else "w", header = header, threads = self.threads)
+        for gene in self.genes:
+            alleles = get_alleles(gene.reference, self.alts[str(gene)])
+            allele_index = get_allele_index(alleles)
+            nr = outfile.new_record(
+                contig = f"chr{gene.chromosome}",
+                start = gene.min,
+                stop = gene.max,
+                alleles = [f'<{a.replace(str(gene), "").replace("(star)", "*")}>' for a in alleles],
+                id = f"{str(gene)}_pgx",
+                qual = None,
+                filter = None,
+                info = {"VARTYPE": "HAP"}
+            )
+            for sample, (haps, va, hc) in zip(nr.samples.values(), self.calls[str(gene)]):
+                sample["GT"] = get_dosage(haps, allele_index) if haps is not None else (None, None)
+                sample["VA"] = va
+                sample["HC"] = hc
+            outfile.write(nr)
+        outfile.close()
+        if self.compress:
+            tabix_index(self.out_path, preset = "vcf", csi = True, force = True)
+        self.calls = {str(gene): [] for gene in self.genes}
+
+
+class ColumnarWriter:
+
+    def __init__(self, directory: str, prefix: str, row_group_size: int = 10000) -> None:
+        """
+        Writes calls to a Parquet file with typed columns, one row per possible genotype
+        Rows are buffered and written as a row group every row_group_size rows, 
+        so subjects can be added as they are called. Requires pyarrow. 
+
+        Args:
+            directory (str): output directory
+            prefix (str): prefix for filename
+            row_group_size (int, optional): rows per row group. Defaults to 10000.
+        """
+        if pa is None:
+            raise ImportError("Columnar output requires pyarrow (pip install pyarrow)")
+        self.schema = pa.schema([
+            ("subject", pa.string()),
+            ("gene", pa.string()),
+            ("haplotype_1", pa.string()),
+            ("haplotype_2", pa.string()),
+            ("confidence", pa.float64()),
+            ("variants", pa.list_(pa.string())),
+            ("timed_out", pa.bool_()),
+            ("max_solve_time", pa.float64())
+        ])
+        self.row_group_size = row_group_size
+        self.columns = {name: [] for name in self.schema.names}
+        self.writer = pq.ParquetWriter(directory + f"/{prefix}.haplotypes.parquet", self.schema)
+
+    def write(self, subject) -> None:
+        """
+        Add the calls for a subject, haplotypes past the second are joined to haplotype_2 with "/"
+
+        Args:
+            subject (Subject): called subject
+        """
+        for gene, haps in subject.called_haplotypes.items():
+            if haps["HAPS"][0] == "NA":
+                calls, variants, confidence = [[None, None]], [[]], None
+            else:
+                calls, variants = haps["HAPS"][0], haps["HAPS"][1]
+                confidence = 1 / len(calls) if len(calls) > 0 else None
+            for call, call_variants in zip(calls, variants):
+                self.columns["subject"].append(str(subject))
+                self.columns["gene"].append(gene)
+                self.columns["haplotype_1"].append(call[0] if len(call) > 0 else None)
+                self.columns["haplotype_2"].append("/".join(call[1:]) if len(call) > 1 else None)
+                self.columns["confidence"].append(confidence)
+                self.columns["variants"].append(list(call_variants))
+                self.columns["timed_out"].append(bool(haps.get("TIMED_OUT", False)))
+                self.columns["max_solve_time"].append(float(haps.get("SOLVE_TIME", 0)))
+        if len(self.columns["subject"]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write buffered rows as a row group
+        """
+        if len(self.columns["subject"]) == 0:
+            return
+        self.writer.write_table(pa.table(self.columns, schema = self.schema))
+        self.columns = {name: [] for name in self.schema.names}
+
+    def close(self) -> None:
+        """
+        Write remaining rows and close the file
+        """
+        self.flush()
+        self.writer.close()
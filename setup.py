@@ -28,6 +28,10 @@ setup(
         "pandas",
         "pysam",
         "numpy"
-    ]
+    ],
+    extras_require={
+        "parquet": ["pyarrow"],
+        "sweep": ["pyyaml"]
+    }
 )
 